@@ -0,0 +1,112 @@
+# Compares the old JSON text cache format with the binary compressed format
+# Reports stored bytes per key and hit latency (decode + building the response)
+# Uses a synthetic Spotify album payload shaped like the real API response
+# Run from the backend directory: python -m benchmarks.cache_format
+import argparse
+import json
+import statistics
+import time
+from fastapi.responses import JSONResponse
+from utils.redis_cache import cachedResponse, deserializeEntry, encodeBody, serializeEntry
+
+# Roughly the size of Spotify's available_markets array
+MARKETS = [f"M{i:03d}" for i in range(185)]
+
+def makeImages(seed: str):
+    return [
+        {"url": f"https://i.scdn.co/image/{seed}{size}", "height": size, "width": size}
+        for size in (640, 300, 64)
+    ]
+
+def makeArtist(i: int):
+    return {
+        "id": f"artist{i:018d}",
+        "name": f"Artist {i}",
+        "type": "artist",
+        "uri": f"spotify:artist:artist{i:018d}",
+        "href": f"https://api.spotify.com/v1/artists/artist{i:018d}",
+        "external_urls": {"spotify": f"https://open.spotify.com/artist/artist{i:018d}"},
+    }
+
+def makeAlbum(trackCount: int):
+    tracks = []
+    for i in range(trackCount):
+        tracks.append({
+            "id": f"track{i:018d}",
+            "name": f"Track number {i}",
+            "track_number": i + 1,
+            "disc_number": 1,
+            "duration_ms": 180000 + i * 1000,
+            "explicit": False,
+            "is_local": False,
+            "type": "track",
+            "uri": f"spotify:track:track{i:018d}",
+            "href": f"https://api.spotify.com/v1/tracks/track{i:018d}",
+            "preview_url": None,
+            "available_markets": MARKETS,
+            "artists": [makeArtist(1)],
+            "external_urls": {"spotify": f"https://open.spotify.com/track/track{i:018d}"},
+        })
+    return {
+        "id": "album0000000000000000",
+        "name": "Benchmark Album",
+        "album_type": "album",
+        "total_tracks": trackCount,
+        "release_date": "2020-01-01",
+        "release_date_precision": "day",
+        "label": "Benchmark Records",
+        "popularity": 50,
+        "genres": [],
+        "available_markets": MARKETS,
+        "images": makeImages("album"),
+        "artists": [makeArtist(1)],
+        "copyrights": [{"text": "2020 Benchmark Records", "type": "C"}],
+        "external_ids": {"upc": "000000000000"},
+        "external_urls": {"spotify": "https://open.spotify.com/album/album0000000000000000"},
+        "tracks": {"items": tracks, "total": trackCount, "limit": 50, "offset": 0},
+    }
+
+# The previous format: JSON text envelope, decoded and re-encoded on every hit
+def oldStore(payload, softExpiry):
+    return json.dumps({"value": payload, "softExpiry": softExpiry, "delta": 0.1})
+
+def oldHit(stored):
+    data = json.loads(stored)["value"]
+    data = {**data, "source": "cache"}
+    return JSONResponse(data).body
+
+def newHit(stored):
+    return cachedResponse(deserializeEntry(stored), "cache").body
+
+def timeHits(hit, stored, iterations: int):
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        hit(stored)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return {
+        "p50Ms": statistics.median(timings) * 1000,
+        "p99Ms": timings[int(len(timings) * 0.99) - 1] * 1000,
+    }
+
+def run(trackCount: int, iterations: int):
+    payload = makeAlbum(trackCount)
+    softExpiry = time.time() + 3600
+    oldStored = oldStore(payload, softExpiry).encode("utf-8")
+    newStored = serializeEntry(encodeBody(payload), softExpiry, 0.1)
+
+    results = {
+        "old": {"bytesPerKey": len(oldStored), **timeHits(oldHit, oldStored, iterations)},
+        "new": {"bytesPerKey": len(newStored), **timeHits(newHit, newStored, iterations)},
+    }
+    print(json.dumps(results, indent=2))
+    print(f"Stored size reduced by {1 - len(newStored) / len(oldStored):.0%}")
+    print(f"p99 hit latency reduced by {1 - results['new']['p99Ms'] / results['old']['p99Ms']:.0%}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tracks", type=int, default=20)
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+    run(args.tracks, args.iterations)
@@ -0,0 +1,49 @@
+# Load test showing cache hits are not throttled by the rate limiter
+# Seeds a cached song in Redis then fires concurrent requests for it
+# through the app, comparing the throughput against the limiter's maxCalls
+# Requires Redis to be running (uses REDIS_URL like the app)
+# Run from the backend directory: python -m benchmarks.cache_hit_throughput
+import argparse
+import asyncio
+import time
+import httpx
+from main import app
+from redis_client import redisBinaryClient
+from utils.rate_limiter import spotifyRateLimiter
+from utils.redis_cache import encodeBody, serializeEntry
+
+SONG_ID = "benchmark-cache-hit"
+
+async def run(requests: int, concurrency: int):
+    # Seed the cache so every request is a hit
+    await redisBinaryClient.setex(
+        f"spotify:song_details:{SONG_ID}",
+        60,
+        serializeEntry(encodeBody({"id": SONG_ID, "name": "Benchmark"}), time.time() + 60, 0.0)
+    )
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def hit():
+            async with semaphore:
+                response = await client.get(f"/spotify/songs/{SONG_ID}")
+                response.raise_for_status()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(hit() for _ in range(requests)))
+        elapsed = time.perf_counter() - start
+
+    await redisBinaryClient.delete(f"spotify:song_details:{SONG_ID}")
+
+    limit = spotifyRateLimiter.maxCalls / spotifyRateLimiter.period
+    print(f"{requests} cache hits in {elapsed:.2f}s")
+    print(f"Throughput: {requests / elapsed:.0f} req/s (Spotify limiter allows {limit:.0f} calls/s)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(run(args.requests, args.concurrency))
@@ -0,0 +1,155 @@
+# Measures a worker's cold start and per core throughput under each run profile
+# baseline: asyncio event loop, h11 and no startup warm-up (plain `uvicorn main:app`)
+# production: uvloop, httptools and the startup warm-up (as start.sh runs it)
+# For each profile a single worker is started against benchmarks/stubs.py and timed:
+# startup: process start until it accepts connections
+# first requests: the first request to each endpoint, all uncached so all go upstream
+# second requests: the same endpoints again with new keys, the usual cost of a miss
+# throughput: req/s of cached requests over --duration seconds, one worker so per core
+# The stubs are plain HTTP so TLS handshakes aren't part of the cold start measured here,
+# real upstreams add one per upstream to the baseline's first requests
+# Redis: uses REDIS_URL, or with --redis fake each worker has its own in-process fakeredis
+# Benchmark keys are deleted between runs so don't point it at production Redis
+# Run from the backend directory: python -m benchmarks.cold_start [--runs 5]
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from types import SimpleNamespace
+from benchmarks.load_test import STUB_HOST, configureEnvironment, runLoad, spotifyID, startStubs
+
+PROFILES = {
+    "baseline": {"loop": "asyncio", "http": "h11", "warmup": "0"},
+    "production": {"loop": "uvloop", "http": "httptools", "warmup": "1"},
+}
+
+# One request per endpoint, each needing a different upstream
+def endpointRequests(key: str):
+    return [
+        ("/spotify/songs/{songID}", f"/spotify/songs/{spotifyID(key)}"),
+        ("/spotify/search_artists", f"/spotify/search_artists?artist={key}"),
+        ("/youtube/get_video_tutorials/{search_query}", f"/youtube/get_video_tutorials/{key}"),
+        ("/google/search_tabs/", f"/google/search_tabs/?query={key}"),
+    ]
+
+def parseArgs():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--profiles", default="baseline,production")
+    parser.add_argument("--runs", type=int, default=3, help="Cold starts per profile, medians are reported")
+    parser.add_argument("--duration", type=float, default=5, help="Seconds to measure throughput for")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency-ms", type=float, default=50, help="Upstream stub latency")
+    parser.add_argument("--redis", choices=["url", "fake"], default="url")
+    parser.add_argument("--port", type=int, default=8765, help="Port for the upstream stubs")
+    parser.add_argument("--app-port", type=int, default=8766, help="Port for the worker being measured")
+    # Used by the benchmark to start the worker being measured
+    parser.add_argument("--serve", choices=list(PROFILES), help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+# Runs a single worker with the profile, started in its own process by the benchmark
+def serve(args):
+    profile = PROFILES[args.serve]
+    os.environ["STARTUP_WARMUP"] = profile["warmup"]
+    configureEnvironment(SimpleNamespace(port=args.port, rate_limit=None, redis=args.redis))
+    import uvicorn
+    from main import app
+    uvicorn.run(app, host=STUB_HOST, port=args.app_port, loop=profile["loop"], http=profile["http"], log_level="warning")
+
+def startWorker(args, profile: str):
+    return subprocess.Popen([
+        sys.executable, "-m", "benchmarks.cold_start", "--serve", profile,
+        "--port", str(args.port), "--app-port", str(args.app_port), "--redis", args.redis,
+    ])
+
+# Seconds until the worker accepts connections, uvicorn only listens once startup is done
+def waitForWorker(args, process, start: float):
+    while process.poll() is None:
+        try:
+            socket.create_connection((STUB_HOST, args.app_port), timeout=0.1).close()
+            return time.perf_counter() - start
+        except OSError:
+            time.sleep(0.005)
+    sys.exit(f"Worker exited with {process.returncode} before accepting connections")
+
+async def clearRedis():
+    from redis_client import redisClient
+    for pattern in ("spotify:*", "youtube:*", "google:*", "lock:*", "rate_limiter:*", "popularity:*"):
+        async for key in redisClient.scan_iter(match=pattern, count=500):
+            await redisClient.delete(key)
+
+# Times each request in turn, returning the seconds per endpoint
+async def timeRequests(client, requests):
+    timings = {}
+    for endpoint, path in requests:
+        start = time.perf_counter()
+        response = await client.get(path)
+        timings[endpoint] = time.perf_counter() - start
+        if response.status_code != 200:
+            print(f"  {path} returned {response.status_code}")
+    return timings
+
+async def coldStart(args, profile: str, run: int):
+    import httpx
+    if args.redis == "url":
+        await clearRedis()
+    start = time.perf_counter()
+    process = startWorker(args, profile)
+    try:
+        result = {"startup": waitForWorker(args, process, start)}
+        async with httpx.AsyncClient(base_url=f"http://{STUB_HOST}:{args.app_port}", timeout=30) as client:
+            result["first"] = await timeRequests(client, endpointRequests(f"cold{run}"))
+            result["second"] = await timeRequests(client, endpointRequests(f"second{run}"))
+
+            # Throughput of cached requests, so it measures the worker rather than the stubs
+            limits = httpx.Limits(max_connections=args.concurrency)
+            async with httpx.AsyncClient(base_url=client.base_url, timeout=30, limits=limits) as loadClient:
+                timings = defaultdict(list)
+                errors = defaultdict(int)
+                requests = endpointRequests(f"cold{run}") * args.concurrency
+                loadStart = time.perf_counter()
+                while time.perf_counter() - loadStart < args.duration:
+                    await runLoad(loadClient, requests, args.concurrency, timings, errors)
+                elapsed = time.perf_counter() - loadStart
+                result["throughput"] = sum(len(values) for values in timings.values()) / elapsed
+                result["errors"] = sum(errors.values())
+        return result
+    finally:
+        process.terminate()
+        process.wait()
+
+async def main(args):
+    configureEnvironment(SimpleNamespace(port=args.port, rate_limit=None, redis=args.redis))
+    stubs = startStubs(SimpleNamespace(port=args.port, latency_ms=args.latency_ms, rate_429=0.0, padding=185), 3600)
+    results = {}
+    try:
+        for profile in args.profiles.split(","):
+            results[profile] = [await coldStart(args, profile, run) for run in range(args.runs)]
+    finally:
+        stubs.terminate()
+        stubs.wait()
+
+    print(f"Medians of {args.runs} cold starts, upstream latency {args.latency_ms:.0f} ms\n")
+    endpoints = [endpoint for endpoint, _ in endpointRequests("")]
+    for profile, runs in results.items():
+        first = {endpoint: statistics.median(run["first"][endpoint] for run in runs) for endpoint in endpoints}
+        second = {endpoint: statistics.median(run["second"][endpoint] for run in runs) for endpoint in endpoints}
+        startup = statistics.median(run["startup"] for run in runs)
+        print(f"{profile}  ({PROFILES[profile]['loop']}, {PROFILES[profile]['http']}, warm-up {'on' if PROFILES[profile]['warmup'] == '1' else 'off'})")
+        print(f"  startup until accepting connections {startup * 1000:>8.1f} ms")
+        print(f"  startup until first response        {(startup + first[endpoints[0]]) * 1000:>8.1f} ms")
+        for endpoint in endpoints:
+            print(f"  {endpoint:<45} first {first[endpoint] * 1000:>7.1f} ms  second {second[endpoint] * 1000:>7.1f} ms")
+        print(f"  cached throughput {statistics.median(run['throughput'] for run in runs):>8.0f} req/s per core"
+              f"  ({sum(run['errors'] for run in runs)} errors)\n")
+
+if __name__ == "__main__":
+    arguments = parseArgs()
+    if arguments.serve:
+        serve(arguments)
+    else:
+        asyncio.run(main(arguments))
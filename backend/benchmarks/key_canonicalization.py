@@ -0,0 +1,152 @@
+# Replays a query log against the cache keys before and after canonicalization
+# and negative caching, reporting the number of distinct keys, the hit rate and
+# the upstream calls (and YouTube quota) each would need
+# Nothing is called, the cache is simulated using each endpoint's TTLs
+# Log lines are: endpoint<TAB>query[<TAB>result], one request per line in order
+# endpoint is one of search_artists, search_songs, tutorials, tabs
+# result is ok (default), empty or not_found as the upstream would answer
+# Without --log a synthetic log with realistic variants of popular queries is used
+# Run from the backend directory: python -m benchmarks.key_canonicalization [--log queries.tsv]
+import argparse
+import random
+import unicodedata
+from collections import defaultdict
+from main import spotify_search_block, search_tutorial_videos, google_search_block
+
+# Cached function, its arguments for a query, and the key it used before canonicalization
+# Searches are cached in blocks of results, the log's requests are for the first page
+ENDPOINTS = {
+    "search_artists": (spotify_search_block, lambda q: {"kind": "artist", "query": q, "block": 0}, lambda q: f"spotify:search_artists:{q.lower().strip()}"),
+    "search_songs": (spotify_search_block, lambda q: {"kind": "track", "query": q, "block": 0}, lambda q: f"spotify:search_songs:{q.lower().strip()}"),
+    "tutorials": (search_tutorial_videos, lambda q: {"search_query": q}, lambda q: f"youtube:get_video_tutorials:{q} Guitar Tutorial and Tabs"),
+    "tabs": (google_search_block, lambda q: {"query": q, "block": 0}, lambda q: f"google:search_tabs:{q} tab"),
+}
+# YouTube quota units per tutorials fetch, search.list then videos.list
+# Not found stops after the search
+YOUTUBE_QUOTA = {"ok": 101, "empty": 101, "not_found": 100}
+
+NAMES = [
+    "Beyoncé", "Motörhead", "Björk", "Sigur Rós", "Mötley Crüe", "Blue Öyster Cult", "Café Tacvba",
+    "Metallica", "Nirvana", "Radiohead", "The Beatles", "Led Zeppelin", "Pink Floyd", "Queen",
+    "AC/DC", "Guns N' Roses", "Red Hot Chili Peppers", "Foo Fighters", "Arctic Monkeys", "Oasis",
+    "Wonderwall Oasis", "Smells Like Teen Spirit Nirvana", "Stairway to Heaven Led Zeppelin",
+    "Hotel California Eagles", "Back in Black AC/DC", "Enter Sandman Metallica", "Creep Radiohead",
+    "Ace of Spades Motörhead", "Jóga Björk", "Hoppípolla Sigur Rós", "Déjà Vu Beyoncé",
+]
+# Queries the upstreams have nothing for, e.g. typos
+MISSING = ["Metalica Enter Sandmn", "Wonderwal Oassis", "Stairway to Heavn Led Zepelin", "Bjork Jogaa"]
+
+def stripAccents(text: str):
+    return "".join(char for char in unicodedata.normalize("NFKD", text) if not unicodedata.combining(char))
+
+def fullWidth(text: str):
+    return "".join(chr(ord(char) + 0xFEE0) if "!" <= char <= "~" else char for char in text)
+
+# Ways users type the same query
+VARIANTS = [
+    lambda q: q,
+    lambda q: q.lower(),
+    lambda q: q.upper(),
+    lambda q: q.title(),
+    lambda q: f" {q} ",
+    lambda q: q.replace(" ", "  "),
+    lambda q: stripAccents(q),
+    lambda q: stripAccents(q).lower(),
+    lambda q: fullWidth(q),
+]
+
+# Zipf distributed popularity with each request typed as a random variant
+def syntheticLog(requests: int, seed: int):
+    rng = random.Random(seed)
+    queries = [(name, "ok") for name in NAMES] + [(name, "not_found") for name in MISSING]
+    weights = [1 / (rank + 1) for rank in range(len(queries))]
+    rng.shuffle(queries)
+    log = []
+    for _ in range(requests):
+        query, result = rng.choices(queries, weights)[0]
+        endpoint = rng.choice(list(ENDPOINTS))
+        # Spotify searches return an empty list rather than a 404
+        if result == "not_found" and endpoint != "tutorials":
+            result = "empty"
+        log.append((endpoint, rng.choice(VARIANTS)(query), result))
+    return log
+
+def readLog(path: str):
+    log = []
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            parts = line.rstrip("\n").split("\t")
+            if len(parts) >= 2:
+                log.append((parts[0], parts[1], parts[2] if len(parts) > 2 else "ok"))
+    return log
+
+# Simulates the cache with requests arriving interval seconds apart
+# old: not found isn't cached, everything else cached for the full TTL
+# new: not found and empty results cached for the endpoint's negativeExpires
+def replay(log, interval: float, canonical: bool):
+    expiry = {}
+    stats = defaultdict(lambda: {"requests": 0, "hits": 0, "keys": set(), "upstream": 0, "quota": 0})
+    for i, (endpoint, query, result) in enumerate(log):
+        now = i * interval
+        func, arguments, oldKey = ENDPOINTS[endpoint]
+        key = func.cacheKey(**arguments(query)) if canonical else oldKey(query)
+        endpointStats = stats[endpoint]
+        endpointStats["requests"] += 1
+        endpointStats["keys"].add(key)
+        if expiry.get(key, -1) > now:
+            endpointStats["hits"] += 1
+            continue
+
+        endpointStats["upstream"] += 1
+        if endpoint == "tutorials":
+            endpointStats["quota"] += YOUTUBE_QUOTA[result]
+        if result == "ok":
+            expiry[key] = now + func.expires
+        elif canonical:
+            expiry[key] = now + func.negativeExpires
+        elif result == "empty":
+            expiry[key] = now + func.expires
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--log", help="Query log to replay, a synthetic one is used if not given")
+    parser.add_argument("--requests", type=int, default=20000, help="Requests in the synthetic log")
+    parser.add_argument("--interval", type=float, default=1.0, help="Seconds between requests")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    log = readLog(args.log) if args.log else syntheticLog(args.requests, args.seed)
+    before = replay(log, args.interval, canonical=False)
+    after = replay(log, args.interval, canonical=True)
+
+    print(f"{len(log)} requests, {args.interval}s apart\n")
+    print(f"{'endpoint':<16}{'keys before':>12}{'keys after':>12}{'hit rate before':>17}{'hit rate after':>16}{'upstream before':>17}{'upstream after':>16}")
+    totals = defaultdict(int)
+    for endpoint in ENDPOINTS:
+        old, new = before[endpoint], after[endpoint]
+        if not old["requests"]:
+            continue
+        print(
+            f"{endpoint:<16}{len(old['keys']):>12}{len(new['keys']):>12}"
+            f"{old['hits'] / old['requests']:>17.1%}{new['hits'] / new['requests']:>16.1%}"
+            f"{old['upstream']:>17}{new['upstream']:>16}"
+        )
+        for name in ("requests", "upstream", "quota"):
+            totals[f"old{name}"] += old[name]
+            totals[f"new{name}"] += new[name]
+        totals["oldkeys"] += len(old["keys"])
+        totals["newkeys"] += len(new["keys"])
+
+    print(
+        f"\nKey space: {totals['oldkeys']} -> {totals['newkeys']} "
+        f"({1 - totals['newkeys'] / totals['oldkeys']:.1%} fewer keys)"
+    )
+    print(
+        f"Hit rate: {1 - totals['oldupstream'] / totals['oldrequests']:.1%} -> "
+        f"{1 - totals['newupstream'] / totals['newrequests']:.1%}"
+    )
+    print(f"YouTube quota units: {totals['oldquota']} -> {totals['newquota']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+# Offline load test of the backend against local upstream stand-ins
+# Starts benchmarks/stubs.py as the Spotify, YouTube and Google APIs, runs the
+# app in-process and reports req/s and p50/p95/p99 latency per endpoint
+# Scenarios:
+# cold: every request is for a different key, so all go upstream
+# hot: the same keys again, now all cached
+# stampede: many concurrent requests for one uncached key
+# token_expiry: steady load while the Spotify token expires and is refreshed
+# Results are written as JSON, and compared against a baseline if given so
+# regressions in the cache or rate limiter fail the run
+# Redis: uses REDIS_URL, or an in-process fakeredis with --redis fake
+# Benchmark keys are deleted between scenarios so don't point it at production Redis
+# Run from the backend directory: python -m benchmarks.load_test --output results.json
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+STUB_HOST = "127.0.0.1"
+
+# Spotify shaped ID (22 base62 characters) for a benchmark key, anything else is answered as not found
+def spotifyID(key: str):
+    return hashlib.md5(key.encode()).hexdigest()[:22]
+
+def parseArgs():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenarios", default="cold,hot,stampede,token_expiry")
+    parser.add_argument("--requests", type=int, default=400, help="Requests per endpoint in cold/hot")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--stampede", type=int, default=200, help="Concurrent requests in the stampede")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds to run token_expiry for")
+    parser.add_argument("--latency-ms", type=float, default=50, help="Upstream stub latency")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Fraction of upstream calls answered with 429")
+    parser.add_argument("--padding", type=int, default=185, help="Size of unused lists in Spotify payloads")
+    parser.add_argument("--rate-limit", type=int, default=None, help="Override every upstream rate limit (calls/s)")
+    parser.add_argument("--redis", choices=["url", "fake"], default="url")
+    parser.add_argument("--port", type=int, default=8765, help="Port for the upstream stubs")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--baseline", help="Fail if throughput or p99 regress against this results file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed regression against the baseline")
+    return parser.parse_args()
+
+# Everything the app reads from the environment at import time
+def configureEnvironment(args):
+    base = f"http://{STUB_HOST}:{args.port}"
+    os.environ.update({
+        "SPOTIFY_API_URL": f"{base}/v1",
+        "SPOTIFY_ACCOUNTS_URL": base,
+        "YOUTUBE_API_URL": f"{base}/youtube/v3",
+        "GOOGLE_SEARCH_API_URL": f"{base}/customsearch/v1/",
+        "SPOTIFY_CLIENT_KEY": "benchmark",
+        "SPOTIFY_SECRET_KEY": "benchmark",
+        "YOUTUBE_API_KEY": "benchmark",
+        "GOOGLE_SEARCH_API_KEY": "benchmark",
+        "GOOGLE_CUSTOM_SEARCH_ID": "benchmark",
+        # Short enough for the token_expiry scenario to see several refreshes
+        "SPOTIFY_TOKEN_REFRESH_MARGIN": "1",
+    })
+    if args.rate_limit:
+        for name in ("SPOTIFY_RATE_LIMIT", "YOUTUBE_RATE_LIMIT", "GOOGLE_SEARCH_RATE_LIMIT"):
+            os.environ[name] = str(args.rate_limit)
+
+    if args.redis == "fake":
+        # Must replace the clients before anything imports them
+        try:
+            import fakeredis
+        except ImportError:
+            sys.exit("--redis fake needs fakeredis (and lupa for the Lua scripts) installed")
+        import redis_client
+        server = fakeredis.FakeServer()
+        redis_client.redisClient = fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+        redis_client.redisBinaryClient = fakeredis.FakeAsyncRedis(server=server)
+
+# Runs the stubs in their own process so they don't share the app's event loop
+def startStubs(args, tokenExpiresIn: int):
+    env = {
+        **os.environ,
+        "STUB_LATENCY_MS": str(args.latency_ms),
+        "STUB_429_RATE": str(args.rate_429),
+        "STUB_PADDING": str(args.padding),
+        "STUB_TOKEN_EXPIRES_IN": str(tokenExpiresIn),
+    }
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "benchmarks.stubs:app",
+         "--host", STUB_HOST, "--port", str(args.port), "--log-level", "warning"],
+        env=env,
+    )
+    # Wait until the stubs accept connections
+    for _ in range(100):
+        try:
+            socket.create_connection((STUB_HOST, args.port), timeout=0.1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    sys.exit("Upstream stubs failed to start")
+
+def percentile(sortedValues, fraction: float):
+    return sortedValues[min(len(sortedValues) - 1, int(len(sortedValues) * fraction))]
+
+def summarise(timings, errors, elapsed: float):
+    summary = {}
+    for endpoint, values in timings.items():
+        values.sort()
+        summary[endpoint] = {
+            "requests": len(values),
+            "errors": errors[endpoint],
+            "reqPerSec": len(values) / elapsed,
+            "p50Ms": statistics.median(values) * 1000,
+            "p95Ms": percentile(values, 0.95) * 1000,
+            "p99Ms": percentile(values, 0.99) * 1000,
+        }
+    return summary
+
+# Sends the requests with limited concurrency, timing each one per endpoint
+# Timings and errors are added to the given dicts so runs can be combined
+async def runLoad(client, requests, concurrency: int, timings=None, errors=None):
+    timings = timings if timings is not None else defaultdict(list)
+    errors = errors if errors is not None else defaultdict(int)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(endpoint, path):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                response = await client.get(path)
+                if response.status_code != 200:
+                    errors[endpoint] += 1
+            except Exception:
+                errors[endpoint] += 1
+            timings[endpoint].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(send(endpoint, path) for endpoint, path in requests))
+    return summarise(timings, errors, time.perf_counter() - start)
+
+# One request per endpoint for each key, keys are spread so cold really is cold
+def mixedRequests(count: int, prefix: str):
+    requests = []
+    for i in range(count):
+        key = f"{prefix}{i}"
+        requests += [
+            ("/spotify/search_artists", f"/spotify/search_artists?artist={key}"),
+            ("/spotify/songs/{songID}", f"/spotify/songs/{spotifyID(key)}"),
+            ("/youtube/get_video_tutorials/{search_query}", f"/youtube/get_video_tutorials/{key}"),
+            ("/google/search_tabs/", f"/google/search_tabs/?query={key}"),
+        ]
+    return requests
+
+async def clearCaches():
+    from redis_client import redisClient
+    from utils.redis_cache import localCache
+    localCache.clear()
+    for pattern in ("spotify:*", "youtube:*", "google:*", "lock:*", "rate_limiter:*"):
+        async for key in redisClient.scan_iter(match=pattern, count=500):
+            await redisClient.delete(key)
+
+async def upstreamCalls(client):
+    return (await client.get("/stub/stats")).json()
+
+async def runScenario(name, args, app, stubClient):
+    import httpx
+    await clearCaches()
+    await stubClient.post("/stub/reset")
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=60) as client:
+        if name == "cold":
+            result = await runLoad(client, mixedRequests(args.requests, "cold"), args.concurrency)
+        elif name == "hot":
+            requests = mixedRequests(20, "hot")
+            # Warm up then time only cache hits
+            await runLoad(client, requests, args.concurrency)
+            await stubClient.post("/stub/reset")
+            result = await runLoad(client, requests * (args.requests // 20), args.concurrency)
+        elif name == "stampede":
+            requests = [("/spotify/songs/{songID}", f"/spotify/songs/{spotifyID('stampede')}")] * args.stampede
+            requests += [("/youtube/get_video_tutorials/{search_query}", "/youtube/get_video_tutorials/stampede")] * args.stampede
+            result = await runLoad(client, requests, args.stampede * 2)
+        elif name == "token_expiry":
+            # Tokens expire every 3 seconds, steady load of new keys runs across several expiries
+            timings = defaultdict(list)
+            errors = defaultdict(int)
+            start = time.perf_counter()
+            batch = 0
+            while time.perf_counter() - start < args.duration:
+                requests = [("/spotify/songs/{songID}", f"/spotify/songs/{spotifyID(f'token{batch}-{i}')}") for i in range(args.concurrency)]
+                await runLoad(client, requests, args.concurrency, timings, errors)
+                batch += 1
+            result = summarise(timings, errors, time.perf_counter() - start)
+        else:
+            raise ValueError(f"Unknown scenario {name}")
+
+    return {"endpoints": result, "upstreamCalls": await upstreamCalls(stubClient)}
+
+# Compares each endpoint against the baseline, returning a list of regressions
+def compare(results, baseline, tolerance: float):
+    regressions = []
+    for scenario, data in results.items():
+        for endpoint, stats in data["endpoints"].items():
+            before = baseline.get(scenario, {}).get("endpoints", {}).get(endpoint)
+            if before is None:
+                continue
+            if stats["reqPerSec"] < before["reqPerSec"] * (1 - tolerance):
+                regressions.append(f"{scenario} {endpoint}: {before['reqPerSec']:.0f} -> {stats['reqPerSec']:.0f} req/s")
+            if stats["p99Ms"] > before["p99Ms"] * (1 + tolerance):
+                regressions.append(f"{scenario} {endpoint}: p99 {before['p99Ms']:.1f} -> {stats['p99Ms']:.1f} ms")
+    return regressions
+
+async def main(args):
+    import httpx
+    from main import app
+
+    results = {}
+    scenarios = args.scenarios.split(",")
+    # token_expiry needs short lived tokens so gets its own stubs
+    for group, tokenExpiresIn in (([s for s in scenarios if s != "token_expiry"], 3600), (["token_expiry"] if "token_expiry" in scenarios else [], 3)):
+        if not group:
+            continue
+        stubs = startStubs(args, tokenExpiresIn)
+        try:
+            async with httpx.AsyncClient(base_url=f"http://{STUB_HOST}:{args.port}") as stubClient:
+                # Lifespan per group so the token manager starts fresh against these stubs
+                async with app.router.lifespan_context(app):
+                    from utils.spotify_access_token import spotifyTokenManager
+                    spotifyTokenManager.token = None
+                    for name in group:
+                        results[name] = await runScenario(name, args, app, stubClient)
+        finally:
+            stubs.terminate()
+            stubs.wait()
+
+    for name, data in results.items():
+        print(f"\n{name}  upstream calls: {data['upstreamCalls']}")
+        for endpoint, stats in data["endpoints"].items():
+            print(
+                f"  {endpoint:<45} {stats['requests']:>6} req {stats['errors']:>4} err "
+                f"{stats['reqPerSec']:>8.0f} req/s  p50 {stats['p50Ms']:>7.1f}  "
+                f"p95 {stats['p95Ms']:>7.1f}  p99 {stats['p99Ms']:>7.1f} ms"
+            )
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        if regressions:
+            print("\nRegressions against baseline:")
+            print("\n".join(f"  {regression}" for regression in regressions))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    arguments = parseArgs()
+    configureEnvironment(arguments)
+    asyncio.run(main(arguments))
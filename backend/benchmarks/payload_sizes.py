@@ -0,0 +1,67 @@
+# Measures how much the response projections shrink each endpoint's payload
+# Calls the real upstream APIs once per endpoint (needs the API keys from .env)
+# and compares the full response size with the projected size
+# Run from the backend directory: python -m benchmarks.payload_sizes
+import argparse
+import asyncio
+import json
+import httpx
+from main import GOOGLE_CUSTOM_SEARCH_ID, GOOGLE_SEARCH_API_KEY, YOUTUBE_API_KEY
+from utils.projections import (
+    projectArtistSearch, projectTrackSearch, projectArtist, projectAlbum, projectTrack,
+    projectTopTracks, projectVideos, projectTabResults,
+    YOUTUBE_SEARCH_FIELDS, YOUTUBE_VIDEOS_FIELDS, GOOGLE_SEARCH_FIELDS
+)
+from utils.spotify_access_token import get_spotify_access_token
+
+def size(data):
+    return len(json.dumps(data, separators=(",", ":")).encode("utf-8"))
+
+async def run(artistID: str, albumID: str, songID: str, query: str):
+    results = {}
+    async with httpx.AsyncClient(timeout=10) as client:
+        token = await get_spotify_access_token(client)
+        headers = {"Authorization": f"Bearer {token}"}
+        spotify = "https://api.spotify.com/v1"
+
+        spotifyCalls = {
+            "search_artists": (f"{spotify}/search", {"q": query, "type": "artist", "limit": 20}, projectArtistSearch),
+            "search_songs": (f"{spotify}/search", {"q": query, "type": "track", "limit": 20}, projectTrackSearch),
+            "artist_details": (f"{spotify}/artists/{artistID}", None, projectArtist),
+            "album_details": (f"{spotify}/albums/{albumID}", None, projectAlbum),
+            "song_details": (f"{spotify}/tracks/{songID}", None, projectTrack),
+            "artist_top_songs": (f"{spotify}/artists/{artistID}/top-tracks", {"market": "US"}, projectTopTracks),
+        }
+        for name, (url, params, project) in spotifyCalls.items():
+            full = (await client.get(url, params=params, headers=headers)).json()
+            results[name] = (size(full), size(project(full)))
+
+        # YouTube and Google are compared with and without the fields mask
+        youtube = "https://www.googleapis.com/youtube/v3"
+        searchParams = {"part": "snippet", "q": f"{query} Guitar Tutorial and Tabs", "type": "video", "maxResults": 8, "key": YOUTUBE_API_KEY}
+        fullSearch = (await client.get(f"{youtube}/search", params=searchParams)).json()
+        trimmedSearch = (await client.get(f"{youtube}/search", params={**searchParams, "fields": YOUTUBE_SEARCH_FIELDS})).json()
+        ids = ",".join(item["id"]["videoId"] for item in trimmedSearch.get("items", []))
+        videoParams = {"id": ids, "key": YOUTUBE_API_KEY}
+        fullVideos = (await client.get(f"{youtube}/videos", params={**videoParams, "part": "snippet,contentDetails,statistics"})).json()
+        trimmedVideos = (await client.get(f"{youtube}/videos", params={**videoParams, "part": "snippet,statistics", "fields": YOUTUBE_VIDEOS_FIELDS})).json()
+        results["youtube_search"] = (size(fullSearch), size(trimmedSearch))
+        results["get_video_tutorials"] = (size(fullVideos), size(projectVideos(trimmedVideos)))
+
+        googleParams = {"q": f"{query} tab", "cx": GOOGLE_CUSTOM_SEARCH_ID, "key": GOOGLE_SEARCH_API_KEY}
+        fullTabs = (await client.get("https://www.googleapis.com/customsearch/v1/", params=googleParams)).json()
+        trimmedTabs = (await client.get("https://www.googleapis.com/customsearch/v1/", params={**googleParams, "fields": GOOGLE_SEARCH_FIELDS})).json()
+        results["search_tabs"] = (size(fullTabs), size(projectTabResults(trimmedTabs)))
+
+    print(f"{'endpoint':<22}{'full':>10}{'projected':>12}{'reduction':>12}")
+    for name, (full, projected) in results.items():
+        print(f"{name:<22}{full:>10}{projected:>12}{1 - projected / max(full, 1):>12.0%}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--artist", default="3WrFJ7ztbogyGnTHbHJFl2") # The Beatles
+    parser.add_argument("--album", default="0ETFjACtuP2ADo6LFhL6HN") # Abbey Road
+    parser.add_argument("--song", default="2EqlS6tkEnglzr7tkKAAYD") # Come Together
+    parser.add_argument("--query", default="come together")
+    args = parser.parse_args()
+    asyncio.run(run(args.artist, args.album, args.song, args.query))
@@ -0,0 +1,136 @@
+# Local stand-ins for the Spotify, YouTube and Google Custom Search APIs
+# Return responses shaped like the real APIs so the app can be load tested
+# without spending real rate limits or quota
+# Configured with environment variables:
+# STUB_LATENCY_MS: delay added to every response
+# STUB_429_RATE: fraction of API calls answered with a 429 and Retry-After
+# STUB_PADDING: size of the unused available_markets list on Spotify items
+# STUB_TOKEN_EXPIRES_IN: expires_in returned with Spotify access tokens
+# Run with: uvicorn benchmarks.stubs:app --port 8765
+import asyncio
+import os
+import random
+from collections import Counter
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+
+LATENCY = float(os.getenv("STUB_LATENCY_MS", "50")) / 1000
+RATE_429 = float(os.getenv("STUB_429_RATE", "0"))
+PADDING = int(os.getenv("STUB_PADDING", "185"))
+TOKEN_EXPIRES_IN = int(os.getenv("STUB_TOKEN_EXPIRES_IN", "3600"))
+
+MARKETS = [f"M{i:03d}" for i in range(PADDING)]
+
+app = FastAPI()
+# Calls received per upstream endpoint, read by the benchmark to count upstream calls
+calls = Counter()
+
+# Adds the configured latency and occasionally rate limits the call
+async def upstream(name: str):
+    calls[name] += 1
+    await asyncio.sleep(LATENCY)
+    if RATE_429 and random.random() < RATE_429:
+        calls[f"{name}:429"] += 1
+        return JSONResponse({"error": {"status": 429}}, status_code=429, headers={"Retry-After": "1"})
+    return None
+
+def image(id: str):
+    return [{"url": f"https://i.example/{id}/{size}", "height": size, "width": size} for size in (640, 300, 64)]
+
+def artist(id: str):
+    return {
+        "id": id, "name": f"Artist {id}", "type": "artist", "uri": f"spotify:artist:{id}",
+        "images": image(id), "genres": ["rock"], "followers": {"total": 1000, "href": None},
+        "popularity": 50, "external_urls": {"spotify": f"https://open.spotify.com/artist/{id}"},
+    }
+
+def album(id: str):
+    return {
+        "id": id, "name": f"Album {id}", "album_type": "album", "uri": f"spotify:album:{id}",
+        "images": image(id), "artists": [artist(f"{id}-artist")], "release_date": "2020-01-01",
+        "total_tracks": 10, "available_markets": MARKETS,
+        "external_urls": {"spotify": f"https://open.spotify.com/album/{id}"},
+        "tracks": {"items": [track(f"{id}-{i}", withAlbum=False) for i in range(10)], "total": 10},
+    }
+
+def track(id: str, withAlbum=True):
+    data = {
+        "id": id, "name": f"Track {id}", "type": "track", "uri": f"spotify:track:{id}",
+        "duration_ms": 200000, "track_number": 1, "explicit": False, "popularity": 50,
+        "artists": [artist(f"{id}-artist")], "available_markets": MARKETS,
+        "external_urls": {"spotify": f"https://open.spotify.com/track/{id}"},
+    }
+    if withAlbum:
+        data["album"] = {key: value for key, value in album(f"{id}-album").items() if key != "tracks"}
+    return data
+
+def page(items, offset: int, limit: int):
+    return {"items": items, "total": 1000, "offset": offset, "limit": limit}
+
+@app.post("/api/token")
+async def token():
+    calls["spotify:token"] += 1
+    await asyncio.sleep(LATENCY)
+    return {"access_token": f"stub-token-{calls['spotify:token']}", "token_type": "Bearer", "expires_in": TOKEN_EXPIRES_IN}
+
+@app.get("/v1/search")
+async def spotify_search(q: str, type: str, limit: int = 20, offset: int = 0):
+    if (limited := await upstream("spotify:search")) is not None:
+        return limited
+    items = [(artist if type == "artist" else track)(f"{q}-{offset + i}") for i in range(limit)]
+    return {f"{type}s": page(items, offset, limit)}
+
+@app.get("/v1/{resource}")
+async def spotify_many(resource: str, ids: str):
+    if (limited := await upstream(f"spotify:{resource}")) is not None:
+        return limited
+    build = {"artists": artist, "albums": album, "tracks": track}[resource]
+    return {resource: [build(id) for id in ids.split(",")]}
+
+@app.get("/v1/artists/{artistID}/top-tracks")
+async def spotify_top_tracks(artistID: str):
+    if (limited := await upstream("spotify:top_tracks")) is not None:
+        return limited
+    return {"tracks": [track(f"{artistID}-top-{i}") for i in range(10)]}
+
+@app.get("/youtube/v3/search")
+async def youtube_search(q: str, maxResults: int = 8):
+    if (limited := await upstream("youtube:search")) is not None:
+        return limited
+    return {"items": [{"id": {"kind": "youtube#video", "videoId": f"{abs(hash(q)) % 10000}-{i}"}} for i in range(maxResults)]}
+
+@app.get("/youtube/v3/videos")
+async def youtube_videos(id: str):
+    if (limited := await upstream("youtube:videos")) is not None:
+        return limited
+    return {"items": [
+        {
+            "id": videoId,
+            "snippet": {"title": f"Video {videoId}", "channelTitle": "Channel", "description": "x" * 500},
+            "statistics": {"viewCount": "1000", "likeCount": "100"},
+        }
+        for videoId in id.split(",")
+    ]}
+
+@app.get("/customsearch/v1/")
+async def google_search(q: str, start: int = 1, num: int = 10):
+    if (limited := await upstream("google:search")) is not None:
+        return limited
+    return {"items": [
+        {
+            "title": f"{q} tab {start + i}", "link": f"https://tabs.example/{start + i}",
+            "snippet": "Guitar tab", "displayLink": "tabs.example",
+            "pagemap": {"metatags": [{"og:image": "https://tabs.example/icon.png"}]},
+        }
+        for i in range(num)
+    ]}
+
+# Used by the benchmark to count upstream calls made during a scenario
+@app.get("/stub/stats")
+async def stats():
+    return dict(calls)
+
+@app.post("/stub/reset")
+async def reset():
+    calls.clear()
+    return {}
@@ -1,21 +1,74 @@
-from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 import httpx
 import os
+import asyncio
+import json
+import re
 from contextlib import asynccontextmanager
 from utils.rate_limiter import SpotifyRateLimited, YoutubeRateLimited, GoogleSearchRateLimited
-from utils.redis_cache import checkRedisCache
-from utils.spotify_access_token import get_spotify_access_token
+from utils.rate_limiter import spotifyRateLimiter, youtubeRateLimiter, googleSearchRateLimiter
+from utils.redis_cache import checkRedisCache, singleFlightStats, refreshStats, localCache, listenForInvalidations, encodeBody
+from utils.redis_cache import inFlightFetches, readEntryHeader
+from utils.spotify_access_token import spotify_get, spotifyTokenManager
+from utils.batcher import MicroBatcher
+from utils.http_client import createUpstreamClient, requestWithRetry
+from utils.metrics import MetricsMiddleware, renderMetrics
+from utils.deadline import DeadlineMiddleware
+from utils.circuit_breaker import UpstreamUnavailable
+from utils.youtube_quota import youtubeQuota
+from utils.pagination import decodeCursor, fetchPage, prefetch, prefetchStats, spareBudget
+from utils.warmup import STARTUP_WARMUP, warmUp
+from redis_client import redisClient
+from utils.cache_warmer import cacheWarmer
+from utils.popularity import popularityTracker
+from utils.autocomplete import autocompleteIndex
+from utils.http_cache import GZipETagMiddleware, cacheControl, computeETag, conditionalResponse, minMaxAge
+from utils.projections import (
+    projectArtistSearch, projectTrackSearch, projectArtist, projectAlbum, projectTrack,
+    projectTopTracks, projectVideos, projectTabResults,
+    YOUTUBE_SEARCH_FIELDS, YOUTUBE_VIDEOS_FIELDS, GOOGLE_SEARCH_FIELDS
+)
 
-# Creating a single instance of httpx client
+# Creating a single httpx client per upstream API
 # More efficient than always creating a new instance
 # And makes it easier to manage the closing of clients
 @asynccontextmanager
 async def Lifespan(app: FastAPI):
-    # Global httpx instance with a timeout of 10 seconds
-    app.httpxClient = httpx.AsyncClient(timeout=10)
+    # Separate connection pools so a slow upstream can't starve the others
+    # All three upstreams support HTTP/2, multiplexing requests over fewer connections
+    app.spotifyClient = createUpstreamClient(maxConnections=20, maxKeepalive=10)
+    app.youtubeClient = createUpstreamClient(maxConnections=10, maxKeepalive=5)
+    app.googleClient = createUpstreamClient(maxConnections=10, maxKeepalive=5)
+    # Connects to Redis and the upstreams and gets a Spotify token before taking requests
+    app.state.ready = False
+    app.state.warmup = None
+    if STARTUP_WARMUP:
+        app.state.warmup = await warmUp(app, [
+            ("spotify", app.spotifyClient, SPOTIFY_API_URL),
+            ("youtube", app.youtubeClient, YOUTUBE_API_URL),
+            ("googleSearch", app.googleClient, GOOGLE_SEARCH_API_URL),
+        ])
+    app.state.ready = True
+    # Keeps this worker's in-process cache in sync with writes from other workers
+    invalidationListener = asyncio.create_task(listenForInvalidations())
+    # Refreshes the Spotify access token before it expires
+    tokenRefresher = asyncio.create_task(spotifyTokenManager.keepFresh(app.spotifyClient))
+    # Tracks the most requested keys and refreshes them before they expire
+    cacheWarmerTask = asyncio.create_task(cacheWarmer.run(app))
+    # Loads and saves the autocomplete index snapshot
+    autocompleteSnapshotter = asyncio.create_task(autocompleteIndex.keepSnapshotted())
     yield # Instance is created and usable
-    await app.httpxClient.aclose() # Close the instance on app shutdown
+    app.state.ready = False
+    invalidationListener.cancel()
+    tokenRefresher.cancel()
+    cacheWarmerTask.cancel()
+    autocompleteSnapshotter.cancel()
+    # Close the clients on app shutdown
+    await app.spotifyClient.aclose()
+    await app.youtubeClient.aclose()
+    await app.googleClient.aclose()
 
 app = FastAPI(lifespan=Lifespan)
 
@@ -24,6 +77,34 @@ GOOGLE_SEARCH_API_KEY = os.getenv("GOOGLE_SEARCH_API_KEY")
 # Using a custom google search which filters by the following sites:
 # Songsterr, Ultimate Guitar, GuitarTabs, AzChords
 GOOGLE_CUSTOM_SEARCH_ID = os.getenv("GOOGLE_CUSTOM_SEARCH_ID")
+# Upstream API base URLs, only overridden to point at local stand-ins when benchmarking
+SPOTIFY_API_URL = os.getenv("SPOTIFY_API_URL", "https://api.spotify.com/v1")
+YOUTUBE_API_URL = os.getenv("YOUTUBE_API_URL", "https://www.googleapis.com/youtube/v3")
+GOOGLE_SEARCH_API_URL = os.getenv("GOOGLE_SEARCH_API_URL", "https://www.googleapis.com/customsearch/v1/")
+# Longest the song page waits for the tutorials or tabs before returning without them
+SONG_PAGE_PART_TIMEOUT = float(os.getenv("SONG_PAGE_PART_TIMEOUT", "5"))
+# After a Redis restart the song pages for the top tracks of this many of the
+# most popular artists are warmed again, the number of top tracks used per artist
+WARM_SONG_PAGE_ARTISTS = int(os.getenv("WARM_SONG_PAGE_ARTISTS", "3"))
+WARM_SONG_PAGE_TRACKS = int(os.getenv("WARM_SONG_PAGE_TRACKS", "5"))
+# Autocomplete only searches Spotify when the local index has fewer results than this
+# and the query is at least AUTOCOMPLETE_UPSTREAM_MIN_LENGTH characters
+AUTOCOMPLETE_MIN_RESULTS = int(os.getenv("AUTOCOMPLETE_MIN_RESULTS", "3"))
+AUTOCOMPLETE_UPSTREAM_MIN_LENGTH = int(os.getenv("AUTOCOMPLETE_UPSTREAM_MIN_LENGTH", "3"))
+# Share of Spotify's rate limit autocomplete may use for searches which aren't cached yet
+# Only used while no user calls are queued, so typing never delays actual requests
+AUTOCOMPLETE_BUDGET_SHARE = float(os.getenv("AUTOCOMPLETE_BUDGET_SHARE", "0.25"))
+# How long browsers may reuse suggestions (seconds), short as the index keeps growing
+AUTOCOMPLETE_MAX_AGE = int(os.getenv("AUTOCOMPLETE_MAX_AGE", "60"))
+# Results fetched and cached per upstream search call, search pages of any size are cut from these blocks
+# Spotify returns at most 50 results per search and Google 10
+SPOTIFY_SEARCH_BLOCK = int(os.getenv("SPOTIFY_SEARCH_BLOCK", "20"))
+GOOGLE_SEARCH_BLOCK = 10
+# Furthest each upstream pages into search results
+SPOTIFY_SEARCH_MAX_RESULTS = 1000
+GOOGLE_SEARCH_MAX_RESULTS = 100
+# Most results a search page may have
+MAX_SEARCH_PAGE = 50
 
 # Allows CORS for the frontend (react) to communicate with the backend (FastAPI)
 app.add_middleware(
@@ -32,90 +113,162 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Cache-Source"], # Lets the frontend see whether a response was cached
 )
-
-# Search for an artist using Spotify API
-@app.get("/spotify/search_artists")
-# Uses Spotify API so endpoint is rate limited
-@SpotifyRateLimited
-# Wrapper to check cache before adding to rate limiter or making API call
+# Compresses large responses for clients accepting gzip
+# Cached responses already sent deflate encoded are passed through untouched
+# Level 6 is almost as small as the default 9 for JSON at a fraction of the CPU
+app.add_middleware(GZipMiddleware, minimum_size=1000, compresslevel=6)
+# Gzipped responses get their own ETag rather than the uncompressed body's
+app.add_middleware(GZipETagMiddleware)
+# Gives each request a deadline, past which it fails fast or is served stale
+# rather than queueing for a slow upstream
+app.add_middleware(DeadlineMiddleware)
+# Times every request for Prometheus and adds the Server-Timing header
+app.add_middleware(MetricsMiddleware)
+
+# One block of Spotify search results, the unit search pages are cached in
+# kind is the Spotify search type (artist or track), query the search as sent to Spotify
+# Not routed, the search endpoints cut their pages out of these blocks
 # Kwargs acting as a safety net for any additional arguments which will not be used in cache key
+# Query is canonicalized so case, accent and whitespace variants share a key
 @checkRedisCache(
-    lambda artist, **kwargs: f"spotify:search_artists:{artist.lower().strip()}", 
-    expires=3600
+    lambda kind, query, block, **kwargs: f"spotify:search_{kind}s:{query}:{block}",
+    expires=3600,
+    canonical=("query",),
+    isEmpty=lambda result: not result["items"]
 )
-async def search_for_artist(
+# Uses Spotify API so upstream calls are rate limited
+@SpotifyRateLimited
+async def spotify_search_block(
     request: Request,
-    artist: str = Query(..., description="Artist name to search with Spotify API.")
+    kind: str,
+    query: str,
+    block: int
     ):
-    client = request.app.httpxClient
-
-    # Lower and strip to improve caching consistency
-    artist = artist.lower().strip()
-    # Calling function to get spotify access token for authorization
-    access_token = await get_spotify_access_token(client)
+    client = request.app.spotifyClient
 
     params = {
-        "q": artist,
-        "type": "artist",
-        # Limit the number of results to 20
-        "limit": 20
+        "q": query,
+        "type": kind,
+        "limit": SPOTIFY_SEARCH_BLOCK,
+        "offset": block * SPOTIFY_SEARCH_BLOCK
     }
-    # Have to send auth header for API access with generated access token
-    headers = {"Authorization": f"Bearer {access_token}"}
-
-    # Making the API call to spotify
-    response = await client.get("https://api.spotify.com/v1/search", params=params, headers=headers)
+    # Making the API call to spotify, handles the access token
+    response = await spotify_get(client, f"{SPOTIFY_API_URL}/search", params=params)
     # Check if the response is successful and send appropriate error if not
     if response.status_code != 200:
         raise HTTPException(status_code=500, detail="Error fetching from Spotify API")
 
-    return response.json()
+    # Only keep the fields the frontend uses before caching
+    # Results found can then be suggested by autocomplete
+    if kind == "artist":
+        result = projectArtistSearch(response.json())["artists"]
+        autocompleteIndex.addArtists(result["items"])
+    else:
+        result = projectTrackSearch(response.json())["tracks"]
+        autocompleteIndex.addTracks(result["items"])
+    return result
+
+# Whether the request was routed straight to the endpoint, rather than another endpoint calling it
+# Only those get a 304 and have their next page prefetched, the others need the body
+# and aren't paged through (e.g. the song page's tabs)
+def routed_to(request: Request, endpoint):
+    return request.scope.get("endpoint") is endpoint
+
+# Page of a Spotify search cut from the cached blocks, optionally prefetching the next page's blocks
+async def spotify_search_page(request: Request, kind: str, query: str, limit: int, cursor: str | None, prefetchNext: bool):
+    return await fetchPage(
+        lambda block: spotify_search_block(request=request, kind=kind, query=query, block=block),
+        decodeCursor(cursor), limit, SPOTIFY_SEARCH_BLOCK, SPOTIFY_SEARCH_MAX_RESULTS,
+        (lambda block: prefetch(spotify_search_block, spotifyRateLimiter, request=request, kind=kind, query=query, block=block))
+        if prefetchNext else None
+    )
+
+# Response for a page of search results, only fresh while every block it was cut from is
+# request is None when answering another endpoint, so no 304 is sent
+def search_response(request: Request | None, result, responses):
+    body = encodeBody(result)
+    sources = {response.headers.get("x-cache-source") for response in responses}
+    return conditionalResponse(
+        request, body, computeETag(body),
+        cacheControl(minMaxAge(response.headers.get("cache-control") for response in responses)),
+        {"X-Cache-Source": "upstream" if "upstream" in sources else "cache"}
+    )
+
+# Search for an artist using Spotify API
+# Paged with cursors, pass the page's next as the cursor for the following page
+@app.get("/spotify/search_artists")
+async def search_for_artist(
+    request: Request,
+    artist: str = Query(..., description="Artist name to search with Spotify API."),
+    limit: int = Query(20, ge=1, le=MAX_SEARCH_PAGE, description="Results per page."),
+    cursor: str | None = Query(None, description="Cursor of the page to get, the first page if not given.")
+    ):
+    direct = routed_to(request, search_for_artist)
+    page, responses = await spotify_search_page(request, "artist", artist, limit, cursor, direct)
+    return search_response(request if direct else None, {"artists": page}, responses)
 
 # Search for a song using Spotify API
+# Paged with cursors, pass the page's next as the cursor for the following page
 @app.get("/spotify/search_songs")
-# Uses Spotify API so endpoint is rate limited
-@SpotifyRateLimited
-# Wrapper to check cache before adding to rate limiter or making API call
-# Kwargs acting as a safety net for any additional arguments which will not be used in cache key
-@checkRedisCache(
-    lambda song, **kwargs: f"spotify:search_songs:{song.lower().strip()}", 
-    expires=3600
-)
 async def search_for_songs(
     request: Request,
-    song: str = Query(..., description="Song name to search with Spotify API.")
+    song: str = Query(..., description="Song name to search with Spotify API."),
+    limit: int = Query(20, ge=1, le=MAX_SEARCH_PAGE, description="Results per page."),
+    cursor: str | None = Query(None, description="Cursor of the page to get, the first page if not given.")
     ):
-    client = request.app.httpxClient
-
-    # Lower case and strip song name to improve cache hit rate
-    song = song.lower().strip()
-    
-    # Calling function to get spotify access token for authorization
-    access_token = await get_spotify_access_token(client)
-
-    params = {
-        "q": song,
-        "type": "track",
-        # Limit the number of results to 20
-        "limit": 20
-    }
-    # Have to send auth header for API access with generated access token
-    headers = {"Authorization": f"Bearer {access_token}"}
-
-    # Making the API call to spotify
-    response = await client.get("https://api.spotify.com/v1/search", params=params, headers=headers)
-    # Check if the response is successful and send appropriate error if not
-    if response.status_code != 200:
-        raise HTTPException(status_code=500, detail="Error fetching from Spotify API")
-
-    return response.json()
+    direct = routed_to(request, search_for_songs)
+    page, responses = await spotify_search_page(request, "track", song, limit, cursor, direct)
+    return search_response(request if direct else None, {"tracks": page}, responses)
+
+# Makes a multi ID lookup against Spotify, e.g. /v1/tracks?ids=
+# Returns a dict of ID to item, IDs Spotify doesn't have are left out
+# Only one rate limiter slot is used for the whole batch
+def spotify_fetch_many(resource: str):
+    @SpotifyRateLimited
+    async def fetch_many(client: httpx.AsyncClient, ids: list[str]):
+        # Making the API call to spotify, handles the access token
+        response = await spotify_get(
+            client,
+            f"{SPOTIFY_API_URL}/{resource}",
+            params={"ids": ",".join(ids)}
+        )
+        # A single invalid ID fails the whole batch, so bisect the batch to find it
+        # rather than failing everyone else's request, which takes a few calls rather than one per ID
+        # A half which fails (e.g. refused by the rate limiter) only fails its own IDs
+        if response.status_code == 400 and len(ids) > 1:
+            halves = [ids[:len(ids) // 2], ids[len(ids) // 2:]]
+            results = await asyncio.gather(*(fetch_many(client, half) for half in halves), return_exceptions=True)
+            items = {}
+            for half, result in zip(halves, results):
+                items.update({id: result for id in half} if isinstance(result, Exception) else result)
+            return items
+        if response.status_code == 400:
+            return {}
+        # Check if the response is successful and send appropriate error if not
+        if response.status_code != 200:
+            raise HTTPException(status_code=500, detail=f"Error fetching {resource} from Spotify API")
+
+        return {item["id"]: item for item in response.json()[resource] if item}
+    return fetch_many
+
+# Spotify IDs are 22 base62 characters, anything else can't exist
+# so is answered as not found without being sent upstream in a batch
+SPOTIFY_ID = re.compile(r"[0-9A-Za-z]{22}")
+
+def is_spotify_id(id: str):
+    return SPOTIFY_ID.fullmatch(id) is not None
+
+# Concurrent single ID lookups are collected into one multi ID call
+# Batch sizes are the most IDs Spotify accepts for each endpoint
+spotifyArtistBatcher = MicroBatcher(spotify_fetch_many("artists"), 50)
+spotifyAlbumBatcher = MicroBatcher(spotify_fetch_many("albums"), 20)
+spotifyTrackBatcher = MicroBatcher(spotify_fetch_many("tracks"), 50)
 
 # Get artist details by ID using Spotify API
 @app.get("/spotify/artists/{artistID}")
-# Uses Spotify API so endpoint is rate limited
-@SpotifyRateLimited
-# Wrapper to check cache before adding to rate limiter or making API call
+# Wrapper to check cache first so cache hits never wait on the rate limiter
 # Kwargs acting as a safety net for any additional arguments which will not be used in cache key
 @checkRedisCache(
     lambda artistID, **kwargs: f"spotify:artist_details:{artistID}", 
@@ -125,27 +278,21 @@ async def get_artist_by_id(
     request: Request,
     artistID: str
     ):
-    client = request.app.httpxClient
-
-    # Calling function to get spotify access token for authorization
-    access_token = await get_spotify_access_token(client)
+    client = request.app.spotifyClient
 
-    # Have to send auth header for API access with generated access token
-    headers = {"Authorization": f"Bearer {access_token}"}
+    # Batched with other artist lookups, which handles rate limiting
+    artist = await spotifyArtistBatcher.load(client, artistID) if is_spotify_id(artistID) else None
+    if artist is None:
+        raise HTTPException(status_code=404, detail="Artist not found on Spotify")
 
-    # Making the API call to spotify
-    response = await client.get(f"https://api.spotify.com/v1/artists/{artistID}", headers=headers)
-    # Check if the response is successful and send appropriate error if not
-    if response.status_code != 200:
-        raise HTTPException(status_code=500, detail="Error fetching artist details from Spotify API")
-
-    return response.json()
+    # Only keep the fields the frontend uses before caching
+    result = projectArtist(artist)
+    autocompleteIndex.addArtists([result])
+    return result
 
 # Get album details by ID using Spotify API
 @app.get("/spotify/albums/{albumID}")
-# Uses Spotify API so endpoint is rate limited
-@SpotifyRateLimited
-# Wrapper to check cache before adding to rate limiter or making API call
+# Wrapper to check cache first so cache hits never wait on the rate limiter
 # Kwargs acting as a safety net for any additional arguments which will not be used in cache key
 @checkRedisCache(
     lambda albumID, **kwargs: f"spotify:album_details:{albumID}", 
@@ -155,27 +302,19 @@ async def get_album_by_id(
     request: Request,
     albumID: str
     ):
-    client = request.app.httpxClient
+    client = request.app.spotifyClient
 
-    # Calling function to get spotify access token for authorization
-    access_token = await get_spotify_access_token(client)
+    # Batched with other album lookups, which handles rate limiting
+    album = await spotifyAlbumBatcher.load(client, albumID) if is_spotify_id(albumID) else None
+    if album is None:
+        raise HTTPException(status_code=404, detail="Album not found on Spotify")
 
-    # Have to send auth header for API access with generated access token
-    headers = {"Authorization": f"Bearer {access_token}"}
-
-    # Making the API call to spotify
-    response = await client.get(f"https://api.spotify.com/v1/albums/{albumID}", headers=headers)
-    # Check if the response is successful and send appropriate error if not
-    if response.status_code != 200:
-        raise HTTPException(status_code=500, detail="Error fetching album details from Spotify API")
-
-    return response.json()
+    # Only keep the fields the frontend uses before caching
+    return projectAlbum(album)
 
 # Get song details by ID using Spotify API
 @app.get("/spotify/songs/{songID}")
-# Uses Spotify API so endpoint is rate limited
-@SpotifyRateLimited
-# Wrapper to check cache before adding to rate limiter or making API call
+# Wrapper to check cache first so cache hits never wait on the rate limiter
 # Kwargs acting as a safety net for any additional arguments which will not be used in cache key
 @checkRedisCache(
     lambda songID, **kwargs: f"spotify:song_details:{songID}", 
@@ -185,103 +324,137 @@ async def get_song_by_id(
     request: Request,
     songID: str
     ):
-    client = request.app.httpxClient
-
-    # Calling function to get spotify access token for authorization
-    access_token = await get_spotify_access_token(client)
-
-    # Have to send auth header for API access with generated access token
-    headers = {"Authorization": f"Bearer {access_token}"}
+    client = request.app.spotifyClient
+
+    # Batched with other song lookups, which handles rate limiting
+    song = await spotifyTrackBatcher.load(client, songID) if is_spotify_id(songID) else None
+    if song is None:
+        raise HTTPException(status_code=404, detail="Song not found on Spotify")
+
+    # Only keep the fields the frontend uses before caching
+    result = projectTrack(song)
+    autocompleteIndex.addTracks([result])
+    return result
+
+# Maximum IDs accepted by the batch endpoints
+MAX_BATCH_IDS = 50
+
+# Looks up several IDs through the single ID endpoint so each one is
+# cached under its own key, misses are batched into multi ID Spotify calls
+# Returns the JSON bytes for a list of the results in the same order as the IDs
+# and how long the whole list can be cached by clients (the shortest of the results)
+# IDs which aren't found are null, like Spotify's own multi ID endpoints
+async def batch_lookup(request: Request, ids: str, lookup, idParam: str):
+    idList = [id for id in ids.split(",") if id]
+    if not idList or len(idList) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=400, detail=f"Between 1 and {MAX_BATCH_IDS} IDs must be given")
+
+    # Returns the result's JSON bytes and Cache-Control
+    async def lookup_one(id):
+        try:
+            response = await lookup(request=request, **{idParam: id})
+            return response.body, response.headers.get("cache-control")
+        except HTTPException as error:
+            if error.status_code == 404:
+                return b"null", (error.headers or {}).get("Cache-Control")
+            raise
+
+    results = await asyncio.gather(*(lookup_one(id) for id in idList))
+    body = b"[" + b",".join(body for body, _ in results) + b"]"
+    return body, minMaxAge(cacheControlValue for _, cacheControlValue in results)
+
+# Response for a batch endpoint, with an ETag so unchanged batches get a 304
+def batch_response(request: Request, key: bytes, body: bytes, maxAge: int):
+    body = b'{"' + key + b'":' + body + b'}'
+    return conditionalResponse(request, body, computeETag(body), cacheControl(maxAge))
+
+# Get details of several artists at once by comma separated IDs
+@app.get("/spotify/artists")
+async def get_artists_by_ids(
+    request: Request,
+    ids: str = Query(..., description=f"Comma separated Spotify artist IDs, up to {MAX_BATCH_IDS}.")
+    ):
+    body, maxAge = await batch_lookup(request, ids, get_artist_by_id, "artistID")
+    return batch_response(request, b"artists", body, maxAge)
 
-    # Making the API call to spotify
-    response = await client.get(f"https://api.spotify.com/v1/tracks/{songID}", headers=headers)
-    # Check if the response is successful and send appropriate error if not
-    if response.status_code != 200:
-        raise HTTPException(status_code=500, detail="Error fetching song details from Spotify API")
+# Get details of several albums at once by comma separated IDs
+@app.get("/spotify/albums")
+async def get_albums_by_ids(
+    request: Request,
+    ids: str = Query(..., description=f"Comma separated Spotify album IDs, up to {MAX_BATCH_IDS}.")
+    ):
+    body, maxAge = await batch_lookup(request, ids, get_album_by_id, "albumID")
+    return batch_response(request, b"albums", body, maxAge)
 
-    return response.json()
+# Get details of several songs at once by comma separated IDs
+@app.get("/spotify/songs")
+async def get_songs_by_ids(
+    request: Request,
+    ids: str = Query(..., description=f"Comma separated Spotify track IDs, up to {MAX_BATCH_IDS}.")
+    ):
+    body, maxAge = await batch_lookup(request, ids, get_song_by_id, "songID")
+    return batch_response(request, b"tracks", body, maxAge)
 
 # Get top songs of an artist by ID using Spotify API
 @app.get("/spotify/artists/{artistID}/songs")
-# Uses Spotify API so endpoint is rate limited
-@SpotifyRateLimited
-# Wrapper to check cache before adding to rate limiter or making API call
+# Wrapper to check cache first so cache hits never wait on the rate limiter
 # Kwargs acting as a safety net for any additional arguments which will not be used in cache key
 @checkRedisCache(
     lambda artistID, **kwargs: f"spotify:artist_top_songs:{artistID}", 
-    expires=3600
+    expires=3600,
+    isEmpty=lambda result: not result["tracks"]
 )
+# Uses Spotify API so upstream calls are rate limited
+@SpotifyRateLimited
 async def get_artist_songs(
     request: Request,
     artistID: str):
-    client = request.app.httpxClient
+    client = request.app.spotifyClient
 
-    # Calling function to get spotify access token for authorization
-    access_token = await get_spotify_access_token(client)
-
-    # Have to send auth header for API access with generated access token
-    headers = {"Authorization": f"Bearer {access_token}"}
-
-    # Making the API call to spotify
-    response = await client.get(f"https://api.spotify.com/v1/artists/{artistID}/top-tracks?market=US", headers=headers)
+    # Making the API call to spotify, handles the access token
+    response = await spotify_get(client, f"{SPOTIFY_API_URL}/artists/{artistID}/top-tracks?market=US")
     # Check if the response is successful and send appropriate error if not
     if response.status_code != 200:
         raise HTTPException(status_code=500, detail="Error fetching from Spotify API")
 
-    return response.json()
+    # Only keep the fields the frontend uses before caching
+    result = projectTopTracks(response.json())
+    autocompleteIndex.addTracks(result["tracks"])
+    return result
 
 # Search for a song from a specific artist using Spotify API
+# Paged with cursors, pass the page's next as the cursor for the following page
 @app.get("/spotify/artists/{artistName}/search_songs")
-# Uses Spotify API so endpoint is rate limited
-@SpotifyRateLimited
-# Wrapper to check cache before adding to rate limiter or making API call
-# Kwargs acting as a safety net for any additional arguments which will not be used in cache key
-@checkRedisCache(
-    lambda artistName, song, **kwargs: f"spotify:artist_search_songs:{artistName}:{song.lower().strip()}", 
-    expires=3600
-)
-async def search_for_songs(
+async def search_for_artist_songs(
     request: Request,
     artistName: str,
-    song: str = Query(..., description="Song name to search with Spotify API.")
+    song: str = Query(..., description="Song name to search with Spotify API."),
+    limit: int = Query(10, ge=1, le=MAX_SEARCH_PAGE, description="Results per page."),
+    cursor: str | None = Query(None, description="Cursor of the page to get, the first page if not given.")
 ):
-    client = request.app.httpxClient
-    
-    # Lowercase and strip to improve effectiveness of caching
-    # Not used on artist name because wont be input by user
-    song = song.lower().strip()
-    # Calling function to get spotify access token for authorization
-    access_token = await get_spotify_access_token(client)
-
-    # Searching with song name filtered by artist ID
-    params = {
-        "q": f"artist:{artistName} track:{song}",
-        "type": "track",
-        # Limit the number of results to 20
-        "limit": 10
-    }
-    # Have to send auth header for API access with generated access token
-    headers = {"Authorization": f"Bearer {access_token}"}
-
-    # Making the API call to spotify
-    response = await client.get("https://api.spotify.com/v1/search", params=params, headers=headers)
-    # Check if the response is successful and send appropriate error if not
-    if response.status_code != 200:
-        raise HTTPException(status_code=500, detail="Error fetching from Spotify API")
-    
-    return response.json()
+    # Searching with song name filtered by artist name
+    query = f"artist:{artistName} track:{song}"
+    direct = routed_to(request, search_for_artist_songs)
+    page, responses = await spotify_search_page(request, "track", query, limit, cursor, direct)
+    return search_response(request if direct else None, {"tracks": page}, responses)
 
 @app.get("/youtube/get_video_tutorials/{search_query}")
-@YoutubeRateLimited
 @checkRedisCache(
         lambda search_query, **kwargs: f"youtube:get_video_tutorials:{search_query} Guitar Tutorial and Tabs",
-        expires=86400 # Cache for whole day, youtube very limited on API calls
+        expires=86400, # Cache for whole day, youtube very limited on API calls
+        # Every search costs 100 quota units even when nothing is found
+        # so no videos found is also cached for longer than other endpoints
+        negativeExpires=3600,
+        canonical=("search_query",),
+        isEmpty=lambda result: not result["items"]
 )
+# Uses Youtube API so upstream calls are rate limited
+@YoutubeRateLimited
 async def search_tutorial_videos(
         request: Request,
         search_query: str
 ):
-    client = request.app.httpxClient
+    client = request.app.youtubeClient
 
     # Adding Guitar Tutorial to the youtube search string
     # The original query will be the name of the song viewed by the user
@@ -290,18 +463,25 @@ async def search_tutorial_videos(
     # Creating the URL to call the Youtube API
     # Searches the query and limits the results to 5
     search_url = (
-        "https://www.googleapis.com/youtube/v3/search"
+        f"{YOUTUBE_API_URL}/search"
         f"?part=snippet"
         f"&q={query}"
         f"&type=video"
         f"&maxResults=8"
+        # Partial response, only the video IDs are needed from the search
+        f"&fields={YOUTUBE_SEARCH_FIELDS}"
         f"&key={YOUTUBE_API_KEY}"
     )
 
     # Making the call to search Youtube via the API
-    search_response = await client.get(search_url)
+    # Each search is charged against the daily quota, refused if it's being used up too fast
+    search_response = await requestWithRetry(
+        client, "GET", search_url, limiter=youtubeRateLimiter,
+        charge=lambda: youtubeQuota.charge("search.list")
+    )
 
     # Check if the response is successful
+    await check_youtube_quota_exceeded(search_response)
     if search_response.status_code != 200:
         raise HTTPException(status_code=500, detail="Error fetching search details from YouTube API")
     
@@ -321,45 +501,278 @@ async def search_tutorial_videos(
     video_ids_str = ",".join(video_ids)
     # Creating the URL to make the call which returns detailed video information
     videos_url = (
-        "https://www.googleapis.com/youtube/v3/videos"
-        f"?part=snippet,contentDetails,statistics"
+        f"{YOUTUBE_API_URL}/videos"
+        f"?part=snippet,statistics"
         f"&id={video_ids_str}"
+        # Partial response with only the fields the frontend uses
+        f"&fields={YOUTUBE_VIDEOS_FIELDS}"
         f"&key={YOUTUBE_API_KEY}"
     )
     # Making the API call for video details
-    response = await client.get(videos_url)
+    response = await requestWithRetry(
+        client, "GET", videos_url, limiter=youtubeRateLimiter,
+        charge=lambda: youtubeQuota.charge("videos.list")
+    )
     # Check if response was successful
+    await check_youtube_quota_exceeded(response)
     if response.status_code != 200:
         raise HTTPException(status_code=500, detail="Error fetching video details from YouTube API")
     
-    return response.json()
-
-# Get information from the search results from popular guitar tab websites
-@app.get("/google/search_tabs/")
-# Uses Google Custom Search API
-@GoogleSearchRateLimited
-# Wrapper to check cache before adding to rate limiter or making API call
+    # Fields mask already trims most of the response, projection removes the rest
+    return projectVideos(response.json())
+
+# YouTube answers 403 quotaExceeded once the project's quota is used up
+# (e.g. by calls the ledger didn't see), the ledger is then marked as used up
+# so calls are refused until the quota resets and stale values are served meanwhile
+async def check_youtube_quota_exceeded(response: httpx.Response):
+    if response.status_code == 403 and b"quotaExceeded" in response.content:
+        raise UpstreamUnavailable("youtube", await youtubeQuota.markExhausted())
+
+# One block of Google search results for tab websites, the unit tab search pages are cached in
+# Not routed, the tab search endpoint cuts its pages out of these blocks
 # Kwargs acting as a safety net for any additional arguments which will not be used in cache key
 @checkRedisCache(
-    lambda query, **kwargs: f"google:search_tabs:{query} tab", 
-    expires=3600
+    lambda query, block, **kwargs: f"google:search_tabs:{query} tab:{block}",
+    expires=3600,
+    canonical=("query",),
+    isEmpty=lambda result: not result["items"]
 )
-async def search_tab_websites(
+# Uses Google Custom Search API so upstream calls are rate limited
+@GoogleSearchRateLimited
+async def google_search_block(
     request: Request,
-    query: str):
-    client = request.app.httpxClient
+    query: str,
+    block: int):
+    client = request.app.googleClient
 
-    url = "https://www.googleapis.com/customsearch/v1/"
+    url = GOOGLE_SEARCH_API_URL
     params = {
         "q": f"{query} tab",
         "cx": f"{GOOGLE_CUSTOM_SEARCH_ID}",
-        "key": f"{GOOGLE_SEARCH_API_KEY}"
+        "key": f"{GOOGLE_SEARCH_API_KEY}",
+        # Google's start is 1 based
+        "start": block * GOOGLE_SEARCH_BLOCK + 1,
+        "num": GOOGLE_SEARCH_BLOCK,
+        # Partial response with only the fields the frontend uses
+        "fields": GOOGLE_SEARCH_FIELDS
     }
 
     # Making the API call to google search API
-    response = await client.get(url, params=params)
+    response = await requestWithRetry(client, "GET", url, limiter=googleSearchRateLimiter, params=params)
     # Check if the response is successful and send appropriate error if not
     if response.status_code != 200:
         raise HTTPException(status_code=500, detail="Error fetching search results")
 
-    return response.json()
+    # Fields mask already trims most of the response, projection removes the rest
+    return projectTabResults(response.json())
+
+# Get information from the search results from popular guitar tab websites
+# Paged with cursors, pass the page's next as the cursor for the following page
+@app.get("/google/search_tabs/")
+async def search_tab_websites(
+    request: Request,
+    query: str,
+    limit: int = Query(GOOGLE_SEARCH_BLOCK, ge=1, le=MAX_SEARCH_PAGE, description="Results per page."),
+    cursor: str | None = Query(None, description="Cursor of the page to get, the first page if not given.")
+    ):
+    direct = routed_to(request, search_tab_websites)
+    page, responses = await fetchPage(
+        lambda block: google_search_block(request=request, query=query, block=block),
+        decodeCursor(cursor), limit, GOOGLE_SEARCH_BLOCK, GOOGLE_SEARCH_MAX_RESULTS,
+        (lambda block: prefetch(google_search_block, googleSearchRateLimiter, request=request, query=query, block=block))
+        if direct else None
+    )
+    return search_response(request if direct else None, page, responses)
+
+# Runs one part of the song page, returning its JSON bytes and Cache-Control
+# Failures and timeouts are returned as an error for that part only
+# Not found is cached like any result, other errors shouldn't be cached by clients
+# The cached fetch keeps running after a timeout so the next load gets it from cache
+async def song_page_part(part):
+    try:
+        response = await asyncio.wait_for(part, timeout=SONG_PAGE_PART_TIMEOUT)
+        return response.body, response.headers.get("cache-control")
+    except HTTPException as error:
+        return encodeBody({"error": error.detail}), (error.headers or {}).get("Cache-Control")
+    except asyncio.TimeoutError:
+        return encodeBody({"error": "Timed out fetching results"}), None
+    except Exception:
+        return encodeBody({"error": "Error fetching results"}), None
+
+# Everything the song page needs in a single request
+# Gets the song then fetches the tutorials and tabs concurrently,
+# each part still goes through its own cache and rate limiter
+@app.get("/song_page/{songID}")
+async def get_song_page(
+    request: Request,
+    songID: str
+    ):
+    # The song is needed to search for tutorials and tabs so fails the whole page
+    songResponse = await get_song_by_id(request=request, songID=songID)
+    song = json.loads(songResponse.body)
+
+    # Same search the song page used to make for tutorials and tabs
+    searchQuery = f"{song['name']} {song['artists'][0]['name']}"
+    (tutorials, tutorialsCacheControl), (tabs, tabsCacheControl) = await asyncio.gather(
+        song_page_part(search_tutorial_videos(request=request, search_query=searchQuery)),
+        song_page_part(search_tab_websites(request=request, query=searchQuery, limit=GOOGLE_SEARCH_BLOCK, cursor=None)),
+    )
+
+    # Joining the already serialized parts rather than decoding and re-encoding them
+    body = b'{"song":' + songResponse.body + b',"tutorials":' + tutorials + b',"tabs":' + tabs + b'}'
+    # Page is only fresh while all of its parts are
+    maxAge = minMaxAge([songResponse.headers.get("cache-control"), tutorialsCacheControl, tabsCacheControl])
+    return conditionalResponse(request, body, computeETag(body), cacheControl(maxAge))
+
+# Autocomplete's own rate limiter per upstream limiter name, a share of the upstream's budget
+autocompleteBudgets = {}
+# noBudget: Spotify searches skipped as the search wasn't cached and Spotify was busy
+autocompleteStats = {"noBudget": 0}
+
+# Whether autocomplete may search Spotify for the query
+# Searches already cached or being fetched are free, others need spare budget
+async def autocomplete_may_search(kind: str, query: str):
+    cacheKey = spotify_search_block.cacheKey(kind=kind, query=query, block=0)
+    if cacheKey in inFlightFetches or await readEntryHeader(cacheKey) is not None:
+        return True
+    if await spareBudget(spotifyRateLimiter, autocompleteBudgets, "autocomplete", AUTOCOMPLETE_BUDGET_SHARE):
+        return True
+    autocompleteStats["noBudget"] += 1
+    return False
+
+# Suggestions for the search boxes while the user is typing
+# Answered from the local index of artists and tracks already seen from Spotify,
+# only searching Spotify when the index has too few results and Spotify has budget to spare
+# Spotify searches go through the cached search endpoints so repeat queries are cheap
+@app.get("/autocomplete")
+async def autocomplete(
+    request: Request,
+    # The frontend only asks once 2 characters are typed, single characters match too much of the index
+    q: str = Query(..., min_length=2, description="Start of an artist or song name."),
+    type: str = Query("all", pattern="^(all|artist|track)$", description="Whether to suggest artists, tracks or both."),
+    limit: int = Query(8, ge=1, le=20)
+    ):
+    kinds = ["artist", "track"] if type == "all" else [type]
+    results = {kind: autocompleteIndex.search(kind, q, limit) for kind in kinds}
+    source = "local"
+
+    short = [kind for kind in kinds if len(results[kind]) < AUTOCOMPLETE_MIN_RESULTS]
+    if short and len(q.strip()) >= AUTOCOMPLETE_UPSTREAM_MIN_LENGTH:
+        allowed = await asyncio.gather(*(autocomplete_may_search(kind, q) for kind in short), return_exceptions=True)
+        # Checks which failed (e.g. Redis is down) count as no budget, the local results are still returned
+        short = [kind for kind, ok in zip(short, allowed) if ok is True]
+    else:
+        short = []
+    if short:
+        searches = {
+            "artist": lambda: search_for_artist(request=request, artist=q, limit=SPOTIFY_SEARCH_BLOCK, cursor=None),
+            "track": lambda: search_for_songs(request=request, song=q, limit=SPOTIFY_SEARCH_BLOCK, cursor=None),
+        }
+        responses = await asyncio.gather(*(searches[kind]() for kind in short), return_exceptions=True)
+        for kind, response in zip(short, responses):
+            # Suggestions are best effort so a failed search just keeps the local results
+            if isinstance(response, Exception):
+                continue
+            # Results cached by another worker never passed through this worker's index
+            data = json.loads(response.body)
+            if kind == "artist":
+                autocompleteIndex.addArtists(data["artists"]["items"])
+            else:
+                autocompleteIndex.addTracks(data["tracks"]["items"])
+            results[kind] = autocompleteIndex.search(kind, q, limit)
+        source = "upstream"
+
+    body = {f"{kind}s": results[kind] for kind in kinds}
+    return Response(content=encodeBody(body), media_type="application/json", headers={"X-Cache-Source": source, "Cache-Control": cacheControl(AUTOCOMPLETE_MAX_AGE)})
+
+# Keep the most popular songs, artists' top tracks and tutorials warm
+# Tutorials make two YouTube calls (search then video details)
+cacheWarmer.register("spotify:song_details", get_song_by_id, spotifyRateLimiter)
+cacheWarmer.register("spotify:artist_top_songs", get_artist_songs, spotifyRateLimiter)
+cacheWarmer.register("youtube:get_video_tutorials", search_tutorial_videos, youtubeRateLimiter, cost=2)
+
+# After a Redis restart warms the song pages for the top tracks of the most
+# popular artists, as the pages users are most likely to open first
+# Runs once the artists' top tracks have been warmed so they come from the cache
+async def warm_song_pages(request: Request):
+    for kwargs in popularityTracker.top("spotify:artist_top_songs", WARM_SONG_PAGE_ARTISTS):
+        try:
+            response = await get_artist_songs(request=request, **kwargs)
+        except HTTPException:
+            continue
+        for track in json.loads(response.body)["tracks"][:WARM_SONG_PAGE_TRACKS]:
+            # Song page fetches the song, tutorials and tabs, all from cache if already warm
+            await cacheWarmer.spend(spotifyRateLimiter)
+            await cacheWarmer.spend(youtubeRateLimiter, 2)
+            await cacheWarmer.spend(googleSearchRateLimiter)
+            await get_song_page(request=request, songID=track["id"])
+
+cacheWarmer.addRestartHook(warm_song_pages)
+
+
+# Readiness probe for load balancers and orchestrators
+# Ready once the worker has warmed up and while it can reach Redis
+# Upstream outages don't make it unready, every worker would be affected alike
+# and stale cached results are still served
+@app.get("/ready")
+async def get_ready(request: Request):
+    ready = request.app.state.ready
+    redis = True
+    if ready:
+        try:
+            await asyncio.wait_for(redisClient.ping(), timeout=1)
+        except Exception:
+            redis = ready = False
+    body = {"ready": ready, "redis": redis, "warmup": request.app.state.warmup}
+    return Response(content=encodeBody(body), media_type="application/json", status_code=200 if ready else 503)
+
+# Prometheus metrics for request, upstream, cache and rate limiter latencies
+@app.get("/metrics")
+async def get_metrics():
+    content, contentType = renderMetrics()
+    return Response(content=content, media_type=contentType)
+
+# Shows how many cache misses made an upstream call vs shared another request's call
+# how many cached entries were refreshed in the background and in-process cache usage
+# Useful for seeing how much request coalescing saves under load
+@app.get("/cache/stats")
+async def get_cache_stats():
+    return {
+        "singleFlight": singleFlightStats,
+        "refresh": refreshStats,
+        "local": localCache.getStats(),
+        "prefetch": prefetchStats,
+    }
+
+# Shows queue depth, wait times, refused calls and circuit breaker state for each upstream's rate limiter
+@app.get("/rate_limiter/stats")
+async def get_rate_limiter_stats():
+    return {
+        "spotify": spotifyRateLimiter.stats(),
+        "youtube": youtubeRateLimiter.stats(),
+        "googleSearch": googleSearchRateLimiter.stats(),
+    }
+
+# Shows today's YouTube quota spend against its budget and how fast it's being spent
+@app.get("/youtube/quota")
+async def get_youtube_quota():
+    return await youtubeQuota.stats()
+
+# Shows how well single ID Spotify lookups are being batched together
+@app.get("/batcher/stats")
+async def get_batcher_stats():
+    return {
+        "artists": spotifyArtistBatcher.stats(),
+        "albums": spotifyAlbumBatcher.stats(),
+        "tracks": spotifyTrackBatcher.stats(),
+    }
+
+# Shows the size of the autocomplete index and how it is being used
+@app.get("/autocomplete/stats")
+async def get_autocomplete_stats():
+    return {**autocompleteIndex.stats(), **autocompleteStats}
+
+# Shows what the cache warmer has refreshed and the most popular keys
+@app.get("/cache/warmer/stats")
+async def get_cache_warmer_stats():
+    return cacheWarmer.stats()
@@ -4,4 +4,6 @@ import os
 # URL for the Redis database
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
 # Initialize Redis client
-redisClient = redis.from_url(REDIS_URL, decode_responses=True)
\ No newline at end of file
+redisClient = redis.from_url(REDIS_URL, decode_responses=True)
+# Client returning raw bytes, used for the binary cached API responses
+redisBinaryClient = redis.from_url(REDIS_URL)
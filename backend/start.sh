@@ -0,0 +1,24 @@
+#!/bin/sh
+# Production run mode: several uvicorn workers on uvloop and httptools
+# Workers default to WEB_CONCURRENCY, which the rate limiters also read to
+# split the budget if Redis is unavailable, so both always agree
+# Each worker warms up in the app lifespan before it is handed requests
+set -e
+
+# Workers write their metrics here so /metrics can combine them
+# Only set for the server started here, other processes importing the app
+# (e.g. benchmarks) keep their metrics in memory rather than needing the directory
+# Files left by a previous run would be counted again so start empty
+export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus}"
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
+# Access logs are left off as every request is already counted in /metrics
+exec uvicorn main:app \
+    --host 0.0.0.0 \
+    --port "${PORT:-8000}" \
+    --workers "${WEB_CONCURRENCY:-1}" \
+    --loop uvloop \
+    --http httptools \
+    --no-access-log \
+    --timeout-graceful-shutdown 10
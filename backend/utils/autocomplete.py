@@ -0,0 +1,251 @@
+# In-process prefix index of the artists and tracks already received from Spotify
+# Lets the search boxes suggest results while typing without a Spotify call per keystroke
+# Every word of a name is indexed, so "pupp" finds "Master of Puppets"
+# Entries are snapshotted to Redis so a restarted worker starts with a full index,
+# and workers pick up each other's entries when they load the snapshot
+import asyncio
+import json
+import logging
+import os
+import re
+from bisect import bisect_left, bisect_right, insort
+from heapq import nsmallest
+from itertools import islice
+from redis.exceptions import RedisError
+from redis_client import redisClient
+from utils.canonical import canonicalize
+
+logger = logging.getLogger(__name__)
+
+# Most artists and tracks kept in the index, new ones are ignored once full
+AUTOCOMPLETE_MAX_ENTRIES = int(os.getenv("AUTOCOMPLETE_MAX_ENTRIES", "100000"))
+# How often new entries are saved to the Redis snapshot (seconds)
+AUTOCOMPLETE_SNAPSHOT_INTERVAL = float(os.getenv("AUTOCOMPLETE_SNAPSHOT_INTERVAL", "60"))
+# Most indexed words looked at per query, short prefixes (e.g. "th") match a large share
+# of the index and scanning all of them would block the event loop
+# Only the first words in alphabetical order are used past this
+AUTOCOMPLETE_MAX_SCAN = int(os.getenv("AUTOCOMPLETE_MAX_SCAN", "2000"))
+# Snapshot is dropped if nothing is saved to it for this long (seconds)
+AUTOCOMPLETE_SNAPSHOT_TTL = 30 * 86400
+# Items per chunk of the sorted word list, chunks are split in two at twice this
+WORDS_CHUNK_SIZE = 512
+
+# Hash of kind:id to the entry as JSON
+SNAPSHOT_KEY = "autocomplete:entries"
+
+# Splits text into canonical words so "Beyonce" matches "Beyoncé"
+def tokenize(text: str):
+    return re.findall(r"\w+", canonicalize(text))
+
+# Sorted list kept as a list of sorted chunks
+# Inserting shifts one chunk rather than the whole list, which took ~10ms per
+# block of tracks once the index held a few 100k words
+class SortedChunks:
+    def __init__(self, items=()):
+        self.build(items)
+
+    # Replaces the contents with the already sorted items
+    def build(self, items):
+        items = list(items)
+        self.chunks = [items[i:i + WORDS_CHUNK_SIZE] for i in range(0, len(items), WORDS_CHUNK_SIZE)]
+        self.heads = [chunk[0] for chunk in self.chunks] # First item of each chunk
+        self.size = len(items)
+
+    def insert(self, item):
+        self.size += 1
+        if not self.chunks:
+            self.chunks.append([item])
+            self.heads.append(item)
+            return
+        i = max(bisect_right(self.heads, item) - 1, 0)
+        chunk = self.chunks[i]
+        insort(chunk, item)
+        self.heads[i] = chunk[0]
+        if len(chunk) >= 2 * WORDS_CHUNK_SIZE:
+            self.chunks[i:i + 1] = [chunk[:WORDS_CHUNK_SIZE], chunk[WORDS_CHUNK_SIZE:]]
+            self.heads[i:i + 1] = [chunk[0], chunk[WORDS_CHUNK_SIZE]]
+
+    # Items from low up to but not including high, in order, as slices of the chunks
+    def islices(self, low, high):
+        # The chunk before the first one starting at low may end with items equal to it
+        i = max(bisect_left(self.heads, low) - 1, 0)
+        for chunk in self.chunks[i:]:
+            end = bisect_left(chunk, high)
+            yield chunk[bisect_left(chunk, low):end]
+            if end < len(chunk):
+                return
+
+    def irange(self, low, high):
+        for items in self.islices(low, high):
+            yield from items
+
+    # Number of items from low up to high, counting stops once past most
+    def count(self, low, high, most):
+        total = 0
+        for items in self.islices(low, high):
+            total += len(items)
+            if total > most:
+                break
+        return total
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            yield from chunk
+
+class AutocompleteIndex:
+    def __init__(self, maxEntries=AUTOCOMPLETE_MAX_ENTRIES):
+        self.maxEntries = maxEntries
+        # (kind, id) to {"item", "tokens", "name", "seen"}
+        # item is the projected artist or track as returned by the search endpoints
+        # tokens are the words it is indexed by, name its own name's words
+        # seen counts how often it came back from Spotify, used to rank suggestions
+        self.entries = {}
+        # Sorted (word, (kind, id)) pairs, words starting with a prefix are a contiguous range
+        # Uses far less memory than storing every prefix of every word
+        self.words = SortedChunks()
+        self.unsaved = set() # Keys changed since the last snapshot
+
+        # Metrics
+        self.queries = 0
+        self.full = 0 # Entries not added as the index was full
+
+    # Adds an artist or track, or counts it as seen again if already indexed
+    # Tracks are also indexed by their artists' names
+    # New words are inserted in order, or appended to newWords if given for sorting in bulk
+    def add(self, kind: str, item, seen: int = 1, newWords=None):
+        id = item.get("id")
+        name = item.get("name")
+        if not id or not name:
+            return
+        key = (kind, id)
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry["item"] = item
+            entry["seen"] += seen
+            self.unsaved.add(key)
+            return
+        if len(self.entries) >= self.maxEntries:
+            self.full += 1
+            return
+
+        tokens = tokenize(name)
+        for artist in item.get("artists", []):
+            tokens += tokenize(artist.get("name") or "")
+        self.entries[key] = {"item": item, "tokens": tokens, "seen": seen, "name": " ".join(tokenize(name))}
+        for word in set(tokens):
+            if newWords is None:
+                self.words.insert((word, key))
+            else:
+                newWords.append((word, key))
+        self.unsaved.add(key)
+
+    def addArtists(self, artists):
+        for artist in artists:
+            self.add("artist", artist)
+
+    def addTracks(self, tracks):
+        for track in tracks:
+            self.add("track", track)
+
+    # Bounds of the (word, key) pairs for words starting with the prefix
+    def prefixRange(self, prefix: str):
+        return (prefix,), (prefix + "\U0010ffff",)
+
+    # Returns up to limit indexed items of the kind matching every word of the query
+    # Names starting with the query come first, then the most often seen
+    def search(self, kind: str, query: str, limit: int):
+        self.queries += 1
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+
+        # Candidates come from the query word with the fewest matches,
+        # the other words are checked against each candidate
+        counts = sorted((self.words.count(*self.prefixRange(token), AUTOCOMPLETE_MAX_SCAN), token) for token in tokens)
+        scanned = islice(self.words.irange(*self.prefixRange(counts[0][1])), AUTOCOMPLETE_MAX_SCAN)
+        candidates = {key for _, key in scanned if key[0] == kind}
+        # Every candidate already has a word starting with the rarest token
+        others = [token for _, token in counts[1:]]
+
+        phrase = " ".join(tokens)
+        matches = []
+        for key in candidates:
+            entry = self.entries[key]
+            if all(any(word.startswith(token) for word in entry["tokens"]) for token in others):
+                matches.append(entry)
+        best = nsmallest(
+            limit, matches,
+            key=lambda entry: (not entry["name"].startswith(phrase), -entry["seen"], len(entry["name"]))
+        )
+        return [entry["item"] for entry in best]
+
+    # Saves the entries changed since the last snapshot to Redis
+    async def saveSnapshot(self):
+        keys, self.unsaved = self.unsaved, set()
+        if not keys:
+            return
+        mapping = {}
+        for kind, id in keys:
+            entry = self.entries[(kind, id)]
+            mapping[f"{kind}:{id}"] = json.dumps({"item": entry["item"], "seen": entry["seen"]}, separators=(",", ":"))
+        try:
+            async with redisClient.pipeline(transaction=False) as pipe:
+                pipe.hset(SNAPSHOT_KEY, mapping=mapping)
+                pipe.expire(SNAPSHOT_KEY, AUTOCOMPLETE_SNAPSHOT_TTL)
+                await pipe.execute()
+        except (RedisError, OSError):
+            # Try again with the next snapshot
+            self.unsaved |= keys
+            raise
+
+    # Adds every entry in the Redis snapshot, including ones saved by other workers
+    async def loadSnapshot(self):
+        loaded = 0
+        scanned = 0
+        # Sorted into the index once at the end, inserting one at a time is quadratic
+        newWords = []
+        async for field, value in redisClient.hscan_iter(SNAPSHOT_KEY, count=1000):
+            scanned += 1
+            kind = field.partition(":")[0]
+            entry = json.loads(value)
+            key = (kind, entry["item"].get("id"))
+            # Entries this worker already has keep their own count
+            if key not in self.entries:
+                self.add(kind, entry["item"], entry["seen"], newWords)
+                self.unsaved.discard(key)
+                loaded += 1
+            # Yield now and then so a large snapshot doesn't block requests
+            if scanned % 1000 == 0:
+                await asyncio.sleep(0)
+        # No await between reading and replacing so words added meanwhile aren't lost
+        self.words.build(sorted(list(self.words) + newWords))
+        return loaded
+
+    # Loads the snapshot then periodically saves new entries to it
+    # Started once per worker in the app lifespan
+    async def keepSnapshotted(self):
+        try:
+            loaded = await self.loadSnapshot()
+            logger.info("Loaded %d autocomplete entries from snapshot", loaded)
+        except (RedisError, OSError) as error:
+            logger.warning("Failed to load autocomplete snapshot: %r", error)
+        while True:
+            await asyncio.sleep(AUTOCOMPLETE_SNAPSHOT_INTERVAL)
+            try:
+                await self.saveSnapshot()
+            except (RedisError, OSError) as error:
+                logger.warning("Failed to save autocomplete snapshot: %r", error)
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "words": len(self.words),
+            "unsaved": len(self.unsaved),
+            "queries": self.queries,
+            "full": self.full,
+        }
+
+autocompleteIndex = AutocompleteIndex()
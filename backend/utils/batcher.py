@@ -0,0 +1,81 @@
+# Collects single ID lookups made around the same time and sends them
+# upstream as one multi ID call, e.g. Spotify's /v1/tracks?ids=
+import asyncio
+import os
+
+# How long to wait for more IDs before sending a batch (seconds)
+BATCH_DELAY = float(os.getenv("BATCH_DELAY", "0.005"))
+
+class MicroBatcher:
+    def __init__(self, fetchMany, maxBatchSize, delay=BATCH_DELAY):
+        # Async function taking (client, ids) and returning a dict of id to item
+        # IDs missing from the dict are treated as not found, and an exception
+        # as the item fails only that ID's callers
+        self.fetchMany = fetchMany
+        self.maxBatchSize = maxBatchSize # Most IDs the upstream accepts in one call
+        self.delay = delay
+        self.pending = {} # IDs waiting for the next batch, mapped to their future
+        self.client = None # Client used to send the next batch
+        self.timer = None
+
+        # Metrics
+        self.batches = 0 # Upstream calls made
+        self.ids = 0 # IDs sent across all batches
+
+    # Returns the item for the ID, or None if the upstream doesn't have it
+    async def load(self, client, id: str):
+        future = self.pending.get(id)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.pending[id] = future
+            self.client = client
+
+            if len(self.pending) >= self.maxBatchSize:
+                # Batch is full so send it straight away
+                self.flush()
+            elif self.timer is None:
+                self.timer = asyncio.get_running_loop().call_later(self.delay, self.flush)
+
+        # Shielded so one cancelled caller doesn't cancel the result for others waiting on the ID
+        return await asyncio.shield(future)
+
+    # Takes the pending IDs as a batch and starts fetching them
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return
+
+        batch, self.pending = self.pending, {}
+        self.batches += 1
+        self.ids += len(batch)
+        asyncio.ensure_future(self.send(self.client, batch))
+
+    async def send(self, client, batch):
+        try:
+            items = await self.fetchMany(client, list(batch))
+        except Exception as error:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(error)
+                    # Marking the exception as retrieved in case every caller was cancelled
+                    future.exception()
+            return
+
+        for id, future in batch.items():
+            if future.done():
+                continue
+            item = items.get(id)
+            if isinstance(item, Exception):
+                future.set_exception(item)
+                future.exception()
+            else:
+                future.set_result(item)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "ids": self.ids,
+            "averageBatchSize": self.ids / self.batches if self.batches else 0.0,
+        }
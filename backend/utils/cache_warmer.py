@@ -0,0 +1,155 @@
+# Refreshes the most popular cached keys before they expire so users
+# requesting them never wait on the upstream APIs
+# Popularity comes from the requests counted by utils/popularity.py
+# Warming uses only a share of each upstream's rate budget so it never
+# crowds out user requests
+import asyncio
+import logging
+import math
+import os
+import time
+from fastapi import Request
+from redis.exceptions import RedisError
+from redis_client import redisClient
+from utils.popularity import popularityTracker, warmingRequests
+from utils.rate_limiter import RateLimiter, budgetShare
+from utils.redis_cache import WORKER_ID, readEntryHeader, startFetch
+
+logger = logging.getLogger(__name__)
+
+# How often popularity counts are sent to Redis (seconds)
+POPULARITY_FLUSH_INTERVAL = float(os.getenv("POPULARITY_FLUSH_INTERVAL", "10"))
+# How often the most popular keys are checked and warmed (seconds)
+WARM_INTERVAL = float(os.getenv("CACHE_WARM_INTERVAL", "60"))
+# Most popular keys per prefix kept warm
+WARM_TOP_N = int(os.getenv("CACHE_WARM_TOP_N", "50"))
+# Keys are refreshed once their soft expiry is this close (seconds)
+# Needs to be longer than the warm interval so keys are caught before expiring
+WARM_AHEAD = float(os.getenv("CACHE_WARM_AHEAD", "300"))
+# Share of each upstream's rate limit the warmer may use
+WARM_BUDGET_SHARE = float(os.getenv("CACHE_WARM_BUDGET_SHARE", "0.2"))
+
+# Held by the worker warming this interval, expires by itself so another worker takes over
+WARM_LOCK_KEY = "lock:cache_warmer"
+
+class Warmable:
+    def __init__(self, endpoint, limiter, cost):
+        self.endpoint = endpoint # Endpoint wrapped by checkRedisCache
+        self.limiter = limiter # Rate limiter of the upstream the endpoint calls
+        self.cost = cost # Upstream calls made by each fetch
+
+class CacheWarmer:
+    def __init__(self):
+        self.warmables = {} # Registered endpoints by cache key prefix
+        self.budgets = {} # Warmer's own rate limiter per upstream limiter name
+        self.restartHooks = [] # Called after Redis restarts, once the popular keys are warm
+        self.warming = None # Warm currently in progress in this worker
+
+        # Metrics
+        self.runs = 0 # Warm cycles started by this worker
+        self.checked = 0 # Keys whose expiry was checked
+        self.warmed = 0 # Keys refreshed
+        self.failures = 0 # Refreshes which failed
+        self.lastRun = None # Time the last warm cycle finished
+
+    # Starts tracking the endpoint's popularity and keeping its most popular keys warm
+    # prefix is the first two segments of the endpoint's cache keys
+    def register(self, prefix: str, endpoint, limiter: RateLimiter, cost: int = 1):
+        endpoint.popularityPrefix = prefix
+        self.warmables[prefix] = Warmable(endpoint, limiter, cost)
+
+    # Adds a function called with a request after Redis restarts and the
+    # popular keys have been warmed again, for warming that depends on them
+    def addRestartHook(self, hook):
+        self.restartHooks.append(hook)
+
+    # Waits for the warmer's share of the upstream's rate budget
+    async def spend(self, limiter: RateLimiter, cost: int = 1):
+        # Warming has no deadline so always waits its turn
+        budget = budgetShare(self.budgets, "warmer", limiter, WARM_BUDGET_SHARE, maxWait=math.inf)
+        for _ in range(cost):
+            await budget.acquire()
+
+    # Refreshes the key for these endpoint arguments if it is missing or about to expire
+    # Negative (not found or empty) entries are left to expire as upstream didn't have them
+    async def warmKey(self, warmable: Warmable, request: Request, kwargs):
+        endpoint = warmable.endpoint
+        kwargs = {**kwargs, "request": request}
+        cacheKey = endpoint.cacheKey(**kwargs)
+        self.checked += 1
+        header = await readEntryHeader(cacheKey)
+        if header is not None and (header["negative"] or header["softExpiry"] - time.time() > WARM_AHEAD):
+            return
+
+        await self.spend(warmable.limiter, warmable.cost)
+        try:
+            # Fetches with the uncached function, as a refresh so it's skipped
+            # if another worker is already fetching the key
+            fetch, _ = startFetch(cacheKey, endpoint, (), kwargs, refreshing=True)
+            if await fetch is not None:
+                self.warmed += 1
+        except Exception as error:
+            self.failures += 1
+            logger.info("Failed to warm %s: %r", cacheKey, error)
+
+    # Warms the most popular keys of every registered endpoint
+    # Each endpoint is warmed in turn, endpoints run concurrently
+    async def warmAll(self, request: Request, restarted=False):
+        async def warmPrefix(prefix, warmable):
+            for kwargs in popularityTracker.top(prefix, WARM_TOP_N):
+                await self.warmKey(warmable, request, kwargs)
+
+        self.runs += 1
+        await asyncio.gather(*(warmPrefix(prefix, warmable) for prefix, warmable in self.warmables.items()))
+        if restarted:
+            for hook in self.restartHooks:
+                try:
+                    await hook(request)
+                except Exception as error:
+                    logger.warning("Cache warmer restart hook failed: %r", error)
+        self.lastRun = time.time()
+
+    # Starts a warm unless one is still running in this worker
+    # Warms after a Redis restart always start as the cache is now empty
+    def startWarm(self, request: Request, restarted=False):
+        if not restarted and self.warming is not None and not self.warming.done():
+            return
+        self.warming = asyncio.create_task(self.warmAll(request, restarted))
+
+    # Sends popularity counts to Redis and warms popular keys, started once
+    # per worker in the app lifespan
+    # Every worker sends its counts, only one worker per interval decays and warms
+    async def run(self, app):
+        # Endpoints only use the request to get the app's upstream clients
+        request = Request({"type": "http", "app": app, "headers": [], "query_string": b""})
+        # Requests made while warming aren't counted towards popularity
+        warmingRequests.set(True)
+        lastWarm = time.monotonic()
+        prefixes = list(self.warmables)
+        while True:
+            await asyncio.sleep(POPULARITY_FLUSH_INTERVAL)
+            try:
+                if await popularityTracker.flush(prefixes, WARM_TOP_N):
+                    # Redis restarted so the cache is empty, warm straight away
+                    self.startWarm(request, restarted=True)
+                elif time.monotonic() - lastWarm >= WARM_INTERVAL:
+                    lastWarm = time.monotonic()
+                    if await redisClient.set(WARM_LOCK_KEY, WORKER_ID, nx=True, px=int(WARM_INTERVAL * 1000)):
+                        await popularityTracker.decay(prefixes, WARM_INTERVAL)
+                        self.startWarm(request)
+            except (RedisError, OSError) as error:
+                logger.warning("Cache warmer failed: %r", error)
+
+    def stats(self):
+        return {
+            "runs": self.runs,
+            "checked": self.checked,
+            "warmed": self.warmed,
+            "failures": self.failures,
+            "lastRun": self.lastRun,
+            "warming": self.warming is not None and not self.warming.done(),
+            "budgets": {name: budget.stats() for name, budget in self.budgets.items()},
+            "popularity": popularityTracker.stats(),
+        }
+
+cacheWarmer = CacheWarmer()
@@ -0,0 +1,18 @@
+# Canonical form of free text used in cache keys and upstream searches
+# so variants of the same query share one cache entry
+# e.g. " Beyoncé ", "BEYONCE" and "ｂｅｙｏｎｃｅ" are all "beyonce"
+import re
+import unicodedata
+
+# Accents and other marks on Latin, Greek and Cyrillic letters
+# Marks in other scripts (e.g. Japanese dakuten) change the letter so are kept
+DIACRITICS = re.compile("[\u0300-\u036f]")
+
+def canonicalize(text: str):
+    # NFKD splits accented letters into letter + mark and folds
+    # compatibility characters such as full width letters
+    text = DIACRITICS.sub("", unicodedata.normalize("NFKD", text))
+    # Recompose what is left (e.g. Hangul) so upstream searches get normal text
+    text = unicodedata.normalize("NFC", text).casefold()
+    # Collapse runs of whitespace and trim
+    return " ".join(text.split())
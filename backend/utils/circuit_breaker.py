@@ -0,0 +1,113 @@
+# Circuit breaker for each upstream API
+# When an upstream keeps failing or responding slowly, calls to it are refused
+# straight away for a while instead of each waiting out its timeouts
+# After that a single probe call is let through, closing the circuit again if it succeeds
+# State is per worker, each worker sees enough of the traffic to notice an outage
+import math
+import os
+import time
+from fastapi import HTTPException
+from utils.metrics import circuitBreakerState
+
+# Consecutive failed or slow calls before the circuit opens
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+# Calls taking at least this long count as failures (seconds)
+CIRCUIT_SLOW_CALL = float(os.getenv("CIRCUIT_SLOW_CALL", "3"))
+# How long the circuit stays open before a probe call is let through (seconds)
+# Also how long a probe may take before another one is allowed
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+# Values of the circuit_breaker_state metric
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# Raised when a call to an upstream is refused rather than made
+# e.g. its circuit is open or too many calls are already queued for it
+# Sent to the client as a 503 telling it when to try again
+class UpstreamUnavailable(HTTPException):
+    def __init__(self, upstream: str, retryAfter: float):
+        super().__init__(
+            status_code=503,
+            detail=f"{upstream} is temporarily unavailable, try again later",
+            headers={"Retry-After": str(max(1, math.ceil(retryAfter)))},
+        )
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name,
+        failureThreshold=CIRCUIT_FAILURE_THRESHOLD,
+        slowCall=CIRCUIT_SLOW_CALL,
+        resetTimeout=CIRCUIT_RESET_TIMEOUT
+    ):
+        self.name = name
+        self.failureThreshold = failureThreshold
+        self.slowCall = slowCall
+        self.resetTimeout = resetTimeout
+        self.state = CLOSED
+        self.failures = 0 # Consecutive failed or slow calls
+        self.openedAt = 0.0
+        self.probeStartedAt = 0.0 # When the current half open probe was let through
+
+        # Metrics
+        self.opened = 0 # Times the circuit opened
+        self.rejected = 0 # Calls refused while open
+        circuitBreakerState.labels(name).set(STATE_VALUES[CLOSED])
+
+    def setState(self, state: str):
+        self.state = state
+        circuitBreakerState.labels(self.name).set(STATE_VALUES[state])
+
+    # Seconds until a call may be let through, 0 if one may be now
+    # Doesn't change any state so can be checked before queueing for a call
+    def retryAfter(self):
+        now = time.monotonic()
+        if self.state == OPEN:
+            return max(0.0, self.openedAt + self.resetTimeout - now)
+        if self.state == HALF_OPEN:
+            return max(0.0, self.probeStartedAt + self.resetTimeout - now)
+        return 0.0
+
+    # Raises UpstreamUnavailable if calls are currently being refused
+    def check(self):
+        retryAfter = self.retryAfter()
+        if retryAfter > 0:
+            self.rejected += 1
+            raise UpstreamUnavailable(self.name, retryAfter)
+
+    # Called right before making a call, refusing it if the circuit is open
+    # Once the reset timeout has passed the call is let through as the probe,
+    # other calls are refused until the probe finishes or takes too long
+    def beforeCall(self):
+        self.check()
+        if self.state != CLOSED:
+            self.setState(HALF_OPEN)
+            self.probeStartedAt = time.monotonic()
+
+    # Records how long a successful call took, slow calls count as failures
+    def recordSuccess(self, elapsed: float):
+        if elapsed >= self.slowCall:
+            self.recordFailure()
+            return
+        self.failures = 0
+        if self.state != CLOSED:
+            self.setState(CLOSED)
+
+    def recordFailure(self):
+        self.failures += 1
+        # A failed probe opens the circuit again straight away
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failureThreshold):
+            self.opened += 1
+            self.openedAt = time.monotonic()
+            self.setState(OPEN)
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "consecutiveFailures": self.failures,
+            "opened": self.opened,
+            "rejected": self.rejected,
+            "retryAfter": self.retryAfter(),
+        }
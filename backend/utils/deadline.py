@@ -0,0 +1,51 @@
+# Deadline for the current request, shared by the cache, rate limiters and upstream calls
+# Past the deadline the result is no longer useful to the user, so rather than
+# queueing for a rate limiter token or waiting on a slow upstream the request
+# fails fast, or is served a stale cached value if there is one
+import os
+import time
+from contextvars import ContextVar
+from fastapi import HTTPException
+
+# Time a request has before it is given up on (seconds)
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "8"))
+
+# time.monotonic() the current request must finish by
+# None outside of a request (e.g. background refreshes and the cache warmer) so there's no limit
+requestDeadline: ContextVar[float | None] = ContextVar("requestDeadline", default=None)
+
+# Raised when there isn't enough time left to finish the request
+class DeadlineExceeded(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=504, detail="Timed out waiting for upstream")
+
+# Seconds left before the current request's deadline, None if it has none
+def deadlineRemaining():
+    deadline = requestDeadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+# Raises DeadlineExceeded if the current request's deadline has passed
+def checkDeadline():
+    remaining = deadlineRemaining()
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceeded()
+
+# ASGI middleware giving each request a deadline of REQUEST_DEADLINE seconds
+# Tasks started while handling the request (e.g. cache fetches) inherit it
+class DeadlineMiddleware:
+    def __init__(self, app, deadline: float = REQUEST_DEADLINE):
+        self.app = app
+        self.deadline = deadline
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        token = requestDeadline.set(time.monotonic() + self.deadline)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            requestDeadline.reset(token)
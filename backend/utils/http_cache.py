@@ -0,0 +1,94 @@
+# HTTP caching headers so browsers, proxies and CDNs can reuse responses
+# Cache-Control is derived from how long the value stays fresh in our cache,
+# and ETags let clients revalidate with If-None-Match and get a body-less 304
+import hashlib
+import re
+from fastapi import Request, Response
+from starlette.datastructures import Headers, MutableHeaders
+
+# ETag of a response body, strong so it's only equal for identical bytes
+def computeETag(body: bytes):
+    return '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+
+# ETag of the deflate encoded representation of the same body
+# Each encoding needs its own strong ETag
+def encodedETag(etag: str, encoding: str):
+    return etag[:-1] + "-" + encoding + '"'
+
+# Response may be reused for maxAge seconds, then served while revalidating for staleFor
+# Values aren't specific to a user so shared caches may store them too
+def cacheControl(maxAge: float, staleFor: float = 0):
+    value = f"public, max-age={max(0, int(maxAge))}"
+    if staleFor > 0:
+        value += f", stale-while-revalidate={int(staleFor)}"
+    return value
+
+# Smallest max-age of the given Cache-Control values, for responses built from
+# several cached parts, parts without a max-age (e.g. errors) count as 0
+def minMaxAge(values):
+    maxAges = []
+    for value in values:
+        match = re.search(r"max-age=(\d+)", value or "")
+        maxAges.append(int(match.group(1)) if match else 0)
+    return min(maxAges, default=0)
+
+# Whether the client already has the representation with one of these ETags
+def notModified(request: Request, *etags: str):
+    ifNoneMatch = request.headers.get("if-none-match")
+    if not ifNoneMatch:
+        return False
+    if ifNoneMatch.strip() == "*":
+        return True
+    # Weak comparison, as If-None-Match allows, so W/ tags added by proxies still match
+    tags = {tag.strip().removeprefix("W/") for tag in ifNoneMatch.split(",")}
+    # Clients holding the gzip compressed representation send its tag, see GZipETagMiddleware
+    # It's only the current representation while the client still accepts gzip
+    gzip = acceptsEncoding(request, "gzip")
+    return any(etag in tags or (gzip and encodedETag(etag, "gzip") in tags) for etag in etags)
+
+# Whether the client accepts the encoding, ignoring q values other than q=0
+def acceptsEncoding(request: Request, encoding: str):
+    for part in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = part.strip().partition(";")
+        if name.strip().lower() == encoding:
+            return params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+# JSON response with ETag and Cache-Control, or a 304 if the client has it already
+# If request is None (e.g. a call from another endpoint) no 304 is sent
+def conditionalResponse(request: Request | None, body: bytes, etag: str, cacheControlValue: str, headers=None):
+    headers = {"ETag": etag, "Cache-Control": cacheControlValue, **(headers or {})}
+    if request is not None and notModified(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# ASGI middleware giving responses compressed by GZipMiddleware their own strong ETag
+# GZipMiddleware keeps the ETag of the uncompressed body, so without this the
+# identity and gzip representations would share one strong validator
+# Must be added after GZipMiddleware so it sees the compressed response
+# A 304 answering the gzip tag is sent with that tag, as it's the one the client has
+class GZipETagMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        ifNoneMatch = Headers(scope=scope).get("if-none-match", "")
+        gzip = acceptsEncoding(Request(scope), "gzip")
+
+        async def sendWithETag(message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                etag = headers.get("etag")
+                if etag is not None and not etag.startswith("W/"):
+                    gzipETag = encodedETag(etag, "gzip")
+                    if headers.get("content-encoding") == "gzip":
+                        headers["etag"] = gzipETag
+                    elif message["status"] == 304 and gzip and gzipETag in ifNoneMatch:
+                        headers["etag"] = gzipETag
+            await send(message)
+
+        await self.app(scope, receive, sendWithETag)
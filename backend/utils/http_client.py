@@ -0,0 +1,138 @@
+# HTTP clients for the upstream APIs and retrying of transient failures
+import asyncio
+import email.utils
+import logging
+import os
+import random
+import time
+import httpx
+from fastapi import HTTPException
+from utils.deadline import checkDeadline, deadlineRemaining
+from utils.metrics import recordTiming, upstreamLatency
+
+logger = logging.getLogger(__name__)
+
+# Statuses worth retrying, anything else is returned straight to the caller
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Retries after the first attempt
+MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "2"))
+# Backoff before the first retry (seconds), doubled for each retry after
+RETRY_BASE_DELAY = 0.2
+# Longest backoff between retries (seconds)
+RETRY_MAX_DELAY = 2.0
+# Longest Retry-After that is waited on, anything longer is returned as a failure
+# rather than keeping the user waiting
+MAX_RETRY_AFTER = float(os.getenv("UPSTREAM_MAX_RETRY_AFTER", "5"))
+# Least time worth retrying with before the request's deadline (seconds)
+RETRY_MIN_TIME = 0.5
+
+# Creates a client for a single upstream
+# Separate clients stop one slow upstream using up another's connections
+# Keep-alive connections are reused across requests to avoid repeated TLS handshakes
+def createUpstreamClient(maxConnections: int, maxKeepalive: int, http2: bool = True):
+    return httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=maxConnections,
+            max_keepalive_connections=maxKeepalive,
+            keepalive_expiry=60,
+        ),
+        # Per phase timeouts instead of one 10 second timeout for everything
+        # pool is how long to wait for a free connection from the pool
+        timeout=httpx.Timeout(connect=3.0, read=8.0, write=5.0, pool=2.0),
+    )
+
+# Parses a Retry-After header, either seconds or an HTTP date
+# Returns None if missing or invalid
+def parseRetryAfter(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+# Whether there is still time for a retry after waiting delay seconds
+# Leaves at least RETRY_MIN_TIME for the call itself
+def retryFitsDeadline(delay: float):
+    remaining = deadlineRemaining()
+    return remaining is None or remaining - delay >= RETRY_MIN_TIME
+
+# Exponential backoff with full jitter so retries from many requests spread out
+def backoffDelay(attempt: int):
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+# Makes a request, retrying transient failures with jittered backoff
+# A 429's Retry-After is honoured and passed to the upstream's rate limiter
+# so every worker holds off, and each retry takes a new rate limiter token
+# Calls go through the limiter's circuit breaker, refused with UpstreamUnavailable while it's open
+# No call or retry is started once the request's deadline has passed or won't leave
+# time for it, but a call already made isn't cut short so its result is still cached
+# charge is an optional async function called before every attempt, e.g. to charge
+# the call against a quota, raising to stop the call being made
+# Returns the last response, raises a 504 if the last attempt timed out or a 502 if it
+# failed to connect or read the response, so the caller can serve stale or a clean error
+async def requestWithRetry(client: httpx.AsyncClient, method: str, url: str, limiter=None, charge=None, **kwargs):
+    # Upstream name for metrics, the limiter's name or otherwise the host
+    upstream = limiter.name if limiter is not None else httpx.URL(url).host
+    breaker = limiter.breaker if limiter is not None else None
+    for attempt in range(MAX_RETRIES + 1):
+        lastAttempt = attempt == MAX_RETRIES
+        paused = False
+        checkDeadline()
+        # Checked before charging so calls refused by the breaker cost nothing
+        if breaker is not None:
+            breaker.check()
+        if charge is not None:
+            await charge()
+        if breaker is not None:
+            breaker.beforeCall()
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.TransportError as error:
+            upstreamLatency.labels(upstream, "error").observe(time.perf_counter() - start)
+            # Connection failures and timeouts
+            if breaker is not None:
+                breaker.recordFailure()
+            delay = backoffDelay(attempt)
+            if lastAttempt or not retryFitsDeadline(delay):
+                if isinstance(error, httpx.TimeoutException):
+                    raise HTTPException(status_code=504, detail=f"Timed out calling {upstream}") from error
+                raise HTTPException(status_code=502, detail=f"Error calling {upstream}") from error
+            logger.info("Retrying %s in %.2fs after %r", url, delay, error)
+        else:
+            elapsed = time.perf_counter() - start
+            upstreamLatency.labels(upstream, str(response.status_code)).observe(elapsed)
+            recordTiming(upstream, elapsed)
+            if breaker is not None:
+                # 429s are the upstream working as intended, the limiter handles them
+                if response.status_code >= 500:
+                    breaker.recordFailure()
+                else:
+                    breaker.recordSuccess(elapsed)
+            if response.status_code not in RETRY_STATUSES or lastAttempt:
+                return response
+
+            delay = parseRetryAfter(response.headers.get("Retry-After"))
+            if response.status_code == 429 and limiter is not None:
+                # Slow down everyone using this upstream, not just this request
+                await limiter.pause(delay if delay is not None else RETRY_MAX_DELAY)
+                paused = True
+            if delay is not None and delay > MAX_RETRY_AFTER:
+                return response
+            if delay is None:
+                delay = backoffDelay(attempt)
+            if not retryFitsDeadline(delay):
+                return response
+            logger.info("Retrying %s in %.2fs after status %s", url, delay, response.status_code)
+
+        # A paused limiter already makes the next token wait out the Retry-After
+        if not paused:
+            await asyncio.sleep(delay)
+        if limiter is not None:
+            await limiter.acquire()
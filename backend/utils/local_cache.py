@@ -0,0 +1,70 @@
+# In-process LRU cache sitting in front of Redis
+# Saves a Redis round trip and JSON decode for hot keys
+import time
+from collections import OrderedDict, defaultdict
+
+# Groups keys by their first two segments for stats
+# e.g. spotify:search_artists:metallica -> spotify:search_artists
+def keyPrefix(key: str):
+    return ":".join(key.split(":")[:2])
+
+class LocalCache:
+    def __init__(self, maxBytes=64 * 1024 * 1024):
+        self.maxBytes = maxBytes # Approximate memory budget based on cached payload sizes
+        self.usedBytes = 0
+        # Ordered so the least recently used entry is always first
+        # Values are (entry, size, expiresAt)
+        self.entries = OrderedDict()
+        self.stats = defaultdict(lambda: {"hits": 0, "misses": 0, "evictions": 0})
+
+    # Returns the cached entry or None if missing or expired
+    def get(self, key: str):
+        cached = self.entries.get(key)
+        if cached is None:
+            self.stats[keyPrefix(key)]["misses"] += 1
+            return None
+
+        entry, size, expiresAt = cached
+        # Never serve past the point Redis would have expired the key
+        if time.monotonic() >= expiresAt:
+            self.remove(key)
+            self.stats[keyPrefix(key)]["misses"] += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.stats[keyPrefix(key)]["hits"] += 1
+        return entry
+
+    # Stores an entry for ttl seconds, size is used for the memory budget
+    def set(self, key: str, entry, size: int, ttl: float):
+        # Larger than the whole cache so not worth keeping
+        if ttl <= 0 or size > self.maxBytes:
+            self.remove(key)
+            return
+
+        self.remove(key)
+        self.entries[key] = (entry, size, time.monotonic() + ttl)
+        self.usedBytes += size
+
+        # Evict least recently used entries until back under budget
+        while self.usedBytes > self.maxBytes:
+            evictedKey, (_, evictedSize, _) = self.entries.popitem(last=False)
+            self.usedBytes -= evictedSize
+            self.stats[keyPrefix(evictedKey)]["evictions"] += 1
+
+    def remove(self, key: str):
+        cached = self.entries.pop(key, None)
+        if cached is not None:
+            self.usedBytes -= cached[1]
+
+    def clear(self):
+        self.entries.clear()
+        self.usedBytes = 0
+
+    def getStats(self):
+        return {
+            "entries": len(self.entries),
+            "usedBytes": self.usedBytes,
+            "maxBytes": self.maxBytes,
+            "prefixes": dict(self.stats),
+        }
@@ -0,0 +1,115 @@
+# Prometheus metrics and Server-Timing header for the hot paths
+# Recording a metric is a lock and an increment so it is cheap enough to leave on
+# With multiple workers set PROMETHEUS_MULTIPROC_DIR so /metrics combines every worker (start.sh does)
+import os
+import time
+from contextvars import ContextVar
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+)
+
+# Buckets suited to both sub-millisecond cache hits and multi-second upstream calls
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+requestLatency = Histogram(
+    "http_request_duration_seconds",
+    "Time to handle a request, by route",
+    ["route", "method", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+upstreamLatency = Histogram(
+    "upstream_request_duration_seconds",
+    "Time for each call to an upstream API, by upstream and status",
+    ["upstream", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+cacheRequests = Counter(
+    "cache_requests_total",
+    "Cache lookups by key prefix and result (local_hit, redis_hit, miss, coalesced, stale, early, negative, stale_if_error)",
+    ["prefix", "result"],
+)
+cacheLatency = Histogram(
+    "cache_lookup_duration_seconds",
+    "Time to look up a key in the local cache and Redis",
+    buckets=LATENCY_BUCKETS,
+)
+rateLimiterWait = Histogram(
+    "rate_limiter_wait_seconds",
+    "Time spent waiting for a rate limiter token, by limiter",
+    ["limiter"],
+    buckets=LATENCY_BUCKETS,
+)
+rateLimiterQueue = Gauge(
+    "rate_limiter_queue_depth",
+    "Calls currently waiting for a rate limiter token",
+    ["limiter"],
+    multiprocess_mode="livesum",
+)
+upstreamRejections = Counter(
+    "upstream_rejections_total",
+    "Upstream calls refused rather than made, by limiter and reason (circuit_open, queue_full, too_slow)",
+    ["limiter", "reason"],
+)
+circuitBreakerState = Gauge(
+    "circuit_breaker_state",
+    "State of each upstream's circuit breaker (0 closed, 1 half open, 2 open)",
+    ["upstream"],
+    multiprocess_mode="max",
+)
+tokenRefreshes = Counter(
+    "spotify_token_refreshes_total",
+    "Spotify access tokens requested from Spotify",
+)
+
+# Timings recorded while handling the current request, sent as the Server-Timing header
+# None outside of a request (e.g. background refreshes) so nothing is recorded
+requestTimings: ContextVar[dict | None] = ContextVar("requestTimings", default=None)
+
+# Adds to the time spent on a step of the current request
+def recordTiming(name: str, seconds: float):
+    timings = requestTimings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+# ASGI middleware timing each request and adding the Server-Timing header
+# Plain ASGI rather than BaseHTTPMiddleware to keep the per request overhead low
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        timings = {}
+        token = requestTimings.set(timings)
+        status = 500
+
+        async def sendWithTiming(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                timings["total"] = time.perf_counter() - start
+                header = ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
+                message["headers"] = list(message.get("headers", [])) + [(b"server-timing", header.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, sendWithTiming)
+        finally:
+            requestTimings.reset(token)
+            # Route template rather than the path so IDs don't create new label values
+            route = scope.get("route")
+            requestLatency.labels(
+                getattr(route, "path", "unmatched"), scope["method"], str(status)
+            ).observe(time.perf_counter() - start)
+
+# Renders every metric in the Prometheus text format
+def renderMetrics():
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
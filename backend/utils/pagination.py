@@ -0,0 +1,137 @@
+# Cursor pagination for the search endpoints
+# Upstream searches are fetched and cached in fixed size blocks of results,
+# pages of any size and offset are cut from the blocks they overlap, so a
+# query paged 10 at a time and the same query paged 20 at a time share entries
+# Cursors are opaque to clients, they pass the previous page's next back unchanged
+# Once a page is served the blocks of the next page are prefetched in the
+# background, so "load more" comes from the cache, using only a share of
+# the upstream's rate budget and only while no user calls are queued for it
+import asyncio
+import base64
+import binascii
+import json
+import logging
+import os
+from fastapi import HTTPException
+from utils.circuit_breaker import UpstreamUnavailable
+from utils.rate_limiter import RateLimiter, budgetShare
+from utils.redis_cache import inFlightFetches, logRefreshFailure, readEntryHeader, startFetch
+
+logger = logging.getLogger(__name__)
+
+# Set to 0 to stop prefetching next pages
+PAGE_PREFETCH = os.getenv("PAGE_PREFETCH", "1") != "0"
+# Share of each upstream's rate limit prefetching may use
+PREFETCH_BUDGET_SHARE = float(os.getenv("PREFETCH_BUDGET_SHARE", "0.2"))
+
+# Prefetches running in this worker, referenced so they aren't garbage collected
+prefetchTasks = set()
+# Metrics
+# started: blocks fetched ahead, cached: blocks already cached or being fetched,
+# noBudget: skipped as the upstream was busy, failed: checks which errored
+prefetchStats = {"started": 0, "cached": 0, "noBudget": 0, "failed": 0}
+# Prefetching's own rate limiter per upstream limiter name
+prefetchBudgets = {}
+
+def encodeCursor(offset: int):
+    return base64.urlsafe_b64encode(json.dumps({"offset": offset}).encode()).decode().rstrip("=")
+
+# Offset of the page the cursor points to, 0 for the first page
+def decodeCursor(cursor: str | None):
+    if not cursor:
+        return 0
+    try:
+        offset = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))["offset"]
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    # JSON true and false are ints to Python too
+    if not isinstance(offset, int) or isinstance(offset, bool) or offset < 0:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return offset
+
+# Blocks holding the results from offset up to offset + limit
+def blockRange(offset: int, limit: int, blockSize: int):
+    if limit <= 0:
+        return range(0)
+    return range(offset // blockSize, (offset + limit - 1) // blockSize + 1)
+
+# Takes a token from prefetching's share of the upstream's budget if one is free right now
+# Never waits, and leaves the budget to users while any of their calls are queued
+# Other optional work (e.g. autocomplete) passes its own budgets, prefix and share
+async def spareBudget(limiter: RateLimiter, budgets=prefetchBudgets, prefix="prefetch", share=PREFETCH_BUDGET_SHARE):
+    if limiter.waiting or (limiter.breaker is not None and limiter.breaker.retryAfter() > 0):
+        return False
+    budget = budgetShare(budgets, prefix, limiter, share, maxWait=0)
+    try:
+        await budget.acquire()
+    except UpstreamUnavailable:
+        return False
+    return True
+
+# Fills the endpoint's cache entry for the arguments in the background, unless it's
+# already cached or being fetched, or the upstream has no budget to spare
+# endpoint is a checkRedisCache wrapper, limiter the rate limiter of the upstream it calls
+# Runs as a refresh so it has no deadline, is skipped if another worker is already
+# fetching the key and is charged as background work (e.g. against the YouTube quota)
+async def prefetch(endpoint, limiter: RateLimiter, **kwargs):
+    try:
+        kwargs = endpoint.canonicalArgs(kwargs)
+        cacheKey = endpoint.cacheKey(**kwargs)
+        if cacheKey in inFlightFetches or await readEntryHeader(cacheKey) is not None:
+            prefetchStats["cached"] += 1
+            return
+        if not await spareBudget(limiter):
+            prefetchStats["noBudget"] += 1
+            return
+    except Exception as error:
+        prefetchStats["failed"] += 1
+        logger.warning("Prefetch check failed: %r", error)
+        return
+    fetch, started = startFetch(cacheKey, endpoint, (), kwargs, refreshing=True)
+    if started:
+        prefetchStats["started"] += 1
+        fetch.add_done_callback(logRefreshFailure)
+
+def startPrefetch(coroutine):
+    task = asyncio.create_task(coroutine)
+    prefetchTasks.add(task)
+    task.add_done_callback(prefetchTasks.discard)
+
+# Builds the page of limit results from offset out of the cached blocks
+# fetchBlock(block) returns the cached response of that block, whose body has
+# the block's items and, if the upstream gives it, the total number of results
+# prefetchBlock(block) returns a coroutine prefetching the block, None disables prefetching
+# maxResults is the furthest the upstream pages (e.g. Google stops at 100 results)
+# Returns the page, with next set to the cursor of the following page or None
+# if this is the last, and the cached responses of the blocks it was cut from
+async def fetchPage(fetchBlock, offset: int, limit: int, blockSize: int, maxResults: int, prefetchBlock=None):
+    blocks = blockRange(offset, min(limit, maxResults - offset), blockSize)
+    responses = await asyncio.gather(*(fetchBlock(block) for block in blocks))
+
+    items = []
+    total = None
+    end = maxResults
+    for block, response in zip(blocks, responses):
+        data = json.loads(response.body)
+        items += data["items"]
+        if data.get("total") is not None:
+            total = data["total"]
+            end = min(end, total)
+        # A short block is the last one the upstream has
+        if len(data["items"]) < blockSize:
+            end = min(end, block * blockSize + len(data["items"]))
+            break
+
+    start = offset - blocks.start * blockSize if blocks else 0
+    page = {"items": items[start:start + limit], "offset": offset, "limit": limit}
+    if total is not None:
+        page["total"] = total
+    nextOffset = offset + limit
+    page["next"] = encodeCursor(nextOffset) if nextOffset < end else None
+
+    if page["next"] is not None and prefetchBlock is not None and PAGE_PREFETCH:
+        for block in blockRange(nextOffset, min(limit, end - nextOffset), blockSize):
+            # Blocks this page was cut from are already cached
+            if block not in blocks:
+                startPrefetch(prefetchBlock(block))
+    return page, responses
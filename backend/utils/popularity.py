@@ -0,0 +1,117 @@
+# Tracks how often cached keys are requested so the most popular ones
+# can be refreshed before they expire (see cache_warmer.py)
+# Counts are kept in a sorted set per cache key prefix, with the arguments
+# of the endpoint call as the member so the warmer can repeat the call
+# Scores are decayed periodically so popularity follows recent traffic
+import json
+import logging
+import os
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+from redis_client import redisClient
+
+logger = logging.getLogger(__name__)
+
+# Time for a key's popularity to halve if it stops being requested (seconds)
+POPULARITY_HALF_LIFE = float(os.getenv("POPULARITY_HALF_LIFE", str(6 * 3600)))
+# Most keys kept per prefix, the least popular are dropped when decaying
+POPULARITY_MAX_TRACKED = int(os.getenv("POPULARITY_MAX_TRACKED", "1000"))
+
+# Set once the sorted sets exist in Redis, a missing marker means Redis
+# was restarted (or flushed) and the sets need restoring from a worker's snapshot
+POPULARITY_MARKER_KEY = "popularity:marker"
+
+# True while the cache warmer is making requests, so warming a key
+# doesn't count as it being requested
+warmingRequests: ContextVar[bool] = ContextVar("warmingRequests", default=False)
+
+# The arguments of an endpoint call as a sorted set member
+# The request is left out as it is different for every call
+def encodeMember(kwargs):
+    return json.dumps(
+        {name: value for name, value in kwargs.items() if name != "request"},
+        sort_keys=True, separators=(",", ":")
+    )
+
+def decodeMember(member: str):
+    return json.loads(member)
+
+class PopularityTracker:
+    def __init__(self):
+        # Requests counted since the last flush, per prefix
+        # Counted locally so tracking never adds a Redis call to a request
+        self.pending = defaultdict(Counter)
+        # Most popular members per prefix as of the last flush, as (member, score)
+        # Kept in memory so the sets can be restored after a Redis restart
+        self.snapshot = {}
+
+        # Metrics
+        self.tracked = 0 # Requests counted
+        self.flushes = 0 # Times the counts were sent to Redis
+        self.restores = 0 # Times the sets were restored after a Redis restart
+
+    def key(self, prefix: str):
+        return f"popularity:{prefix}"
+
+    # Counts a request for the endpoint call with these arguments
+    def track(self, prefix: str, kwargs):
+        if warmingRequests.get():
+            return
+        self.pending[prefix][encodeMember(kwargs)] += 1
+        self.tracked += 1
+
+    # Sends the counts to Redis and updates the snapshot of the top members
+    # Returns True if Redis had been restarted and this worker restored the sets
+    async def flush(self, prefixes, topN: int):
+        pending, self.pending = self.pending, defaultdict(Counter)
+
+        # Only one worker sets the marker again, so only one restores the sets
+        restored = False
+        if await redisClient.set(POPULARITY_MARKER_KEY, 1, nx=True):
+            restored = any(self.snapshot.values())
+            if restored:
+                self.restores += 1
+                logger.info("Restoring key popularity after Redis restart")
+
+        async with redisClient.pipeline(transaction=False) as pipe:
+            if restored:
+                for prefix, members in self.snapshot.items():
+                    if members:
+                        pipe.zadd(self.key(prefix), dict(members), gt=True)
+            for prefix, counts in pending.items():
+                for member, count in counts.items():
+                    pipe.zincrby(self.key(prefix), count, member)
+            for prefix in prefixes:
+                pipe.zrevrange(self.key(prefix), 0, topN - 1, withscores=True)
+            results = await pipe.execute()
+
+        for prefix, members in zip(prefixes, results[len(results) - len(prefixes):]):
+            self.snapshot[prefix] = members
+        self.flushes += 1
+        return restored
+
+    # Most popular endpoint arguments for the prefix, as of the last flush
+    def top(self, prefix: str, count: int):
+        return [decodeMember(member) for member, _ in self.snapshot.get(prefix, [])[:count]]
+
+    # Scales every score down by the decay for the time elapsed
+    # and drops the least popular members beyond the maximum tracked
+    # Only one worker should decay per period (see CacheWarmer)
+    async def decay(self, prefixes, elapsed: float):
+        factor = 0.5 ** (elapsed / POPULARITY_HALF_LIFE)
+        async with redisClient.pipeline(transaction=False) as pipe:
+            for prefix in prefixes:
+                key = self.key(prefix)
+                pipe.zunionstore(key, {key: factor})
+                pipe.zremrangebyrank(key, 0, -POPULARITY_MAX_TRACKED - 1)
+            await pipe.execute()
+
+    def stats(self):
+        return {
+            "tracked": self.tracked,
+            "flushes": self.flushes,
+            "restores": self.restores,
+            "top": {prefix: members[:10] for prefix, members in self.snapshot.items()},
+        }
+
+popularityTracker = PopularityTracker()
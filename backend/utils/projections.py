@@ -0,0 +1,129 @@
+# Projections trimming upstream API responses down to the fields the frontend renders
+# Applied before caching so Redis, the network and the browser only deal with what is used
+# If the frontend starts using a new field it has to be added here as well
+
+# Only the first (largest) image is ever displayed
+def projectImages(images):
+    return (images or [])[:1]
+
+def projectArtistSummary(artist):
+    return {
+        "id": artist.get("id"),
+        "name": artist.get("name"),
+    }
+
+def projectArtist(artist):
+    return {
+        "id": artist.get("id"),
+        "name": artist.get("name"),
+        "images": projectImages(artist.get("images")),
+        "genres": artist.get("genres", []),
+        "followers": {"total": (artist.get("followers") or {}).get("total")},
+        "external_urls": {"spotify": (artist.get("external_urls") or {}).get("spotify")},
+    }
+
+def projectAlbumSummary(album):
+    return {
+        "id": album.get("id"),
+        "name": album.get("name"),
+        "images": projectImages(album.get("images")),
+    }
+
+# Tracks as listed on an album page, the album itself is already known
+def projectAlbumTrack(track):
+    return {
+        "id": track.get("id"),
+        "name": track.get("name"),
+        "track_number": track.get("track_number"),
+        "duration_ms": track.get("duration_ms"),
+    }
+
+def projectAlbum(album):
+    tracks = album.get("tracks") or {}
+    return {
+        "id": album.get("id"),
+        "name": album.get("name"),
+        "images": projectImages(album.get("images")),
+        "artists": [projectArtistSummary(artist) for artist in album.get("artists", [])],
+        "release_date": album.get("release_date"),
+        "total_tracks": album.get("total_tracks"),
+        "external_urls": {"spotify": (album.get("external_urls") or {}).get("spotify")},
+        "tracks": {
+            "items": [projectAlbumTrack(track) for track in tracks.get("items", [])],
+            "total": tracks.get("total"),
+        },
+    }
+
+def projectTrack(track):
+    return {
+        "id": track.get("id"),
+        "name": track.get("name"),
+        "duration_ms": track.get("duration_ms"),
+        "album": projectAlbumSummary(track.get("album") or {}),
+        "artists": [projectArtistSummary(artist) for artist in track.get("artists", [])],
+        "external_urls": {"spotify": (track.get("external_urls") or {}).get("spotify")},
+    }
+
+# Spotify search results are paged objects, only the items and paging totals are kept
+def projectPage(page, projectItem):
+    page = page or {}
+    return {
+        "items": [projectItem(item) for item in page.get("items", []) if item],
+        "total": page.get("total"),
+        "offset": page.get("offset"),
+        "limit": page.get("limit"),
+    }
+
+def projectArtistSearch(data):
+    return {"artists": projectPage(data.get("artists"), projectArtist)}
+
+def projectTrackSearch(data):
+    return {"tracks": projectPage(data.get("tracks"), projectTrack)}
+
+def projectTopTracks(data):
+    return {"tracks": [projectTrack(track) for track in data.get("tracks", [])]}
+
+# YouTube and Google support partial responses through the fields parameter,
+# these are the field masks sent with each request
+YOUTUBE_SEARCH_FIELDS = "items(id(videoId))"
+YOUTUBE_VIDEOS_FIELDS = "items(id,snippet(title,channelTitle),statistics(viewCount,likeCount))"
+GOOGLE_SEARCH_FIELDS = "items(title,link,snippet,displayLink,pagemap(cse_image,metatags))"
+
+def projectVideo(video):
+    snippet = video.get("snippet") or {}
+    statistics = video.get("statistics") or {}
+    return {
+        "id": video.get("id"),
+        "snippet": {
+            "title": snippet.get("title"),
+            "channelTitle": snippet.get("channelTitle"),
+        },
+        "statistics": {
+            "viewCount": statistics.get("viewCount"),
+            "likeCount": statistics.get("likeCount"),
+        },
+    }
+
+def projectVideos(data):
+    return {"items": [projectVideo(video) for video in data.get("items", [])]}
+
+# Metatags hold every meta tag on the page, only the icons are used
+def projectTabResult(result):
+    pagemap = result.get("pagemap") or {}
+    metatags = (pagemap.get("metatags") or [{}])[0]
+    cseImage = (pagemap.get("cse_image") or [{}])[0]
+    return {
+        "title": result.get("title"),
+        "link": result.get("link"),
+        "snippet": result.get("snippet"),
+        "displayLink": result.get("displayLink"),
+        "pagemap": {
+            "cse_image": [{"src": cseImage.get("src")}] if cseImage.get("src") else [],
+            "metatags": [{
+                key: metatags[key] for key in ("og:image", "favicon") if key in metatags
+            }],
+        },
+    }
+
+def projectTabResults(data):
+    return {"items": [projectTabResult(result) for result in data.get("items", [])]}
@@ -1,46 +1,267 @@
 # Class for rate limiting API calls
 import asyncio
+import logging
+import os
 import time
 from functools import wraps
-from collections import deque
+from redis.exceptions import RedisError
+from redis_client import redisClient
+from utils.circuit_breaker import CircuitBreaker, UpstreamUnavailable
+from utils.deadline import deadlineRemaining
+from utils.metrics import rateLimiterQueue, rateLimiterWait, recordTiming, upstreamRejections
+
+logger = logging.getLogger(__name__)
+
+# Number of workers sharing the rate limit, used to split the budget
+# between workers if Redis is unavailable and the local fallback is used
+# WEB_CONCURRENCY is also what uvicorn uses as its default worker count
+WORKER_COUNT = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+# Most calls waiting for a token in each worker, further calls are refused with a 503
+# rather than piling up while an upstream is slow
+RATE_LIMIT_MAX_QUEUE = int(os.getenv("RATE_LIMIT_MAX_QUEUE", "100"))
+# Calls which would wait longer than this for a token are refused (seconds)
+# Calls are also refused if the wait would take them past their request's deadline
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "5"))
+
+# Token bucket shared by every worker and replica, run atomically in Redis
+# Each call reserves a token immediately, letting the bucket go negative,
+# and is told how long to wait until its token becomes available
+# This keeps callers in FIFO order without anyone holding a lock while waiting
+# Redis server time is used so workers with skewed clocks share one timeline
+# KEYS[1] bucket key, ARGV[1] tokens added per second, ARGV[2] bucket capacity
+# Returns the wait in seconds as a string (Lua numbers are truncated to integers)
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+
+tokens = math.min(capacity, tokens + (now - updated) * rate) - 1
+redis.call("HSET", KEYS[1], "tokens", tokens, "updated", now)
+-- Bucket is idle and full again once this time has passed, so let it expire
+redis.call("PEXPIRE", KEYS[1], math.ceil((capacity - tokens) / rate * 1000) + 1000)
+
+if tokens >= 0 then
+    return "0"
+end
+return tostring(-tokens / rate)
+"""
+tokenBucketScript = redisClient.register_script(TOKEN_BUCKET_SCRIPT)
+
+# Empties the bucket into debt so no token is available for the given number of seconds
+# Used when the upstream asks us to back off (e.g. 429 with Retry-After)
+# KEYS[1] bucket key, ARGV[1] tokens added per second, ARGV[2] bucket capacity, ARGV[3] seconds
+PAUSE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local seconds = tonumber(ARGV[3])
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+
+tokens = math.min(capacity, tokens + (now - updated) * rate, -seconds * rate)
+redis.call("HSET", KEYS[1], "tokens", tokens, "updated", now)
+redis.call("PEXPIRE", KEYS[1], math.ceil((capacity - tokens) / rate * 1000) + 1000)
+return "0"
+"""
+pauseScript = redisClient.register_script(PAUSE_SCRIPT)
+
+# Gives back a reserved token which won't be used, e.g. the call was refused
+# KEYS[1] bucket key, ARGV[1] bucket capacity
+REFUND_SCRIPT = """
+local tokens = tonumber(redis.call("HGET", KEYS[1], "tokens"))
+if tokens then
+    redis.call("HSET", KEYS[1], "tokens", math.min(tonumber(ARGV[1]), tokens + 1))
+end
+return "0"
+"""
+refundScript = redisClient.register_script(REFUND_SCRIPT)
 
 class RateLimiter:
-    def __init__(self, maxCalls=10, period=1.0):
+    def __init__(self, name, maxCalls=10, period=1.0, maxQueue=RATE_LIMIT_MAX_QUEUE, maxWait=RATE_LIMIT_MAX_WAIT, breaker=None, countRejections=True):
+        self.name = name # Used for the Redis key so all workers share the bucket
         self.maxCalls = maxCalls  # Maximum number of calls allowed in the period
         self.period = period # Time period for tracking the max calls
-        self.lock = asyncio.Lock() # Lock to ensure rate limiter is accessed by one coroutine at a time
-        # Allows efficient appending and popping of call times compared to a list
-        self.calls = deque()
+        self.rate = maxCalls / period # Tokens added to the bucket per second
+        self.key = f"rate_limiter:{name}"
+        self.maxQueue = maxQueue # Most calls waiting for a token in this worker
+        self.maxWait = maxWait # Longest a call may wait for a token
+        # Circuit breaker of the upstream, calls are refused before queueing while it's open
+        self.breaker = breaker
+        # Whether refused calls count towards the upstream rejection metrics
+        self.countRejections = countRejections
+
+        # Local bucket used only if Redis is unavailable
+        # Gets this worker's share of the budget
+        self.localRate = self.rate / WORKER_COUNT
+        self.localCapacity = max(1.0, maxCalls / WORKER_COUNT)
+        self.localTokens = self.localCapacity
+        self.localUpdated = time.monotonic()
+        # Whether the last call fell back to the local bucket, so switching is only logged once
+        self.usingLocal = False
+
+        # Metrics
+        self.waiting = 0 # Calls currently waiting for a token (queue depth)
+        self.acquired = 0 # Total calls let through
+        self.delayed = 0 # Calls which had to wait for a token
+        self.totalWaitTime = 0.0 # Total seconds spent waiting for tokens
+        self.maxWaitTime = 0.0 # Longest single wait for a token
+        self.fallbacks = 0 # Calls which used the local bucket as Redis was unavailable
+        self.pauses = 0 # Times the upstream asked us to back off
+        self.rejected = {"circuit_open": 0, "queue_full": 0, "too_slow": 0} # Calls refused, by reason
 
+    # Adds the tokens earned since the local bucket was last updated
+    def refillLocal(self):
+        now = time.monotonic()
+        self.localTokens = min(
+            self.localCapacity,
+            self.localTokens + (now - self.localUpdated) * self.localRate
+        )
+        self.localUpdated = now
+
+    # Reserves a token from the local bucket, returning the wait in seconds
+    # Doesn't await so is atomic within the event loop
+    def reserveLocal(self):
+        self.refillLocal()
+        self.localTokens -= 1
+        if self.localTokens >= 0:
+            return 0.0
+        return -self.localTokens / self.localRate
+
+    # Reserves a token from the shared Redis bucket
+    # Returns the wait in seconds and whether the local bucket was used instead
+    async def reserve(self):
+        try:
+            wait = await tokenBucketScript(keys=[self.key], args=[self.rate, self.maxCalls])
+        except (RedisError, OSError) as error:
+            # Keep serving requests under this worker's share of the budget
+            self.fallbacks += 1
+            if not self.usingLocal:
+                self.usingLocal = True
+                logger.warning("Rate limiter %s falling back to local bucket: %r", self.name, error)
+            return self.reserveLocal(), True
+        if self.usingLocal:
+            self.usingLocal = False
+            logger.info("Rate limiter %s back on the shared Redis bucket", self.name)
+        return float(wait), False
+
+    # Gives back a reserved token to the bucket it came from
+    async def refund(self, local: bool):
+        if local:
+            self.refillLocal()
+            self.localTokens = min(self.localCapacity, self.localTokens + 1)
+            return
+        try:
+            await refundScript(keys=[self.key], args=[self.maxCalls])
+        except (RedisError, OSError):
+            pass
+
+    # Counts a refused call and returns the error to raise for it
+    def rejection(self, reason: str, retryAfter: float):
+        if self.countRejections:
+            self.rejected[reason] += 1
+            upstreamRejections.labels(self.name, reason).inc()
+        return UpstreamUnavailable(self.name, retryAfter)
+
+    # Stops tokens being handed out for the given number of seconds across all workers
+    async def pause(self, seconds: float):
+        self.pauses += 1
+        try:
+            await pauseScript(keys=[self.key], args=[self.rate, self.maxCalls, seconds])
+        except (RedisError, OSError):
+            pass
+        # Local bucket is paused too in case it is being used as the fallback
+        self.refillLocal()
+        self.localTokens = min(self.localTokens, -seconds * self.localRate)
+
+    # Waits for a token, or raises UpstreamUnavailable if the call shouldn't be made:
+    # the upstream's circuit is open, too many calls are already waiting in this worker,
+    # or the wait would be longer than maxWait or run past the request's deadline
     async def acquire(self):
-        # Using lock to ensure it is only accessed by one coroutine at a time
-        async with self.lock:
-            # Get the current time
-            now = time.monotonic()
-
-            # Remove calls older than the current second
-            while self.calls and self.calls[0] <= now - self.period:
-                self.calls.popleft()
-            
-            # If more than the max number of calls in current second
-            if len(self.calls) >= self.maxCalls:
-                # Wait until the oldest call is outside the period
-                # Since this means a new call can be made after sleep time passes
-                sleepTime = self.calls[0] + self.period - now
-                await asyncio.sleep(sleepTime)
-                # Get new current time after sleep time
-                now = time.monotonic()
-            
-            # Append the current call time to the list either immediately or after sleep time
-            self.calls.append(time.monotonic())
+        if self.breaker is not None and self.breaker.retryAfter() > 0:
+            self.breaker.rejected += 1
+            raise self.rejection("circuit_open", self.breaker.retryAfter())
+        if self.waiting >= self.maxQueue:
+            raise self.rejection("queue_full", self.waiting / self.rate)
+
+        waitTime, local = await self.reserve()
+        maxWait = self.maxWait
+        remaining = deadlineRemaining()
+        if remaining is not None:
+            maxWait = min(maxWait, remaining)
+        if waitTime > maxWait:
+            # Token won't be used so let another call have it
+            await self.refund(local)
+            raise self.rejection("too_slow", waitTime)
+
+        self.acquired += 1
+        rateLimiterWait.labels(self.name).observe(max(0.0, waitTime))
+        if waitTime <= 0:
+            return
+        recordTiming("ratelimit", waitTime)
+
+        # Token is already reserved so just sleep until it is usable
+        # No lock is held so other callers can reserve their own tokens meanwhile
+        self.delayed += 1
+        self.totalWaitTime += waitTime
+        self.maxWaitTime = max(self.maxWaitTime, waitTime)
+        self.waiting += 1
+        rateLimiterQueue.labels(self.name).inc()
+        try:
+            await asyncio.sleep(waitTime)
+        finally:
+            self.waiting -= 1
+            rateLimiterQueue.labels(self.name).dec()
+
+    def stats(self):
+        return {
+            "maxCalls": self.maxCalls,
+            "period": self.period,
+            "queueDepth": self.waiting,
+            "acquired": self.acquired,
+            "delayed": self.delayed,
+            "averageWaitTime": self.totalWaitTime / self.delayed if self.delayed else 0.0,
+            "maxWaitTime": self.maxWaitTime,
+            "localFallbacks": self.fallbacks,
+            "pauses": self.pauses,
+            "rejected": self.rejected,
+            "circuitBreaker": self.breaker.stats() if self.breaker is not None else None,
+        }
 
 # Making instance of RateLimiter to be used across all spotify endpoints
-spotifyRateLimiter = RateLimiter(8, 1.0)  # 8 calls per second
+# Budgets can be tuned per upstream with environment variables
+# Each upstream has a circuit breaker so calls fail fast while it is down
+spotifyRateLimiter = RateLimiter("spotify", int(os.getenv("SPOTIFY_RATE_LIMIT", "8")), 1.0, breaker=CircuitBreaker("spotify"))  # 8 calls per second
 # Making instance of RateLimiter to be used across all youtube endpoints
 # Youtube doesn't limit on time but will help prevent spam
-youtubeRateLimiter = RateLimiter(10, 1.0) # 10 calls per second
+youtubeRateLimiter = RateLimiter("youtube", int(os.getenv("YOUTUBE_RATE_LIMIT", "10")), 1.0, breaker=CircuitBreaker("youtube")) # 10 calls per second
 # Google search rate limit
-googleSearchRateLimiter = RateLimiter(10,1.0) # 10 calls per second
+googleSearchRateLimiter = RateLimiter("google_search", int(os.getenv("GOOGLE_SEARCH_RATE_LIMIT", "10")), 1.0, breaker=CircuitBreaker("google_search")) # 10 calls per second
+
+# Rate limiter for a share of the limiter's budget, created once and kept in budgets by the limiter's name
+# Background work (cache warming, page prefetching) takes a token from its share before
+# calling the upstream, so it never uses more than that share of the upstream's budget
+# Tokens are still taken from the upstream's own limiter when the call is made
+# Refusals are routine for these so aren't counted as upstream rejections
+def budgetShare(budgets: dict, prefix: str, limiter: RateLimiter, share: float, maxWait: float):
+    budget = budgets.get(limiter.name)
+    if budget is None:
+        budget = RateLimiter(
+            f"{prefix}:{limiter.name}",
+            max(1, int(limiter.maxCalls * share)),
+            limiter.period,
+            maxWait=maxWait,
+            countRejections=False
+        )
+        budgets[limiter.name] = budget
+    return budget
 
 # Rate limiting decorator function to limit the number of API calls per second
 # Will track API calls across all endpoints
@@ -70,4 +291,4 @@ def GoogleSearchRateLimited(func):
         # Call the acquire method of RateLimiter
         await googleSearchRateLimiter.acquire()
         return await func(*args, **kwargs)
-    return wrapper
\ No newline at end of file
+    return wrapper
@@ -1,52 +1,501 @@
-from redis_client import redisClient
+from fastapi import HTTPException, Response
+from redis_client import redisClient, redisBinaryClient
+from redis.exceptions import RedisError
+from utils.local_cache import LocalCache, keyPrefix
+from utils.metrics import cacheLatency, cacheRequests, recordTiming
+from utils.popularity import popularityTracker
+from utils.canonical import canonicalize
+from utils.http_cache import acceptsEncoding, cacheControl, computeETag, encodedETag, notModified
+from utils.deadline import DeadlineExceeded, deadlineRemaining, requestDeadline
+from contextvars import ContextVar
 from functools import wraps
+import asyncio
 import json
+import logging
+import math
+import os
+import random
+import struct
+import time
+import uuid
+import zlib
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# How long the worker fetching a key holds the cross-worker lock (milliseconds)
+# Should comfortably cover a slow upstream call
+CACHE_LOCK_TIMEOUT_MS = int(os.getenv("CACHE_LOCK_TIMEOUT_MS", "10000"))
+# How often workers waiting on another worker's fetch check Redis for the value
+CACHE_LOCK_POLL_INTERVAL = float(os.getenv("CACHE_LOCK_POLL_INTERVAL", "0.05"))
+# How long not found and empty results are cached for (seconds)
+# Short so new content upstream still shows up soon, but repeated searches
+# for something that doesn't exist don't each cost an upstream call
+NEGATIVE_CACHE_EXPIRES = int(os.getenv("NEGATIVE_CACHE_EXPIRES", "300"))
+# How long entries are kept after their stale period, only to be served if
+# fetching a new value fails (e.g. the upstream is down), 0 disables (seconds)
+CACHE_STALE_IF_ERROR = int(os.getenv("CACHE_STALE_IF_ERROR", "3600"))
+# Memory budget for the in-process cache in front of Redis (bytes)
+LOCAL_CACHE_MAX_BYTES = int(os.getenv("LOCAL_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# Workers publish the keys they write on this channel so the
+# other workers drop their now outdated in-process copy
+INVALIDATION_CHANNEL = "cache:invalidate"
+# Identifies this worker so it can ignore its own invalidation messages
+WORKER_ID = uuid.uuid4().hex
+
+localCache = LocalCache(LOCAL_CACHE_MAX_BYTES)
+
+# Only deletes the lock if it is still owned by the worker releasing it
+# Prevents a slow worker deleting a lock that has since expired and been re-acquired
+RELEASE_LOCK_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+# True while fetching to refresh an entry rather than for a request waiting on it
+# Lets upstream budgets (e.g. the YouTube quota) put waiting requests first
+refreshingFetch: ContextVar[bool] = ContextVar("refreshingFetch", default=False)
+
+# Fetches currently in progress in this worker, keyed by cache key
+# Concurrent misses for the same key all await the same task
+inFlightFetches = {}
+
+# Counts how requests which missed the cache were served
+# leader: made the upstream call itself
+# coalesced: shared the result of a fetch already in progress (in this worker)
+# coalescedRemote: waited for another worker to fill the cache
+singleFlightStats = {"leader": 0, "coalesced": 0, "coalescedRemote": 0}
+
+# Counts background refreshes of cached entries
+# stale: entry was past its soft TTL and served stale while refreshing
+# early: entry was refreshed early by the probabilistic (XFetch) check
+refreshStats = {"stale": 0, "early": 0}
+
+# Entries are stored in a small binary format: a fixed header followed by the
+# JSON body, zlib compressed if it is large enough to be worth it
+# The header holds a soft expiry alongside the value, after which the value is
+# still served (stale) until Redis removes it at the hard expiry, while a
+# background task refreshes it
+# Header: magic, format version, flags, soft expiry, last fetch duration, ETag
+# The ETag is stored so it is only computed once, when the value is cached
+# Not found and empty results are flagged as negative, with not found ones also
+# flagged FLAG_NOT_FOUND and the error detail stored as the body
+ENTRY_HEADER = struct.Struct(">2sBBdd24s")
+ENTRY_MAGIC = b"TT"
+ENTRY_VERSION = 2
+# Version 1 entries have no ETag, it is computed when they are read
+ENTRY_HEADER_V1 = struct.Struct(">2sBBdd")
+FLAG_COMPRESSED = 1
+FLAG_NOT_FOUND = 2
+FLAG_NEGATIVE = 4
+# Bodies smaller than this aren't compressed as the saving is negligible
+COMPRESSION_MIN_BYTES = int(os.getenv("CACHE_COMPRESSION_MIN_BYTES", "512"))
+
+# Serializes a result to JSON bytes the same way FastAPI's JSONResponse does
+# so the stored body can be sent as the response without re-encoding
+def encodeBody(result):
+    return json.dumps(result, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+# Compresses the body if it is large enough to be worth it, otherwise returns None
+# zlib's output is also what HTTP calls deflate so can be sent to clients as is
+def compressBody(body: bytes):
+    if len(body) >= COMPRESSION_MIN_BYTES:
+        return zlib.compress(body, 6)
+    return None
+
+# deflated is the already compressed body and etag the body's ETag if the caller has them
+def serializeEntry(body: bytes, softExpiry: float, delta: float, notFound: bool = False, negative: bool = False, deflated=None, etag=None):
+    flags = (FLAG_NOT_FOUND if notFound else 0) | (FLAG_NEGATIVE if negative else 0)
+    if etag is None:
+        etag = computeETag(body)
+    if deflated is None:
+        deflated = compressBody(body)
+    if deflated is not None:
+        body = deflated
+        flags |= FLAG_COMPRESSED
+    # Stored without the quotes
+    return ENTRY_HEADER.pack(ENTRY_MAGIC, ENTRY_VERSION, flags, softExpiry, delta, etag[1:-1].encode()) + body
+
+# Builds the entry dict held in the in-process cache
+# The ETag is computed here unless it was stored with the entry
+# deflated is the compressed body, kept to send to clients accepting deflate
+def makeEntry(body: bytes, softExpiry: float, delta: float, notFound=False, negative=False, deflated=None, etag=None):
+    return {
+        "body": body,
+        "deflated": deflated,
+        "etag": etag if etag is not None else computeETag(body),
+        "softExpiry": softExpiry,
+        "delta": delta,
+        "notFound": notFound,
+        "negative": negative,
+    }
+
+# Approximate memory used by an entry, for the in-process cache's budget
+def entrySize(entry):
+    return len(entry["body"]) + len(entry["deflated"] or b"")
+
+# Reads a stored entry back into a dict with the JSON body and its expiry details
+def deserializeEntry(cachedResult: bytes):
+    if cachedResult[:2] == ENTRY_MAGIC:
+        if cachedResult[2] == 1:
+            _, _, flags, softExpiry, delta = ENTRY_HEADER_V1.unpack_from(cachedResult)
+            body, etag = cachedResult[ENTRY_HEADER_V1.size:], None
+        else:
+            _, _, flags, softExpiry, delta, etag = ENTRY_HEADER.unpack_from(cachedResult)
+            body, etag = cachedResult[ENTRY_HEADER.size:], '"' + etag.decode() + '"'
+        deflated = None
+        if flags & FLAG_COMPRESSED:
+            deflated = body
+            body = zlib.decompress(body)
+        return makeEntry(body, softExpiry, delta, bool(flags & FLAG_NOT_FOUND), bool(flags & FLAG_NEGATIVE), deflated, etag)
+
+    # Entries written as JSON text by earlier versions are still readable
+    # Ones without a soft expiry are treated as fresh until Redis expires them
+    entry = json.loads(cachedResult)
+    if not isinstance(entry, dict) or "softExpiry" not in entry:
+        return makeEntry(encodeBody(entry), math.inf, 0.0)
+    return makeEntry(encodeBody(entry["value"]), entry["softExpiry"], entry["delta"])
+
+# Builds the HTTP response straight from the cached JSON bytes
+# Whether it came from the cache is sent as a header rather than in the body
+# Cache-Control lets clients reuse it for as long as it stays fresh here
+# Cached not found results are raised again as the same 404 the endpoint raised
+# request is only given when responding to the client directly, in which case
+# a 304 is sent if the client already has it, and the stored compressed
+# body is sent as is to clients accepting deflate
+def cachedResponse(entry, source: str, request=None, staleFor: float = 0):
+    remaining = entry["softExpiry"] - time.time()
+    # Negative entries aren't served stale here so shouldn't be by clients either
+    headers = {
+        "X-Cache-Source": source,
+        "Cache-Control": cacheControl(
+            remaining if math.isfinite(remaining) else 0,
+            0 if entry["negative"] else staleFor
+        ),
+    }
+    if entry["notFound"]:
+        raise HTTPException(status_code=404, detail=json.loads(entry["body"]), headers=headers)
+
+    headers["ETag"] = entry["etag"]
+    if request is None:
+        return Response(content=entry["body"], media_type="application/json", headers=headers)
+
+    deflateETag = encodedETag(entry["etag"], "deflate")
+    # The deflate tag only matches while the client still accepts deflate
+    etags = (entry["etag"], deflateETag) if acceptsEncoding(request, "deflate") else (entry["etag"],)
+    if notModified(request, *etags):
+        return Response(status_code=304, headers=headers)
+    # Stored compressed bytes are sent as is, GZipMiddleware leaves encoded responses alone
+    # Vary is only added here for them, GZipMiddleware adds it to responses it compresses
+    if entry["deflated"] is not None and acceptsEncoding(request, "deflate"):
+        headers["ETag"] = deflateETag
+        headers["Content-Encoding"] = "deflate"
+        headers["Vary"] = "Accept-Encoding"
+        return Response(content=entry["deflated"], media_type="application/json", headers=headers)
+    return Response(content=entry["body"], media_type="application/json", headers=headers)
+
+# Decides whether an entry should be refreshed in the background
+# Past the soft expiry always refresh, otherwise use probabilistic early
+# expiration (XFetch) so hot keys are refreshed by a single request
+# shortly before they expire rather than by every request at once
+# delta is how long the last fetch took, beta > 1 favours earlier refreshes
+def refreshReason(entry, beta: float):
+    now = time.time()
+    if now >= entry["softExpiry"]:
+        return "stale"
+    # -log(random) is exponentially distributed, scaled by the fetch time
+    # random() can return 0 so use 1 - random() which is in (0, 1]
+    if beta > 0 and now - entry["delta"] * beta * math.log(1.0 - random.random()) >= entry["softExpiry"]:
+        return "early"
+    return None
+
+# Reads an entry from the in-process cache, falling back to Redis
+# Entries read from Redis are kept locally until Redis would expire them
+async def readEntry(cacheKey):
+    entry = localCache.get(cacheKey)
+    if entry is not None:
+        cacheRequests.labels(keyPrefix(cacheKey), "local_hit").inc()
+        return entry
+
+    async with redisBinaryClient.pipeline(transaction=False) as pipe:
+        pipe.get(cacheKey)
+        pipe.pttl(cacheKey)
+        cachedResult, ttlMs = await pipe.execute()
+    if not cachedResult:
+        cacheRequests.labels(keyPrefix(cacheKey), "miss").inc()
+        return None
+
+    cacheRequests.labels(keyPrefix(cacheKey), "redis_hit").inc()
+    entry = deserializeEntry(cachedResult)
+    # Keys without an expiry (pttl of -1) aren't kept locally
+    if ttlMs > 0:
+        localCache.set(cacheKey, entry, entrySize(entry), ttlMs / 1000)
+    return entry
+
+# Returns the cached entry's soft expiry and whether it is negative, None if it isn't in Redis
+# Only reads the header so is cheap enough to check many keys
+async def readEntryHeader(cacheKey):
+    header = await redisBinaryClient.getrange(cacheKey, 0, ENTRY_HEADER.size - 1)
+    if not header:
+        return None
+    if header[:2] != ENTRY_MAGIC:
+        # Older JSON entries, treated as fresh until Redis expires them
+        return {"softExpiry": math.inf, "negative": False}
+    # Version 2 only adds the ETag after the fields needed here, so both read the same
+    _, _, flags, softExpiry, _ = ENTRY_HEADER_V1.unpack_from(header)
+    return {"softExpiry": softExpiry, "negative": bool(flags & FLAG_NEGATIVE)}
+
+# Writes an entry to Redis and the in-process cache, and tells the
+# other workers to drop their copy of the key
+# For a not found entry the result is the error detail
+# Returns the written entry
+async def writeEntry(cacheKey, result, expires, staleFor, delta, notFound=False, negative=False):
+    body = encodeBody(result)
+    entry = makeEntry(body, time.time() + expires, delta, notFound, negative, compressBody(body))
+    # Kept in Redis for the stale period after the soft expiry, then for longer
+    # still in case the upstream is failing when it's next fetched
+    # Negative entries are never served stale so go at the soft expiry
+    ttl = expires if negative else expires + staleFor + CACHE_STALE_IF_ERROR
+    await redisBinaryClient.setex(
+        cacheKey,
+        ttl,
+        serializeEntry(body, entry["softExpiry"], delta, notFound, negative, entry["deflated"], entry["etag"])
+    )
+    localCache.set(cacheKey, entry, entrySize(entry), ttl)
+    await redisClient.publish(INVALIDATION_CHANNEL, f"{WORKER_ID}:{cacheKey}")
+    return entry
+
+# Listens for keys written by other workers and removes them from the
+# in-process cache, started once per worker in the app lifespan
+async def listenForInvalidations():
+    while True:
+        pubsub = redisClient.pubsub()
+        try:
+            await pubsub.subscribe(INVALIDATION_CHANNEL)
+            # Messages may have been missed while not subscribed
+            localCache.clear()
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                workerId, _, cacheKey = message["data"].partition(":")
+                if workerId != WORKER_ID:
+                    localCache.remove(cacheKey)
+        except (RedisError, OSError) as error:
+            logger.warning("Cache invalidation listener disconnected: %r", error)
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
+
+# Fetches the result from upstream while holding a short Redis lock
+# so only one worker across the deployment makes the upstream call
+# When refreshing an existing entry, workers which don't get the lock
+# simply skip the refresh as the stale value is still being served
+# endpoint is the checkRedisCache wrapper, holding the cache settings and the uncached function
+# Returns the entry and where it came from, or None for a skipped refresh
+async def fetchWithLock(cacheKey, endpoint, args, kwargs, refreshing=False):
+    # Runs as its own task so this only affects the fetch
+    # Refreshes aren't awaited by a request so don't have its deadline
+    if refreshing:
+        requestDeadline.set(None)
+        refreshingFetch.set(True)
+    lockKey = f"lock:{cacheKey}"
+    lockToken = uuid.uuid4().hex
+    acquired = await redisClient.set(lockKey, lockToken, nx=True, px=CACHE_LOCK_TIMEOUT_MS)
+
+    if not acquired:
+        if refreshing:
+            return None
+        # Another worker is already fetching this key, wait for it to fill the cache
+        waited = 0.0
+        while waited < CACHE_LOCK_TIMEOUT_MS / 1000:
+            await asyncio.sleep(CACHE_LOCK_POLL_INTERVAL)
+            waited += CACHE_LOCK_POLL_INTERVAL
+            cachedResult = await redisBinaryClient.get(cacheKey)
+            if cachedResult:
+                entry = deserializeEntry(cachedResult)
+                # Entries past their stale period are only kept as the fallback
+                # this fetch is replacing, so keep waiting for the new value
+                if time.time() < entry["softExpiry"] + endpoint.staleFor:
+                    singleFlightStats["coalescedRemote"] += 1
+                    return entry, "cache"
+            # Lock released without a value being cached (e.g. the upstream call failed)
+            # so stop waiting and try the upstream call from this worker
+            if not await redisClient.exists(lockKey):
+                break
+
+    singleFlightStats["leader"] += 1
+    try:
+        # If not cached, call the original function
+        # Timing the call as slower fetches should be refreshed earlier
+        start = time.time()
+        expires, staleFor = endpoint.expires, endpoint.staleFor
+        notFound = False
+        try:
+            result = await endpoint.__wrapped__(*args, **kwargs)
+        except HTTPException as error:
+            if error.status_code != 404 or endpoint.negativeExpires is None:
+                raise
+            # Not found is cached briefly so repeats don't go upstream again
+            result, notFound = error.detail, True
+        delta = time.time() - start
+
+        # Not found and empty results aren't served stale so they're retried once expired
+        negative = endpoint.negativeExpires is not None and (notFound or endpoint.isEmpty(result))
+        if negative:
+            expires, staleFor = endpoint.negativeExpires, 0
+            cacheRequests.labels(keyPrefix(cacheKey), "negative").inc()
+
+        # Cache the result to reduce future API calls
+        # The serialized body is reused for the response
+        return await writeEntry(cacheKey, result, expires, staleFor, delta, notFound, negative), "upstream"
+    finally:
+        if acquired:
+            await redisClient.eval(RELEASE_LOCK_SCRIPT, 1, lockKey, lockToken)
+
+# Starts a fetch for the cache key or returns the one already in progress
+# Fetches run as their own task so a cancelled request (e.g. client
+# disconnect) doesn't cancel the fetch for everyone waiting on it
+def startFetch(cacheKey, endpoint, args, kwargs, refreshing=False):
+    fetch = inFlightFetches.get(cacheKey)
+    if fetch is not None:
+        return fetch, False
+
+    fetch = asyncio.ensure_future(
+        fetchWithLock(cacheKey, endpoint, args, kwargs, refreshing)
+    )
+    inFlightFetches[cacheKey] = fetch
+    fetch.add_done_callback(lambda _: inFlightFetches.pop(cacheKey, None))
+    return fetch, True
+
+# Whether a failed fetch can be answered with the stale value kept for errors
+# Requests refused by admission control, deadlines and upstream errors can,
+# other errors (e.g. a bad request) would fail the same way with the stale value
+def isUpstreamFailure(error):
+    if isinstance(error, HTTPException):
+        return error.status_code >= 500
+    return isinstance(error, (httpx.HTTPError, asyncio.TimeoutError))
+
+# Waits for the fetch, giving up at the request's deadline
+# The fetch itself carries on so the cache is still filled for later requests
+async def awaitFetch(fetch):
+    try:
+        return await asyncio.wait_for(asyncio.shield(fetch), deadlineRemaining())
+    except asyncio.TimeoutError:
+        if fetch.done():
+            raise
+        # Nobody may be left waiting on it, so log if it fails
+        fetch.add_done_callback(logRefreshFailure)
+        raise DeadlineExceeded()
+
+# Background refreshes, and fetches requests gave up waiting on, have nobody awaiting them so log any failure
+# The stale value stays in the cache until its hard expiry
+def logRefreshFailure(fetch):
+    if not fetch.cancelled() and fetch.exception() is not None:
+        logger.warning("Background cache refresh failed: %r", fetch.exception())
 
 # Wrapper function which checks if result is cached in Redis
 # If result is cached prevents API call and returns cached result
-# Wrapper should be placed before any rate limiting if needed
-def checkRedisCache(cacheKeyFunc, expires: int = 3600):
+# Results are returned as a JSON response built from the cached bytes,
+# with an X-Cache-Source header of either cache or upstream, an ETag and
+# a Cache-Control header derived from how long the entry stays fresh
+# Concurrent misses for the same key are coalesced into a single upstream call
+# Entries are fresh for expires seconds, then served stale for up to staleFor
+# seconds while being refreshed in the background (stale-while-revalidate)
+# beta controls how eagerly hot keys are refreshed before expiring, 0 disables
+# Not found (404) results, and results isEmpty returns True for, are cached for
+# negativeExpires seconds instead, None disables caching them differently
+# Past the stale period entries are kept for another CACHE_STALE_IF_ERROR seconds,
+# only served (with an X-Cache-Source of stale) if fetching a new value fails
+# Fetches give up at the request's deadline, falling back to that stale value if any
+# Arguments named in canonical are canonicalized (case, accents, whitespace)
+# before building the key and calling the endpoint so variants share one entry
+# Wrapper should be placed above any rate limiting decorator so cache hits skip the limiter
+# The cache settings are kept on the wrapper so the cache warmer can refresh keys itself,
+# and once registered with the warmer requests are counted towards the key's popularity
+def checkRedisCache(
+    cacheKeyFunc,
+    expires: int = 3600,
+    staleFor: int | None = None,
+    beta: float = 1.0,
+    negativeExpires: int | None = NEGATIVE_CACHE_EXPIRES,
+    isEmpty=lambda result: False,
+    canonical: tuple[str, ...] = (),
+):
+    # By default serve stale values for as long as they were fresh
+    if staleFor is None:
+        staleFor = expires
+
+    # Canonical arguments, used for the key and passed on to the endpoint
+    def canonicalArgs(kwargs):
+        return {
+            name: canonicalize(value) if name in canonical and isinstance(value, str) else value
+            for name, value in kwargs.items()
+        }
+
     def decorator(func):
         @wraps(func)
         async def wrapper(*args, **kwargs):
+            kwargs = canonicalArgs(kwargs)
+            # Only requests routed straight to this endpoint get conditional and
+            # compressed responses, other endpoints calling it need the plain body
+            request = kwargs.get("request")
+            if request is not None and request.scope.get("endpoint") is not wrapper:
+                request = None
             # Need to use function to get cache key dynamically
             cacheKey = cacheKeyFunc(*args, **kwargs)
-            # Check if the result is already cached in Redis
-            cachedResult = await redisClient.get(cacheKey)
-            if cachedResult:
-                data = json.loads(cachedResult)
-                # Simply marking if the result is from cache
-                data["source"] = "cache"
-                return data
-            
-            # If not cached, call the original function
-            result = await func(*args, **kwargs)
-
-            # Cache the result in Redis to reduce future API calls
-            await redisClient.setex(cacheKey, expires, json.dumps(result))
-            return result
-        return wrapper
-    return decorator
+            if wrapper.popularityPrefix is not None:
+                popularityTracker.track(wrapper.popularityPrefix, kwargs)
+            # Check if the result is already cached locally or in Redis
+            start = time.perf_counter()
+            entry = await readEntry(cacheKey)
+            lookupTime = time.perf_counter() - start
+            cacheLatency.observe(lookupTime)
+            recordTiming("cache", lookupTime)
+            # Past its stale period the entry is only kept in case the fetch fails
+            fallback = None
+            if entry is not None and not entry["negative"] and time.time() >= entry["softExpiry"] + staleFor:
+                fallback, entry = entry, None
+            if entry is not None:
+                reason = refreshReason(entry, beta)
+                if reason is not None:
+                    fetch, started = startFetch(cacheKey, wrapper, args, kwargs, refreshing=True)
+                    if started:
+                        refreshStats[reason] += 1
+                        cacheRequests.labels(keyPrefix(cacheKey), reason).inc()
+                        fetch.add_done_callback(logRefreshFailure)
+                return cachedResponse(entry, "cache", request, staleFor)
 
-# Modified version of standard checking of redis cache
-# Accepts a string for cache key instead of func as 
-# dynamic key is not required
-# Used for spotify access token
-def checkRedisCacheStringKey(cacheKey: str, expires: int = 3400):
-    def decorator(func):
-        @wraps(func)
-        async def wrapper(*args, **kwargs):
-            # Check Redis first
-            cachedResult = await redisClient.get(cacheKey)
-            if cachedResult:
-                # Format into string
-                return cachedResult
+            # Join a fetch for the same key already in progress in this worker
+            fetch, started = startFetch(cacheKey, wrapper, args, kwargs)
+            if not started:
+                singleFlightStats["coalesced"] += 1
+                cacheRequests.labels(keyPrefix(cacheKey), "coalesced").inc()
 
-            # If nothing found in cache run standard function
-            result = await func(*args, **kwargs)
+            try:
+                fetched = await awaitFetch(fetch)
+                # Joined a background refresh which another worker was already doing
+                # so the entry expired in between, fetch it normally instead
+                if fetched is None:
+                    fetch, _ = startFetch(cacheKey, wrapper, args, kwargs)
+                    fetched = await awaitFetch(fetch)
+            except Exception as error:
+                if fallback is None or not isUpstreamFailure(error):
+                    raise
+                logger.info("Serving stale %s after fetch failed: %r", cacheKey, error)
+                cacheRequests.labels(keyPrefix(cacheKey), "stale_if_error").inc()
+                return cachedResponse(fallback, "stale", request)
+            return cachedResponse(*fetched, request, staleFor)
 
-            # Cache result of normal function in Redis to reduce future API calls
-            await redisClient.setex(cacheKey, expires, result)
-            return result
+        # Cache key for the arguments as the endpoint would build it
+        wrapper.cacheKey = lambda *args, **kwargs: cacheKeyFunc(*args, **canonicalArgs(kwargs))
+        wrapper.canonicalArgs = canonicalArgs
+        wrapper.expires = expires
+        wrapper.staleFor = staleFor
+        wrapper.negativeExpires = negativeExpires
+        wrapper.isEmpty = isEmpty
+        wrapper.popularityPrefix = None # Set by CacheWarmer.register
         return wrapper
-    return decorator
\ No newline at end of file
+    return decorator
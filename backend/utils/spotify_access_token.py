@@ -1,20 +1,47 @@
 from fastapi import HTTPException
-from utils.redis_cache import checkRedisCacheStringKey
+from redis.exceptions import RedisError
+from redis_client import redisClient
+from utils.http_client import requestWithRetry
+from utils.metrics import tokenRefreshes
+from utils.rate_limiter import spotifyRateLimiter
+import asyncio
 import base64
+import logging
 import os
+import time
+import uuid
 import httpx
 
+logger = logging.getLogger(__name__)
+
 # API key from envirnoment variable
 SPOTIFY_CLIENT_KEY = os.getenv("SPOTIFY_CLIENT_KEY")
 SPOTIFY_SECRET_KEY = os.getenv("SPOTIFY_SECRET_KEY")
+# Only overridden to point at a local stand-in when benchmarking
+SPOTIFY_ACCOUNTS_URL = os.getenv("SPOTIFY_ACCOUNTS_URL", "https://accounts.spotify.com")
 
-# Gets access token to allow Spotify API calls
-# Global httpx instance is passed as a parameter
-# Caching key with expiration of under an hour to prevent
-# unecessary access token requests
-@checkRedisCacheStringKey("spotify:access_token", 3400)
-async def get_spotify_access_token(client: httpx.AsyncClient):
-    url = "https://accounts.spotify.com/api/token"
+# Token is refreshed this many seconds before Spotify expires it
+TOKEN_REFRESH_MARGIN = int(os.getenv("SPOTIFY_TOKEN_REFRESH_MARGIN", "300"))
+# How long the worker refreshing the token holds the cross-worker lock (milliseconds)
+TOKEN_LOCK_TIMEOUT_MS = 10000
+
+TOKEN_KEY = "spotify:access_token"
+TOKEN_LOCK_KEY = f"lock:{TOKEN_KEY}"
+
+# Deletes the key only if it still holds the given value
+# Used to release the refresh lock and to drop a token Spotify rejected
+# without removing one another worker has just replaced it with
+DELETE_IF_EQUAL_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+# Gets a new access token from Spotify
+# Returns the token and how many seconds it is valid for
+async def request_spotify_access_token(client: httpx.AsyncClient):
+    url = f"{SPOTIFY_ACCOUNTS_URL}/api/token"
     # Sending authorization header with base64 encoded client key and secret
     auth_str = f"{SPOTIFY_CLIENT_KEY}:{SPOTIFY_SECRET_KEY}"
     headers = {
@@ -24,9 +51,139 @@ async def get_spotify_access_token(client: httpx.AsyncClient):
     # Client credentials instead of user credentials as only need to access public data
     data = {"grant_type": "client_credentials"}
 
-    response = await client.post(url, data=data, headers=headers)
-    
+    response = await requestWithRetry(client, "POST", url, data=data, headers=headers)
+
     if response.status_code != 200:
         raise HTTPException(status_code=500, detail="Error fetching Spotify access token")
 
-    return response.json()["access_token"]
\ No newline at end of file
+    tokenData = response.json()
+    return tokenData["access_token"], int(tokenData.get("expires_in", 3600))
+
+# Keeps the Spotify access token in memory so requests don't touch Redis
+# Redis is only used to share the token between workers, with a lock so
+# only one worker asks Spotify for a new token when it is due to expire
+class SpotifyTokenManager:
+    def __init__(self):
+        self.token = None
+        self.expiresAt = 0.0 # Unix time Spotify expires the token
+        self.refreshTask = None # Refresh in progress in this worker
+        self.refreshes = 0 # Tokens requested from Spotify by this worker
+
+    # Returns a valid token, only waiting if there isn't one at all
+    async def getToken(self, client: httpx.AsyncClient):
+        now = time.time()
+        if self.token is not None and now < self.expiresAt:
+            # Close to expiring so refresh in the background but keep using the current token
+            if now >= self.expiresAt - TOKEN_REFRESH_MARGIN:
+                self.startRefresh(client)
+            return self.token
+
+        await asyncio.shield(self.startRefresh(client))
+        return self.token
+
+    # Starts a refresh or returns the one already in progress in this worker
+    def startRefresh(self, client: httpx.AsyncClient):
+        if self.refreshTask is None or self.refreshTask.done():
+            self.refreshTask = asyncio.ensure_future(self.refresh(client))
+            self.refreshTask.add_done_callback(self.logRefreshFailure)
+        return self.refreshTask
+
+    def logRefreshFailure(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Spotify access token refresh failed: %r", task.exception())
+
+    # Uses a token stored in Redis by another worker if it isn't due for refresh
+    async def adoptSharedToken(self):
+        async with redisClient.pipeline(transaction=False) as pipe:
+            pipe.get(TOKEN_KEY)
+            pipe.pttl(TOKEN_KEY)
+            token, ttlMs = await pipe.execute()
+        if token and ttlMs > TOKEN_REFRESH_MARGIN * 1000:
+            self.token = token
+            self.expiresAt = time.time() + ttlMs / 1000
+            return True
+        return False
+
+    async def fetchToken(self, client: httpx.AsyncClient):
+        token, expiresIn = await request_spotify_access_token(client)
+        self.refreshes += 1
+        tokenRefreshes.inc()
+        self.token = token
+        self.expiresAt = time.time() + expiresIn
+        return expiresIn
+
+    async def refresh(self, client: httpx.AsyncClient):
+        try:
+            if await self.adoptSharedToken():
+                return
+
+            lockToken = uuid.uuid4().hex
+            acquired = await redisClient.set(TOKEN_LOCK_KEY, lockToken, nx=True, px=TOKEN_LOCK_TIMEOUT_MS)
+            if not acquired:
+                # Another worker is refreshing, wait for it to share the new token
+                waited = 0.0
+                while waited < TOKEN_LOCK_TIMEOUT_MS / 1000:
+                    await asyncio.sleep(0.05)
+                    waited += 0.05
+                    if await self.adoptSharedToken():
+                        return
+                    if not await redisClient.exists(TOKEN_LOCK_KEY):
+                        break
+
+            try:
+                expiresIn = await self.fetchToken(client)
+                # Shared for as long as Spotify says the token is valid
+                await redisClient.setex(TOKEN_KEY, expiresIn, self.token)
+            finally:
+                if acquired:
+                    await redisClient.eval(DELETE_IF_EQUAL_SCRIPT, 1, TOKEN_LOCK_KEY, lockToken)
+        except (RedisError, OSError) as error:
+            # Without Redis each worker just manages its own token
+            logger.warning("Redis unavailable for Spotify access token, fetching directly: %r", error)
+            await self.fetchToken(client)
+
+    # Drops a token Spotify has rejected so the next request gets a new one
+    async def invalidate(self, token: str):
+        if self.token == token:
+            self.token = None
+            self.expiresAt = 0.0
+        try:
+            await redisClient.eval(DELETE_IF_EQUAL_SCRIPT, 1, TOKEN_KEY, token)
+        except (RedisError, OSError):
+            pass
+
+    # Refreshes the token in the background before it expires
+    # Started once per worker in the app lifespan
+    async def keepFresh(self, client: httpx.AsyncClient):
+        while True:
+            try:
+                if self.token is None or time.time() >= self.expiresAt - TOKEN_REFRESH_MARGIN:
+                    await asyncio.shield(self.startRefresh(client))
+            except Exception as error:
+                logger.warning("Spotify access token refresh failed: %r", error)
+                await asyncio.sleep(5)
+                continue
+            # Wake up when the token is due for refresh
+            await asyncio.sleep(max(1.0, self.expiresAt - TOKEN_REFRESH_MARGIN - time.time()))
+
+spotifyTokenManager = SpotifyTokenManager()
+
+# Gets access token to allow Spotify API calls
+# Global httpx instance is passed as a parameter
+async def get_spotify_access_token(client: httpx.AsyncClient):
+    return await spotifyTokenManager.getToken(client)
+
+# Makes an authorized GET request to the Spotify API
+# If Spotify rejects the token (401) it is replaced and the request retried once
+# Transient failures and 429s are retried, backing off the shared rate limiter
+async def spotify_get(client: httpx.AsyncClient, url: str, params=None):
+    for attempt in range(2):
+        access_token = await get_spotify_access_token(client)
+        # Have to send auth header for API access with generated access token
+        headers = {"Authorization": f"Bearer {access_token}"}
+        response = await requestWithRetry(
+            client, "GET", url, limiter=spotifyRateLimiter, params=params, headers=headers
+        )
+        if response.status_code != 401 or attempt == 1:
+            return response
+        await spotifyTokenManager.invalidate(access_token)
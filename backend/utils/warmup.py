@@ -0,0 +1,53 @@
+# Warms up a worker before it starts taking requests
+# Without this the first requests to each worker pay for connecting to Redis,
+# the TLS handshakes to every upstream and fetching a Spotify access token
+# Run in the app lifespan, uvicorn only hands a worker requests once its startup is done
+import asyncio
+import logging
+import os
+import time
+import httpx
+from redis_client import redisClient, redisBinaryClient
+from utils.spotify_access_token import spotifyTokenManager
+
+logger = logging.getLogger(__name__)
+
+# Set to 0 to skip the warm-up, e.g. to measure a cold start
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "1") != "0"
+# Longest each warm-up step may hold up startup (seconds)
+# Steps which don't finish in time are left for the first requests to do
+STARTUP_WARMUP_TIMEOUT = float(os.getenv("STARTUP_WARMUP_TIMEOUT", "10"))
+# Redis connections opened per client, enough for the usual concurrent cache lookups
+REDIS_WARM_CONNECTIONS = int(os.getenv("REDIS_WARM_CONNECTIONS", "4"))
+
+# Opens pooled connections to Redis, concurrent pings each need their own connection
+async def warmRedis():
+    for client in (redisClient, redisBinaryClient):
+        await asyncio.gather(*(client.ping() for _ in range(REDIS_WARM_CONNECTIONS)))
+
+# Opens a keep-alive connection to the upstream's host
+# Only the host's root is requested so no API quota is used, whatever the status
+async def warmUpstream(client: httpx.AsyncClient, url: str):
+    await client.head(httpx.URL(url).copy_with(path="/", query=None))
+
+# Runs every warm-up step concurrently, returning how each went
+# upstreams are (name, client, API URL)
+# Failures are logged and reported but don't stop the worker starting,
+# the steps are only done ahead of time and requests still do them if needed
+async def warmUp(app, upstreams):
+    steps = {"redis": warmRedis()}
+    for name, client, url in upstreams:
+        steps[name] = warmUpstream(client, url)
+    steps["spotifyToken"] = spotifyTokenManager.getToken(app.spotifyClient)
+
+    async def runStep(name, step):
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(step, STARTUP_WARMUP_TIMEOUT)
+            error = None
+        except Exception as exception:
+            error = repr(exception)
+            logger.warning("Startup warm-up of %s failed: %s", name, error)
+        return name, {"ok": error is None, "seconds": time.perf_counter() - start, "error": error}
+
+    return dict(await asyncio.gather(*(runStep(name, step) for name, step in steps.items())))
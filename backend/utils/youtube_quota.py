@@ -0,0 +1,161 @@
+# Ledger of the YouTube Data API's daily quota, shared by every worker in Redis
+# Each call is charged its real unit cost (a search costs 100 units, a video lookup 1)
+# and refused once it would go over the budget for that point in the day,
+# so a busy morning can't use up the whole day's quota
+# The budget accrues evenly across the day (the pace), user requests may run
+# ahead of the pace by the burst, background refreshes and warming only spend
+# while under the pace, so users always have the burst to themselves
+# Refused calls raise UpstreamUnavailable, which the cache answers with
+# the stale value if it still has one
+import logging
+import math
+import os
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from redis.exceptions import RedisError
+from redis_client import redisClient
+from utils.circuit_breaker import UpstreamUnavailable
+from utils.popularity import warmingRequests
+from utils.redis_cache import refreshingFetch
+
+logger = logging.getLogger(__name__)
+
+# Units available per day, YouTube's default is 10,000
+YOUTUBE_DAILY_QUOTA = int(os.getenv("YOUTUBE_DAILY_QUOTA", "10000"))
+# Units user requests may spend ahead of the pace
+YOUTUBE_QUOTA_BURST = int(os.getenv("YOUTUBE_QUOTA_BURST", str(YOUTUBE_DAILY_QUOTA // 5)))
+
+# Units charged per call of each API method
+# https://developers.google.com/youtube/v3/determine_quota_cost
+QUOTA_COSTS = {"search.list": 100, "videos.list": 1}
+
+# Quota resets at midnight Pacific Time
+try:
+    QUOTA_TIMEZONE = ZoneInfo("America/Los_Angeles")
+except ZoneInfoNotFoundError:
+    # No time zone database installed, Pacific Standard Time is at most an hour out
+    QUOTA_TIMEZONE = timezone(timedelta(hours=-8))
+
+# Charges a call if it fits the budget, counting it per method, priority and minute
+# KEYS[1] day's ledger hash
+# ARGV[1] cost, ARGV[2] method, ARGV[3] priority, ARGV[4] most units that may be used
+# ARGV[5] minute of the day, ARGV[6] ledger TTL in seconds
+# Returns 1 if charged or 0 if refused, and the units used before the call
+CHARGE_SCRIPT = """
+local cost = tonumber(ARGV[1])
+local used = tonumber(redis.call("HGET", KEYS[1], "total")) or 0
+redis.call("EXPIRE", KEYS[1], ARGV[6])
+if used + cost > tonumber(ARGV[4]) then
+    redis.call("HINCRBY", KEYS[1], "rejected:" .. ARGV[3], 1)
+    return {0, used}
+end
+redis.call("HINCRBY", KEYS[1], "total", cost)
+redis.call("HINCRBY", KEYS[1], "method:" .. ARGV[2], cost)
+redis.call("HINCRBY", KEYS[1], "priority:" .. ARGV[3], cost)
+redis.call("HINCRBY", KEYS[1], "minute:" .. ARGV[5], cost)
+return {1, used}
+"""
+chargeScript = redisClient.register_script(CHARGE_SCRIPT)
+
+# Calls made for background refreshes and cache warming rather than for a waiting user
+def quotaPriority():
+    return "background" if refreshingFetch.get() or warmingRequests.get() else "user"
+
+class YoutubeQuota:
+    def __init__(self, dailyQuota=YOUTUBE_DAILY_QUOTA, burst=YOUTUBE_QUOTA_BURST):
+        self.dailyQuota = dailyQuota
+        self.burst = burst
+
+        # Metrics
+        self.fallbacks = 0 # Calls let through uncharged as Redis was unavailable
+
+    # Start and length (seconds) of the current quota day, and its ledger key
+    # Days are 23 or 25 hours long when the clocks change
+    def quotaDay(self):
+        now = datetime.now(QUOTA_TIMEZONE)
+        start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        # Adding a day keeps the wall clock time so is the next midnight
+        dayLength = (start + timedelta(days=1)).timestamp() - start.timestamp()
+        return now.timestamp() - start.timestamp(), dayLength, f"youtube_quota:{start.date().isoformat()}"
+
+    # Most units that may have been used by now for each priority
+    def limits(self, elapsed: float, dayLength: float):
+        pace = self.dailyQuota * elapsed / dayLength
+        return {
+            "user": min(self.dailyQuota, pace + self.burst),
+            "background": min(self.dailyQuota, pace),
+        }
+
+    # Seconds until a call with this cost would fit under the limit, given the units used
+    def retryAfter(self, used: int, cost: int, priority: str, elapsed: float, dayLength: float):
+        headroom = self.burst if priority == "user" else 0
+        needed = (used + cost - headroom) / self.dailyQuota * dayLength
+        if needed > dayLength:
+            # Not until the quota resets
+            return dayLength - elapsed
+        return max(0.0, needed - elapsed)
+
+    # Charges a call of the API method, raising UpstreamUnavailable if it doesn't fit the budget
+    async def charge(self, method: str):
+        cost = QUOTA_COSTS[method]
+        priority = quotaPriority()
+        elapsed, dayLength, key = self.quotaDay()
+        limit = self.limits(elapsed, dayLength)[priority]
+        try:
+            charged, used = await chargeScript(
+                keys=[key],
+                args=[cost, method, priority, math.floor(limit), int(elapsed // 60), 2 * 86400]
+            )
+        except (RedisError, OSError) as error:
+            # The per second rate limiter still applies so let the call through
+            self.fallbacks += 1
+            logger.warning("YouTube quota ledger unavailable, call not charged: %r", error)
+            return
+        if not charged:
+            raise UpstreamUnavailable("youtube", self.retryAfter(used, cost, priority, elapsed, dayLength))
+
+    # YouTube says the quota is used up (e.g. it was shared with another app),
+    # so refuse every call until it resets
+    async def markExhausted(self):
+        elapsed, dayLength, key = self.quotaDay()
+        try:
+            async with redisClient.pipeline(transaction=False) as pipe:
+                pipe.hset(key, "total", self.dailyQuota)
+                pipe.expire(key, 2 * 86400)
+                await pipe.execute()
+        except (RedisError, OSError) as error:
+            logger.warning("Failed to mark YouTube quota as exhausted: %r", error)
+        return dayLength - elapsed
+
+    # Today's spend so far and how fast it's being spent
+    async def stats(self):
+        elapsed, dayLength, key = self.quotaDay()
+        ledger = {field: int(value) for field, value in (await redisClient.hgetall(key)).items()}
+        used = ledger.get("total", 0)
+        minute = int(elapsed // 60)
+
+        # Units spent per minute, averaged over the last few minutes
+        def spendRate(minutes):
+            spent = sum(ledger.get(f"minute:{m}", 0) for m in range(max(0, minute - minutes + 1), minute + 1))
+            return spent / min(minutes, minute + 1)
+
+        limits = self.limits(elapsed, dayLength)
+        lastHourRate = spendRate(60)
+        return {
+            "dailyQuota": self.dailyQuota,
+            "used": used,
+            "remaining": max(0, self.dailyQuota - used),
+            "pace": round(limits["background"]),
+            "aheadOfPace": round(used - limits["background"]),
+            "userLimit": round(limits["user"]),
+            "spendRatePerMinute": {"last5Minutes": spendRate(5), "lastHour": lastHourRate},
+            # Where the day ends up if the last hour's rate keeps up
+            "projectedUse": round(used + lastHourRate * (dayLength - elapsed) / 60),
+            "byMethod": {name.partition(":")[2]: value for name, value in ledger.items() if name.startswith("method:")},
+            "byPriority": {name.partition(":")[2]: value for name, value in ledger.items() if name.startswith("priority:")},
+            "rejected": {name.partition(":")[2]: value for name, value in ledger.items() if name.startswith("rejected:")},
+            "resetsIn": round(dayLength - elapsed),
+            "localFallbacks": self.fallbacks,
+        }
+
+youtubeQuota = YoutubeQuota()
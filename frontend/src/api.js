@@ -1,18 +1,30 @@
 const backendUrl = "http://localhost:8000";
 
 // Spotify related API calls
-export async function searchForArtists(artist) {
-    const res = await fetch(`${backendUrl}/spotify/search_artists?artist=${encodeURIComponent(artist)}`);
+// Searches are paged, pass the previous page's next as the cursor to get the following page
+function pageParams(cursor) {
+    return cursor ? `&cursor=${encodeURIComponent(cursor)}` : "";
+}
+
+export async function searchForArtists(artist, cursor) {
+    const res = await fetch(`${backendUrl}/spotify/search_artists?artist=${encodeURIComponent(artist)}${pageParams(cursor)}`);
     if (!res.ok) throw new Error("Failed to fetch artists.");
     return res.json();
 }
 
-export async function searchForSongs(song) {
-    const res = await fetch(`${backendUrl}/spotify/search_songs?song=${encodeURIComponent(song)}`);
+export async function searchForSongs(song, cursor) {
+    const res = await fetch(`${backendUrl}/spotify/search_songs?song=${encodeURIComponent(song)}${pageParams(cursor)}`);
     if (!res.ok) throw new Error("Failed to fetch songs.");
     return res.json();
 }
 
+// Suggestions while typing, answered from artists and songs the backend has already seen
+export async function autocomplete(query, signal) {
+    const res = await fetch(`${backendUrl}/autocomplete?q=${encodeURIComponent(query)}`, { signal });
+    if (!res.ok) throw new Error("Failed to fetch suggestions.");
+    return res.json();
+}
+
 export async function getArtistByID(artistID) {
     const res = await fetch(`${backendUrl}/spotify/artists/${encodeURIComponent(artistID)}`);
     if (!res.ok) throw new Error("Failed to fetch artist details.");
@@ -31,6 +43,13 @@ export async function getSongByID(songID) {
     return res.json();
 }
 
+// Song details with their tutorials and tabs in a single request
+export async function getSongPage(songID) {
+    const res = await fetch(`${backendUrl}/song_page/${encodeURIComponent(songID)}`)
+    if (!res.ok) throw new Error("Failed to fetch song details.");
+    return res.json();
+}
+
 export async function getArtistSongsByID(artistID){
     const res = await fetch(`${backendUrl}/spotify/artists/${encodeURIComponent(artistID)}/songs`);
     if (!res.ok) throw new Error("Failed to fetch artist songs.");
@@ -1,5 +1,6 @@
-import { useState } from 'react'
-import { searchForArtists, searchForSongs } from '../api'
+import { useEffect, useState } from 'react'
+import { Link } from 'react-router-dom';
+import { autocomplete, searchForArtists, searchForSongs } from '../api'
 import { Search } from 'lucide-react';
 import SongCard from '../components/SongCard.jsx'
 import ArtistCard from '../components/ArtistCard.jsx';
@@ -11,6 +12,29 @@ function Home() {
   const [searchError, setSearchError] = useState(null); // State to hold any search errors
   const [isLoading, setIsLoading] = useState(false); // State to indicate if the search is in progress
   const [filter, setFilter] = useState(""); // State to hold the search filter
+  const [suggestions, setSuggestions] = useState(null); // State to hold the autocomplete suggestions
+  const [isLoadingMore, setIsLoadingMore] = useState(false); // State to indicate if another page is being fetched
+
+  // Fetch suggestions once the user pauses typing
+  // Previous request is aborted so suggestions never arrive out of order
+  useEffect(() => {
+    if (query.trim().length < 2) {
+      setSuggestions(null);
+      return;
+    }
+    const controller = new AbortController();
+    const timer = setTimeout(async () => {
+      try {
+        setSuggestions(await autocomplete(query, controller.signal));
+      } catch {
+        // Suggestions are optional so errors are ignored
+      }
+    }, 150);
+    return () => {
+      clearTimeout(timer);
+      controller.abort();
+    };
+  }, [query]);
 
   const clearSearch = () => {
     setQuery("");
@@ -18,6 +42,7 @@ function Home() {
     setSearchError(null);
     setIsLoading(false);
     setFilter("");
+    setSuggestions(null);
   };
 
   const handleSearch = async () => {
@@ -29,6 +54,7 @@ function Home() {
 
     try {
       // Set loading and clear previous results
+      setSuggestions(null);
       setIsLoading(true);
       setSearchError(null);
       setResults(null);
@@ -37,6 +63,7 @@ function Home() {
       const songsData = await searchForSongs(query);
       // Combining songs and artists
       const searchData = {
+        query: query,
         artists: artistData,
         songs: songsData,
       };
@@ -53,6 +80,26 @@ function Home() {
     }
   };
 
+  // Appends the next page of songs or artists, usually already prefetched by the backend
+  const loadMore = async (kind) => {
+    const search = kind === "songs" ? searchForSongs : searchForArtists;
+    const key = kind === "songs" ? "tracks" : "artists";
+    try {
+      setIsLoadingMore(true);
+      const page = await search(results.query, results[kind][key].next);
+      setResults((previous) => ({
+        ...previous,
+        [kind]: {
+          [key]: { ...page[key], items: [...previous[kind][key].items, ...page[key].items] },
+        },
+      }));
+    } catch (err) {
+      setSearchError(err.message);
+    } finally {
+      setIsLoadingMore(false);
+    }
+  };
+
   return (
     <div>
       <div className="flex flex-col items-center justify-center p-4 gap-8 mb-20 mt-40">
@@ -83,7 +130,27 @@ function Home() {
               <option value="artists">Artists</option>
           </select>
         </div>
-          
+
+        {/* Suggestions while typing, links straight to the song or artist page */}
+        {suggestions && (suggestions.tracks.length > 0 || suggestions.artists.length > 0) && (
+          <ul className="w-full max-w-3xl bg-white/10 backdrop-blur-md border border-white/20 rounded-xl p-2">
+            {suggestions.tracks.slice(0, 5).map((song) => (
+              <li key={song.id}>
+                <Link to={`/song/${song.id}`} className="block px-4 py-2 text-white hover:underline truncate">
+                  {song.name} <span className="text-gray-400">- {song.artists.map((artist) => artist.name).join(", ")}</span>
+                </Link>
+              </li>
+            ))}
+            {suggestions.artists.slice(0, 3).map((artist) => (
+              <li key={artist.id}>
+                <Link to={`/artist/${artist.id}`} className="block px-4 py-2 text-white hover:underline truncate">
+                  {artist.name} <span className="text-gray-400">- Artist</span>
+                </Link>
+              </li>
+            ))}
+          </ul>
+        )}
+
         <div className="flex flex-col items-center justify-center gap-4 w-full">
           <button 
           className="bg-purple-700 text-white 
@@ -136,6 +203,14 @@ function Home() {
               ) : (
               results && <p className="text-white">No songs found.</p>
               )}
+              {results?.songs?.tracks?.next && (
+                <button
+                className="text-white text-lg mt-4 hover:text-purple-700"
+                onClick={() => loadMore("songs")}
+                disabled={isLoadingMore}>
+                    Load more songs
+                </button>
+              )}
             </div>
           )}
 
@@ -158,6 +233,14 @@ function Home() {
               ) : (
               results && <p className="text-white">No artists found.</p>
               )}
+              {results?.artists?.artists?.next && (
+                <button
+                className="text-white text-lg mt-4 hover:text-purple-700"
+                onClick={() => loadMore("artists")}
+                disabled={isLoadingMore}>
+                    Load more artists
+                </button>
+              )}
             </div>
           )}
           </>
@@ -1,6 +1,6 @@
 import { useState, useEffect } from 'react';
 import { useParams, Link } from 'react-router-dom';
-import { getSongByID, searchTabWebsites, searchTutorialVideos } from '../api';
+import { getSongPage } from '../api';
 import placeholderImage from '../assets/albumplaceholder.png';
 import spotifyIcon from '../assets/spotify-icon.png';
 import TutorialCard from '../components/TutorialCard';
@@ -22,53 +22,33 @@ function Song() {
     const [tabsError, setTabsError] = useState(null); // State to hold errors regarding tab search
 
     useEffect(() => {
-        // Fetch song details from Spotify API using the songID from the URL
-        async function fetchSong() {
+        // Fetch the song, its tabs and its tutorials in one request using the songID from the URL
+        // Tabs and tutorials can fail on their own without failing the song
+        async function fetchSongPage() {
+            setIsSongLoading(true);
+            setIsTabsLoading(true);
+            setIsTutorialsLoading(true);
             try {
-                const songData = await getSongByID(songID);
+                const { song: songData, tutorials: videos, tabs: tabResults } = await getSongPage(songID);
                 setSong(songData);
                 setSongImageUrl(songData.album.images && songData.album.images.length > 0 ? songData.album.images[0].url : placeholderImage);
-            } catch (err) {
-                setSongError(err.message);
-            } finally {
-                setIsSongLoading(false);
-            }
-        }
-
-        fetchSong();
-    }, [songID]);
 
-    // When/if song loads search for Youtube tutorials
-    useEffect(() => {
-        if (!song?.name || !song?.artists[0].name) return; // Only fetch if song has returned a name
+                if (tabResults.error) setTabsError(tabResults.error);
+                else setTabs(tabResults.items);
 
-        async function fetchTabs() {
-            setIsTabsLoading(true);
-            try {
-                const tabs = await searchTabWebsites(`${song.name} ${song.artists[0].name}`);
-                setTabs(tabs.items);
+                if (videos.error) setTutorialsError(videos.error);
+                else setTutorials(videos.items);
             } catch (err) {
-                setTabsError(err.message);
+                setSongError(err.message);
             } finally {
+                setIsSongLoading(false);
                 setIsTabsLoading(false);
-            }
-        }
-
-        async function fetchTutorials() {
-            setIsTutorialsLoading(true);
-            try {
-                const videos = await searchTutorialVideos(`${song.name} ${song.artists[0].name}`);
-                setTutorials(videos.items);
-            } catch (err) {
-                setTutorialsError(err.message);
-            } finally {
                 setIsTutorialsLoading(false);
             }
         }
 
-        fetchTabs();
-        fetchTutorials();
-    }, [song]);
+        fetchSongPage();
+    }, [songID]);
 
     // Converts the spotify ms duration to minutes and seconds
     function formatDuration(ms) {